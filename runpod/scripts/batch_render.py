@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+"""
+Render a directory of input sets through a running ComfyUI, headless.
+
+An input set is the images one view needs, named <set>_<role>.<ext>
+(ph_house02_1DEPTH.jpg, ph_house02_2CANNY.jpg, ...). The roles come from
+the workflow: every LoadImage naming a file of the template set
+(ph_house01_1DEPTH.jpg) takes the matching file of each set instead.
+
+For every set (and every workflow given) the runner uploads the inputs,
+queues the API-format prompt on /prompt with at most --in-flight prompts
+queued at once, follows execution on the websocket, downloads the saved
+images to <out>/<job>/ and requeues failed prompts up to --retries times.
+A summary with jobs/hour goes to <out>/batch_report.json.
+
+UI workflows are pruned and folded like patch_workflow.py --prune, and
+optionally patched with a hardware profile; API-format prompts (e.g.
+sweep_workflow.py variants) are queued as they are.
+
+Usage:
+    python3 batch_render.py inputs/
+    python3 batch_render.py inputs/ archviz_v037_cuda.json --profile rtx4090 --in-flight 2
+    python3 batch_render.py inputs/ sweep/variant_*.json --server http://127.0.0.1:8188 --out renders/
+"""
+
+import argparse
+import base64
+import copy
+import hashlib
+import json
+import os
+import socket
+import ssl
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from pathlib import Path
+
+from patch_workflow import (
+    OUTPUT_NODES,
+    PATCH_PROFILES,
+    WorkflowError,
+    apply_rules,
+    is_link,
+    optimize_workflow,
+)
+
+WORKFLOW_FILE = Path(__file__).resolve().parent.parent / "workflows" / "archviz_v037_cuda.json"
+
+COMFYUI_URL = "http://127.0.0.1:8188"
+
+# The set the workflow's own LoadImage nodes name
+TEMPLATE_SET = "ph_house01"
+
+# Node type -> input holding the image file name
+INPUT_NODES = {"LoadImage": "image", "LoadImageMask": "image"}
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp"}
+
+# Server-side input subfolder for uploads, so batches never overwrite the
+# template images
+UPLOAD_SUBFOLDER = "batch"
+
+# Two prompts in flight keep the GPU busy while the next one uploads and
+# validates; more only grows ComfyUI's queue
+DEFAULT_IN_FLIGHT = 2
+DEFAULT_RETRIES = 2
+DEFAULT_TIMEOUT = 1800
+
+# Seconds between history polls when the websocket is quiet (covers
+# messages missed while reconnecting)
+POLL_SECONDS = 5
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+class ComfyUIError(Exception):
+    """A request ComfyUI rejected; retryable is False when a resubmit cannot help."""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+class WebSocket:
+    """
+    Minimal RFC 6455 client: enough for ComfyUI's /ws event stream.
+
+    recv() returns text messages and None on timeout; binary messages
+    (latent previews) are dropped.
+    """
+
+    def __init__(self, url: str, timeout: float = 10):
+        parts = urllib.parse.urlsplit(url)
+        secure = parts.scheme == "wss"
+        self.sock = socket.create_connection((parts.hostname, parts.port or (443 if secure else 80)), timeout=timeout)
+        if secure:
+            self.sock = ssl.create_default_context().wrap_socket(self.sock, server_hostname=parts.hostname)
+        key = base64.b64encode(os.urandom(16)).decode()
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        self.sock.sendall(
+            f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode()
+        )
+        response = b""
+        while b"\r\n\r\n" not in response:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("websocket handshake: connection closed")
+            response += chunk
+        header, _, self.buffer = response.partition(b"\r\n\r\n")
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        if header.split(b" ", 2)[1:2] != [b"101"] or accept.encode() not in header:
+            raise ConnectionError(f"websocket handshake refused: {header.splitlines()[0].decode(errors='replace')}")
+        self.fragments = []
+
+    def _frame(self):
+        """(opcode, fin, payload) of the next buffered frame, or None if incomplete."""
+        if len(self.buffer) < 2:
+            return None
+        first, second = self.buffer[0], self.buffer[1]
+        length, offset = second & 0x7F, 2
+        if length == 126:
+            if len(self.buffer) < 4:
+                return None
+            length, offset = int.from_bytes(self.buffer[2:4], "big"), 4
+        elif length == 127:
+            if len(self.buffer) < 10:
+                return None
+            length, offset = int.from_bytes(self.buffer[2:10], "big"), 10
+        mask = b""
+        if second & 0x80:
+            mask, offset = self.buffer[offset:offset + 4], offset + 4
+        if len(self.buffer) < offset + length:
+            return None
+        payload = self.buffer[offset:offset + length]
+        self.buffer = self.buffer[offset + length:]
+        if mask:
+            payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        return first & 0x0F, bool(first & 0x80), payload
+
+    def send(self, payload: bytes, opcode: int = 0x1):
+        """Send one frame (clients must mask)."""
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x80 | opcode, 0x80 | length])
+        elif length < 1 << 16:
+            header = bytes([0x80 | opcode, 0x80 | 126]) + length.to_bytes(2, "big")
+        else:
+            header = bytes([0x80 | opcode, 0x80 | 127]) + length.to_bytes(8, "big")
+        self.sock.sendall(header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)))
+
+    def recv(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self._frame()
+            if frame is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.sock.settimeout(remaining)
+                try:
+                    chunk = self.sock.recv(65536)
+                except socket.timeout:
+                    return None
+                if not chunk:
+                    raise ConnectionError("websocket closed")
+                self.buffer += chunk
+                continue
+            opcode, fin, payload = frame
+            if opcode == 0x8:
+                raise ConnectionError("websocket closed by server")
+            if opcode == 0x9:
+                self.send(payload, opcode=0xA)
+                continue
+            if opcode == 0xA:
+                continue
+            self.fragments.append((opcode, payload))
+            if not fin:
+                continue
+            first_opcode = self.fragments[0][0]
+            message = b"".join(part for _, part in self.fragments)
+            self.fragments = []
+            if first_opcode == 0x1:
+                return message.decode()
+
+    def close(self):
+        try:
+            self.send(b"", opcode=0x8)
+        except OSError:
+            pass
+        self.sock.close()
+
+class ComfyClient:
+    """The ComfyUI HTTP endpoints the runner uses."""
+
+    def __init__(self, url: str = COMFYUI_URL, client_id: str = None):
+        self.url = url.rstrip("/")
+        self.client_id = client_id or uuid.uuid4().hex
+
+    def request(self, path: str, data: bytes = None, headers: dict = None, timeout: float = 60) -> bytes:
+        request = urllib.request.Request(self.url + path, data=data, headers=headers or {})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            body = e.read().decode(errors="replace")
+            # 400 is a validation error: the same prompt fails again
+            raise ComfyUIError(f"{path}: HTTP {e.code}: {body[:500]}", retryable=e.code != 400) from e
+        except (urllib.error.URLError, OSError) as e:
+            raise ComfyUIError(f"{path}: {e}") from e
+
+    def get_json(self, path: str):
+        return json.loads(self.request(path))
+
+    def post_json(self, path: str, payload) -> bytes:
+        return self.request(path, json.dumps(payload).encode(), {"Content-Type": "application/json"})
+
+    def upload_image(self, path: Path, name: str, subfolder: str = UPLOAD_SUBFOLDER) -> str:
+        """Upload to ComfyUI's input directory; returns the name LoadImage takes."""
+        boundary = uuid.uuid4().hex
+        fields = [("subfolder", subfolder), ("type", "input"), ("overwrite", "true")]
+        body = b"".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"\r\n\r\n{value}\r\n'.encode()
+            for field, value in fields
+        )
+        body += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="{name}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode() + path.read_bytes() + f"\r\n--{boundary}--\r\n".encode()
+        result = json.loads(self.request(
+            "/upload/image", body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}, timeout=300,
+        ))
+        return f"{result['subfolder']}/{result['name']}" if result.get("subfolder") else result["name"]
+
+    def queue_prompt(self, prompt: dict) -> str:
+        result = json.loads(self.post_json("/prompt", {"prompt": prompt, "client_id": self.client_id}))
+        if result.get("node_errors"):
+            raise ComfyUIError(f"/prompt: node errors: {json.dumps(result['node_errors'])[:500]}", retryable=False)
+        return result["prompt_id"]
+
+    def history(self, prompt_id: str):
+        """The prompt's history entry, or None while it has not finished."""
+        return self.get_json(f"/history/{prompt_id}").get(prompt_id)
+
+    def view(self, image: dict) -> bytes:
+        query = urllib.parse.urlencode({key: image.get(key, "") for key in ("filename", "subfolder", "type")})
+        return self.request(f"/view?{query}", timeout=300)
+
+    def cancel(self, prompt_id: str):
+        """Stop a prompt: interrupt it if running, else drop it from the queue."""
+        queue = self.get_json("/queue")
+        if any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+            self.post_json("/interrupt", {})
+        else:
+            self.post_json("/queue", {"delete": [prompt_id]})
+
+    def websocket(self) -> WebSocket:
+        parts = urllib.parse.urlsplit(self.url)
+        scheme = "wss" if parts.scheme == "https" else "ws"
+        return WebSocket(f"{scheme}://{parts.netloc}/ws?clientId={self.client_id}")
+
+def load_prompt(path: Path, profile: str = None) -> dict:
+    """An API-format prompt from a UI workflow (optimized, optionally patched) or an API file."""
+    data = json.loads(path.read_text())
+    if "nodes" not in data:
+        return data
+    if profile:
+        apply_rules(data, PATCH_PROFILES[profile])
+    return optimize_workflow(data)[0]
+
+def input_roles(prompt: dict, template: str = TEMPLATE_SET) -> dict:
+    """
+    Map role -> [(node id, input)] for the image inputs naming a template file.
+
+    ph_house01_1DEPTH.jpg with template ph_house01 is role 1DEPTH.
+    """
+    roles = {}
+    for node_id, entry in prompt.items():
+        name = INPUT_NODES.get(entry["class_type"])
+        value = entry["inputs"].get(name)
+        if not isinstance(value, str) or is_link(value):
+            continue
+        stem = Path(value.split("/")[-1]).stem
+        if stem.startswith(f"{template}_"):
+            roles.setdefault(stem[len(template) + 1:], []).append((node_id, name))
+    return roles
+
+def find_input_sets(directory: Path, roles) -> dict:
+    """
+    Group the images of a directory into sets by role suffix.
+
+    Returns:
+        Map set name -> {role: path}; files matching no role are ignored
+    """
+    sets = {}
+    # Longest first, so SEG_MASK wins over MASK
+    ordered = sorted(roles, key=len, reverse=True)
+    for path in sorted(directory.iterdir()):
+        if path.suffix.lower() not in IMAGE_EXTENSIONS:
+            continue
+        role = next((role for role in ordered if path.stem.endswith(f"_{role}")), None)
+        if role is not None:
+            sets.setdefault(path.stem[:-len(role) - 1], {})[role] = path
+    return sets
+
+def build_jobs(prompts: list, sets: dict, template: str = TEMPLATE_SET) -> tuple:
+    """
+    One job per input set and prompt.
+
+    Image Save nodes get the job name appended to their prefix (outputs of
+    different jobs never share a name) and show previews, which is what
+    puts their files in /history.
+
+    Returns:
+        (jobs, skipped): jobs as {'name', 'prompt', 'inputs': {(node id,
+        input): path}, 'attempts'}; skipped as (set, missing roles)
+    """
+    jobs, skipped = [], []
+    for set_name, files in sorted(sets.items()):
+        for prompt_name, prompt in prompts:
+            roles = input_roles(prompt, template)
+            missing = sorted(set(roles) - set(files))
+            if missing:
+                skipped.append((set_name, missing))
+                continue
+            name = set_name if len(prompts) == 1 else f"{set_name}_{prompt_name}"
+            job = copy.deepcopy(prompt)
+            for entry in job.values():
+                if entry["class_type"] in OUTPUT_NODES and isinstance(entry["inputs"].get("filename_prefix"), str):
+                    entry["inputs"]["filename_prefix"] += f"_{name}"
+                    if "show_previews" in entry["inputs"]:
+                        entry["inputs"]["show_previews"] = "true"
+            jobs.append({
+                "name": name,
+                "prompt": job,
+                "inputs": {target: files[role] for role, targets in roles.items() for target in targets},
+                "attempts": 0,
+            })
+    return jobs, skipped
+
+def run_batch(client: ComfyClient, jobs: list, out: Path, in_flight: int = DEFAULT_IN_FLIGHT,
+              retries: int = DEFAULT_RETRIES, timeout: float = DEFAULT_TIMEOUT) -> dict:
+    """
+    Queue the jobs with a bounded number in flight and collect their outputs.
+
+    A job is done when the websocket reports its prompt finished (or a
+    history poll finds it); its 'output' images are then saved to
+    <out>/<job name>/. Failed jobs are requeued at the back, up to retries
+    times; validation errors (HTTP 400, node errors) are not retried.
+
+    Returns:
+        Report with per-job results (outputs as node id -> saved paths),
+        wall time and jobs/hour
+    """
+    pending = list(jobs)
+    running = {}  # prompt id -> (job, queued at)
+    uploaded = {}  # local path -> server name
+    results = []
+    started = time.monotonic()
+    socket_ = None
+    last_poll = started
+
+    def finish(job, queued_at, error=None, outputs=None, timing=None):
+        if error and job.get("retryable", True) and job["attempts"] <= retries:
+            print(f"  [retry] {job['name']} (attempt {job['attempts']}): {error}")
+            pending.append(job)
+            return
+        status = "failed" if error else "ok"
+        results.append({
+            "name": job["name"],
+            "status": status,
+            "attempts": job["attempts"],
+            "seconds": round(time.monotonic() - queued_at, 2),
+            "queue_seconds": (timing or {}).get("queue"),
+            "execution_seconds": (timing or {}).get("execution"),
+            "outputs": outputs or {},
+            "error": error,
+        })
+        print(f"  [{status}] {job['name']} in {results[-1]['seconds']:.1f}s" + (f": {error}" if error else ""))
+
+    def collect(prompt_id: str, entry: dict):
+        job, queued_at = running.pop(prompt_id)
+        status = entry.get("status", {})
+        if status.get("status_str") == "error":
+            messages = [data for kind, data in status.get("messages", []) if kind == "execution_error"]
+            error = messages[0].get("exception_message", "execution error") if messages else "execution error"
+            finish(job, queued_at, error=str(error).strip())
+            return
+        saved = {}
+        for node_id, node_output in entry.get("outputs", {}).items():
+            for image in node_output.get("images", []):
+                if image.get("type") != "output":
+                    continue
+                target = out / job["name"] / image["filename"]
+                target.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    target.write_bytes(client.view(image))
+                except ComfyUIError as e:
+                    finish(job, queued_at, error=f"download {image['filename']}: {e}")
+                    return
+                saved.setdefault(node_id, []).append(str(target))
+        if not saved:
+            finish(job, queued_at, error="finished without saved images")
+            return
+        # ComfyUI timestamps (ms) the start and end of execution: before it
+        # the prompt waited in ComfyUI's queue, the rest of a job's time is
+        # uploads and downloads
+        stamps = {kind: data.get("timestamp") for kind, data in status.get("messages", [])}
+        timing = {}
+        if stamps.get("execution_start") and stamps.get("execution_success"):
+            timing["execution"] = round((stamps["execution_success"] - stamps["execution_start"]) / 1000, 2)
+            timing["queue"] = round(max(0, stamps["execution_start"] / 1000 - job["queued_epoch"]), 2)
+        finish(job, queued_at, outputs=saved, timing=timing)
+
+    def poll():
+        nonlocal last_poll
+        last_poll = time.monotonic()
+        for prompt_id in list(running):
+            try:
+                entry = client.history(prompt_id)
+            except ComfyUIError:
+                continue
+            if entry is not None:
+                collect(prompt_id, entry)
+            elif time.monotonic() - running[prompt_id][1] > timeout:
+                try:
+                    client.cancel(prompt_id)
+                except ComfyUIError:
+                    pass
+                job, queued_at = running.pop(prompt_id)
+                finish(job, queued_at, error=f"timed out after {timeout:.0f}s")
+
+    try:
+        while pending or running:
+            while pending and len(running) < in_flight:
+                job = pending.pop(0)
+                job["attempts"] += 1
+                queued_at = time.monotonic()
+                try:
+                    prompt = copy.deepcopy(job["prompt"])
+                    for (node_id, name), path in job["inputs"].items():
+                        if path not in uploaded:
+                            uploaded[path] = client.upload_image(path, path.name)
+                        prompt[node_id]["inputs"][name] = uploaded[path]
+                    running[client.queue_prompt(prompt)] = (job, queued_at)
+                    job["queued_epoch"] = time.time()
+                except ComfyUIError as e:
+                    job["retryable"] = e.retryable
+                    finish(job, queued_at, error=str(e))
+                    if e.retryable:
+                        time.sleep(1)
+                    continue
+
+            if not running:
+                continue
+            if socket_ is None:
+                try:
+                    socket_ = client.websocket()
+                except (OSError, ConnectionError):
+                    # Completion still arrives through history polls
+                    time.sleep(POLL_SECONDS)
+                    poll()
+                    continue
+                # Prompts may have finished before the socket connected
+                poll()
+            try:
+                message = socket_.recv(POLL_SECONDS)
+            except (OSError, ConnectionError):
+                socket_.close()
+                socket_ = None
+                continue
+            if message is None or time.monotonic() - last_poll > POLL_SECONDS:
+                # Also checks timeouts while other prompts keep the socket busy
+                poll()
+            if message is None:
+                continue
+            event = json.loads(message)
+            data = event.get("data", {})
+            prompt_id = data.get("prompt_id")
+            if prompt_id not in running:
+                continue
+            # ComfyUI sends execution_success/error/interrupted from inside
+            # execute() and writes the history entry afterwards, then sends
+            # executing with node None: until the entry exists, wait for that
+            # (or the next poll) instead of treating the prompt as lost
+            if event.get("type") == "executing" and data.get("node") is None \
+                    or event.get("type") in ("execution_success", "execution_error", "execution_interrupted"):
+                entry = client.history(prompt_id)
+                if entry is not None:
+                    collect(prompt_id, entry)
+    finally:
+        if socket_ is not None:
+            socket_.close()
+
+    wall = time.monotonic() - started
+    done = [result for result in results if result["status"] == "ok"]
+    return {
+        "server": client.url,
+        "jobs": len(results),
+        "succeeded": len(done),
+        "failed": len(results) - len(done),
+        "retries": sum(result["attempts"] - 1 for result in results),
+        "wall_seconds": round(wall, 2),
+        "jobs_per_hour": round(len(done) * 3600 / wall, 2) if wall > 0 else 0,
+        "mean_job_seconds": round(sum(result["seconds"] for result in done) / len(done), 2) if done else None,
+        "in_flight": in_flight,
+        "results": results,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render input sets through a running ComfyUI")
+    parser.add_argument("inputs", type=Path, help="Directory of input images named <set>_<role>.<ext>")
+    parser.add_argument("workflows", nargs="*", type=Path, default=[WORKFLOW_FILE],
+                        help="UI workflows or API prompts (default: the archviz workflow)")
+    parser.add_argument("--server", default=COMFYUI_URL, help=f"ComfyUI URL (default: {COMFYUI_URL})")
+    parser.add_argument("--out", type=Path, default=Path("renders"), help="Output directory (default: ./renders)")
+    parser.add_argument("--template", default=TEMPLATE_SET,
+                        help=f"Set name the workflow's LoadImage nodes use (default: {TEMPLATE_SET})")
+    parser.add_argument("--profile", choices=sorted(PATCH_PROFILES),
+                        help="Patch UI workflows for a hardware profile first")
+    parser.add_argument("--in-flight", type=int, default=DEFAULT_IN_FLIGHT,
+                        help=f"Prompts queued at once (default: {DEFAULT_IN_FLIGHT})")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                        help=f"Resubmits of a failed job (default: {DEFAULT_RETRIES})")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help=f"Seconds before a queued job is cancelled and retried (default: {DEFAULT_TIMEOUT})")
+    args = parser.parse_args(argv)
+
+    for path in [args.inputs] + args.workflows:
+        if not path.exists():
+            print(f"Error: File not found: {path}")
+            return 1
+    try:
+        prompts = [(path.stem, load_prompt(path, args.profile)) for path in args.workflows]
+    except WorkflowError as e:
+        print(f"Error: {e}")
+        return 1
+
+    roles = set().union(*(input_roles(prompt, args.template) for _, prompt in prompts))
+    if not roles:
+        print(f"Error: no LoadImage in the workflow names a {args.template}_<role> image")
+        return 1
+    sets = find_input_sets(args.inputs, roles)
+    jobs, skipped = build_jobs(prompts, sets, args.template)
+    for set_name, missing in skipped:
+        print(f"Warning: skipping {set_name}: no {', '.join(missing)} image")
+    if not jobs:
+        print(f"Error: no complete input set in {args.inputs} (roles: {', '.join(sorted(roles))})")
+        return 1
+
+    print(f"{len(jobs)} jobs ({len(sets)} input sets x {len(prompts)} workflows) on {args.server}, "
+          f"{max(1, args.in_flight)} in flight")
+    report = run_batch(ComfyClient(args.server), jobs, args.out, max(1, args.in_flight), args.retries, args.timeout)
+
+    args.out.mkdir(parents=True, exist_ok=True)
+    (args.out / "batch_report.json").write_text(json.dumps(report, indent=2))
+    mean = f", {report['mean_job_seconds']:.1f}s per job" if report["mean_job_seconds"] else ""
+    print(f"{report['succeeded']}/{report['jobs']} jobs in {report['wall_seconds']:.0f}s: "
+          f"{report['jobs_per_hour']:.1f} jobs/hour{mean}, {report['retries']} retries")
+    print(f"Report: {args.out / 'batch_report.json'}")
+    return 0 if report["failed"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
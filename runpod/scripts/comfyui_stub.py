@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Stand-in for ComfyUI's HTTP and websocket API, without a GPU.
+
+Implements the endpoints batch_render.py uses (/upload/image, /prompt,
+/queue, /interrupt, /free, /history, /view, /system_stats, /ws) with one
+worker executing prompts in queue order. "Executing" a prompt sleeps and
+writes a 1x1 PNG per latent batch item and Image Save/SaveImage node.
+Models load on the first prompt and stay loaded until /free, so cold and
+warm runs differ like on a pod. Events follow ComfyUI's order: the
+execution_success/error/interrupted broadcast comes before the history
+entry is written, and executing with node None after it.
+
+Usage:
+    python3 comfyui_stub.py --port 8188
+    python3 comfyui_stub.py --port 8188 --run-seconds 2 --load-seconds 10 --fail-every 3
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import queue
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Node types whose images the stub "saves"
+SAVE_NODES = {"Image Save", "SaveImage"}
+
+def tiny_png() -> bytes:
+    """A valid 1x1 grey PNG."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return len(data).to_bytes(4, "big") + kind + data + zlib.crc32(kind + data).to_bytes(4, "big")
+    header = (1).to_bytes(4, "big") * 2 + bytes([8, 0, 0, 0, 0])
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"\x00\x80")) + chunk(b"IEND", b"")
+
+class StubComfyUI:
+    """Queue, history and files of the stub server."""
+
+    def __init__(self, run_seconds: float, load_seconds: float, fail_every: int):
+        self.run_seconds = run_seconds
+        self.load_seconds = load_seconds
+        self.fail_every = fail_every
+        self.files = {}  # (type, subfolder, name) -> bytes
+        self.history = {}
+        self.queue = queue.Queue()
+        self.pending = []  # prompt ids queued, in order
+        self.running = None
+        self.deleted = set()
+        self.interrupted = threading.Event()
+        self.models_loaded = False
+        self.executed = 0
+        self.counter = 0
+        self.sockets = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    def broadcast(self, kind: str, data: dict):
+        message = json.dumps({"type": kind, "data": data}).encode()
+        frame = bytes([0x81])
+        if len(message) < 126:
+            frame += bytes([len(message)])
+        elif len(message) < 1 << 16:
+            frame += bytes([126]) + len(message).to_bytes(2, "big")
+        else:
+            frame += bytes([127]) + len(message).to_bytes(8, "big")
+        with self.lock:
+            for sock in list(self.sockets):
+                try:
+                    sock.sendall(frame + message)
+                except OSError:
+                    self.sockets.remove(sock)
+
+    def queue_status(self):
+        self.broadcast("status", {"status": {"exec_info": {"queue_remaining": len(self.pending) + bool(self.running)}}})
+
+    def submit(self, prompt: dict) -> str:
+        prompt_id = str(uuid.uuid4())
+        with self.lock:
+            self.counter += 1
+            number = self.counter
+            self.pending.append(prompt_id)
+        self.queue.put((number, prompt_id, prompt))
+        self.queue_status()
+        return prompt_id
+
+    def worker(self):
+        while True:
+            number, prompt_id, prompt = self.queue.get()
+            with self.lock:
+                self.pending.remove(prompt_id)
+                if prompt_id in self.deleted:
+                    continue
+                self.running = (number, prompt_id)
+            self.interrupted.clear()
+            self.broadcast("execution_start", {"prompt_id": prompt_id})
+            seconds = self.run_seconds
+            if not self.models_loaded:
+                seconds += self.load_seconds
+                self.models_loaded = True
+            for node_id in prompt:
+                self.broadcast("executing", {"node": node_id, "prompt_id": prompt_id})
+            self.executed += 1
+            messages = [["execution_start", {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)}]]
+            outputs, status = {}, "success"
+            if self.interrupted.wait(seconds):
+                status = "error"
+                messages.append(["execution_interrupted", {"prompt_id": prompt_id}])
+                self.broadcast("execution_interrupted", {"prompt_id": prompt_id})
+            elif self.fail_every and self.executed % self.fail_every == 0:
+                status = "error"
+                error = {"prompt_id": prompt_id, "node_id": next(iter(prompt), None),
+                         "exception_message": "stub: injected failure", "exception_type": "RuntimeError"}
+                messages.append(["execution_error", error])
+                self.broadcast("execution_error", error)
+            else:
+                # One image per latent in the batch
+                batch = max([entry["inputs"]["batch_size"] for entry in prompt.values()
+                             if isinstance(entry.get("inputs", {}).get("batch_size"), int)] or [1])
+                for node_id, entry in prompt.items():
+                    if entry.get("class_type") not in SAVE_NODES:
+                        continue
+                    prefix = re.sub(r"[^A-Za-z0-9_.-]", "_", str(entry["inputs"].get("filename_prefix", "ComfyUI")))
+                    images = []
+                    for index in range(batch):
+                        name = f"{prefix}_{number:05d}_{index:02d}_.png"
+                        self.files[("output", "", name)] = tiny_png()
+                        images.append({"filename": name, "subfolder": "", "type": "output"})
+                    outputs[node_id] = {"images": images}
+                success = {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)}
+                messages.append(["execution_success", success])
+                self.broadcast("execution_success", success)
+            with self.lock:
+                self.history[prompt_id] = {
+                    "prompt": [number, prompt_id, prompt, {}, list(outputs)],
+                    "outputs": outputs,
+                    "status": {"status_str": status, "completed": status == "success", "messages": messages},
+                }
+                self.running = None
+            self.broadcast("executing", {"node": None, "prompt_id": prompt_id})
+            self.queue_status()
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    stub = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, payload, status: int = 200, content_type: str = "application/json"):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        stub = self.stub
+        if url.path == "/ws":
+            self.upgrade()
+        elif url.path == "/system_stats":
+            self.reply({"system": {"comfyui_version": "stub"}, "devices": []})
+        elif url.path == "/queue":
+            with stub.lock:
+                running = [[*stub.running, {}, {}, []]] if stub.running else []
+                pending = [[0, prompt_id, {}, {}, []] for prompt_id in stub.pending]
+            self.reply({"queue_running": running, "queue_pending": pending})
+        elif url.path.startswith("/history/"):
+            prompt_id = url.path.rsplit("/", 1)[1]
+            with stub.lock:
+                entry = stub.history.get(prompt_id)
+            self.reply({prompt_id: entry} if entry else {})
+        elif url.path == "/view":
+            data = stub.files.get((query.get("type", "output"), query.get("subfolder", ""), query.get("filename")))
+            if data is None:
+                self.reply({"error": "not found"}, 404)
+            else:
+                self.reply(data, content_type="image/png")
+        else:
+            self.reply({"error": "not found"}, 404)
+
+    def do_POST(self):
+        stub = self.stub
+        if self.path == "/prompt":
+            payload = json.loads(self.body())
+            prompt = payload.get("prompt")
+            if not isinstance(prompt, dict) or not prompt:
+                self.reply({"error": {"type": "invalid_prompt", "message": "no prompt"}, "node_errors": {}}, 400)
+                return
+            self.reply({"prompt_id": stub.submit(prompt), "number": stub.counter, "node_errors": {}})
+        elif self.path == "/upload/image":
+            fields = self.multipart()
+            subfolder = fields.get("subfolder", (None, b""))[1].decode()
+            name, data = fields["image"]
+            stub.files[("input", subfolder, name)] = data
+            self.reply({"name": name, "subfolder": subfolder, "type": "input"})
+        elif self.path == "/queue":
+            payload = json.loads(self.body())
+            with stub.lock:
+                stub.deleted.update(payload.get("delete", []))
+            self.reply({})
+        elif self.path == "/interrupt":
+            self.body()
+            stub.interrupted.set()
+            self.reply({})
+        elif self.path == "/free":
+            payload = json.loads(self.body() or b"{}")
+            if payload.get("unload_models"):
+                stub.models_loaded = False
+            self.reply({})
+        else:
+            self.reply({"error": "not found"}, 404)
+
+    def multipart(self) -> dict:
+        """Field name -> (file name, data) of a multipart/form-data body."""
+        boundary = self.headers["Content-Type"].split("boundary=", 1)[1].encode()
+        fields = {}
+        for part in self.body().split(b"--" + boundary):
+            head, _, data = part.partition(b"\r\n\r\n")
+            match = re.search(rb'name="([^"]*)"(?:; filename="([^"]*)")?', head)
+            if match:
+                filename = match.group(2).decode() if match.group(2) else None
+                fields[match.group(1).decode()] = (filename, data[:-2] if data.endswith(b"\r\n") else data)
+        return fields
+
+    def upgrade(self):
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        with self.stub.lock:
+            self.stub.sockets.append(self.connection)
+        self.stub.queue_status()
+        # Hold the connection until the client goes away
+        try:
+            while self.connection.recv(4096):
+                pass
+        except OSError:
+            pass
+        with self.stub.lock:
+            if self.connection in self.stub.sockets:
+                self.stub.sockets.remove(self.connection)
+        self.close_connection = True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a stand-in for ComfyUI's API")
+    parser.add_argument("--listen", default="127.0.0.1", help="Address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8188, help="Port (default: 8188)")
+    parser.add_argument("--run-seconds", type=float, default=1.0, help="Seconds per prompt (default: 1)")
+    parser.add_argument("--load-seconds", type=float, default=0.0,
+                        help="Extra seconds for the first prompt after start or /free (default: 0)")
+    parser.add_argument("--boot-seconds", type=float, default=0.0,
+                        help="Seconds before the server starts listening (default: 0)")
+    parser.add_argument("--fail-every", type=int, default=0, metavar="N",
+                        help="Fail every Nth prompt with an execution error (default: never)")
+    args = parser.parse_args(argv)
+
+    time.sleep(args.boot_seconds)
+    Handler.stub = StubComfyUI(args.run_seconds, args.load_seconds, args.fail_every)
+    server = ThreadingHTTPServer((args.listen, args.port), Handler)
+    server.daemon_threads = True
+    print(f"ComfyUI stub on http://{args.listen}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the serverless platform's job API.
+
+Clients submit jobs, a worker (serverless_handler.py) takes and completes
+them, the same way RunPod's queue hands jobs to a serverless worker:
+
+    POST /run                       {"input": {...}} -> {"id", "status"}
+    GET  /status/<id>               -> {"id", "status", "output" | "error",
+                                        "delayTime", "executionTime"} (ms)
+    GET  /job-take/<worker>         -> {"id", "input"}, or 204 when empty
+    POST /job-done/<worker>?id=<id> {"output": ...} or {"error": ...}
+
+Usage:
+    python3 job_api_stub.py --port 8000
+    curl -s -X POST localhost:8000/run -d @job.json
+    curl -s localhost:8000/status/<id>
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class JobQueue:
+    """Jobs in submission order and their results."""
+
+    def __init__(self):
+        self.jobs = {}
+        self.queued = []
+        self.lock = threading.Lock()
+
+    def submit(self, job_input: dict) -> dict:
+        job = {"id": uuid.uuid4().hex, "input": job_input, "status": "IN_QUEUE", "submitted": time.time()}
+        with self.lock:
+            self.jobs[job["id"]] = job
+            self.queued.append(job["id"])
+        return {"id": job["id"], "status": job["status"]}
+
+    def take(self, worker: str):
+        with self.lock:
+            if not self.queued:
+                return None
+            job = self.jobs[self.queued.pop(0)]
+            job.update(status="IN_PROGRESS", worker=worker, started=time.time())
+        return {"id": job["id"], "input": job["input"]}
+
+    def done(self, job_id: str, result: dict) -> bool:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["status"] != "IN_PROGRESS":
+                return False
+            job.update(status="FAILED" if "error" in result else "COMPLETED", finished=time.time(), **result)
+        return True
+
+    def status(self, job_id: str):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            report = {key: job[key] for key in ("id", "status", "output", "error") if key in job}
+            if "started" in job:
+                report["delayTime"] = int((job["started"] - job["submitted"]) * 1000)
+            if "finished" in job:
+                report["executionTime"] = int((job["finished"] - job["started"]) * 1000)
+        return report
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    jobs = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, payload, status: int = 200):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts[0] == "job-take" and len(parts) == 2:
+            job = self.jobs.take(parts[1])
+            self.reply(job, 200 if job else 204)
+        elif parts[0] == "status" and len(parts) == 2:
+            status = self.jobs.status(parts[1])
+            self.reply(status or {"error": "no such job"}, 200 if status else 404)
+        else:
+            self.reply({"error": "not found"}, 404)
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self.reply({"error": "invalid JSON"}, 400)
+            return
+        if parts == ["run"]:
+            if not isinstance(payload.get("input"), dict):
+                self.reply({"error": "body must be {\"input\": {...}}"}, 400)
+                return
+            self.reply(self.jobs.submit(payload["input"]))
+        elif parts[0] == "job-done" and len(parts) == 2:
+            job_id = dict(urllib.parse.parse_qsl(url.query)).get("id", "")
+            result = {key: payload[key] for key in ("output", "error") if key in payload}
+            if self.jobs.done(job_id, result):
+                self.reply({})
+            else:
+                self.reply({"error": f"job {job_id} is not in progress"}, 404)
+        else:
+            self.reply({"error": "not found"}, 404)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the serverless job API")
+    parser.add_argument("--listen", default="127.0.0.1", help="Address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="Port (default: 8000)")
+    args = parser.parse_args(argv)
+
+    Handler.jobs = JobQueue()
+    server = ThreadingHTTPServer((args.listen, args.port), Handler)
+    server.daemon_threads = True
+    print(f"Job API stub on http://{args.listen}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
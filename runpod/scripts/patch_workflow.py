@@ -1,99 +1,1048 @@
 #!/usr/bin/env python3
 """
 Patch ComfyUI workflow for CUDA/RunPod deployment.
-Converts MPS device references to CUDA and optimizes precision settings.
+Converts MPS device references to CUDA and optimizes precision settings;
+hardware profiles (rtx4090, l40, a100-80g, apple-m-64g) also tune resize
+devices, upscale tiles and model residency for the pod.
+
+Also compiles UI-format workflows (as saved from the browser) to the API
+format accepted by ComfyUI's /prompt endpoint, for headless runs.
 """
 
+import argparse
+import ast
+import copy
 import json
+import math
+import operator
 import sys
+from collections import namedtuple
 from pathlib import Path
 
+# Node types that load model files: widget index -> directory of the file,
+# relative to the volume root (layout created by setup.py)
+MODEL_LOADERS = {
+    'CheckpointLoaderSimple': {0: 'models/checkpoints'},
+    'UnetLoaderGGUF': {0: 'models/unet'},
+    'UNETLoader': {0: 'models/unet'},
+    'DualCLIPLoaderGGUF': {0: 'models/clip', 1: 'models/clip'},
+    'DualCLIPLoader': {0: 'models/clip', 1: 'models/clip'},
+    'CLIPLoader': {0: 'models/clip'},
+    'VAELoader': {0: 'models/vae'},
+    'ControlNetLoader': {0: 'models/controlnet'},
+    'DiffControlNetLoader': {0: 'models/controlnet'},
+    'CLIPVisionLoader': {0: 'models/clip_vision'},
+    'IPAdapterModelLoader': {0: 'models/ipadapter'},
+    'UpscaleModelLoader': {0: 'models/upscale_models'},
+    'LoraLoader': {0: 'models/loras'},
+    'DownloadAndLoadSAM2Model': {0: 'models/sam2'},
+    'DepthAnythingPreprocessor': {0: 'models/depth'},
+    'DepthAnythingV2Preprocessor': {0: 'models/depth'},
+    # Widget holds a repo id (microsoft/Florence-2-large); the model is a directory
+    'DownloadAndLoadFlorence2Model': {0: 'LLM'},
+}
+
+# Node modes that keep a node from executing
+MODE_MUTED = 2
+MODE_BYPASSED = 4
+
 
-def patch_workflow(input_path: str, output_path: str) -> dict:
+def model_references(workflow: dict) -> list:
     """
-    Patch workflow JSON for CUDA deployment.
+    List the model files a UI-format workflow loads, in execution order.
+
+    A loader runs when its first consumer needs it, so references are
+    ordered by the earliest execution order ('order') among the nodes fed
+    by the loader. Muted and bypassed loaders are skipped; a file loaded by
+    several nodes is listed once.
 
     Args:
-        input_path: Path to input workflow JSON
-        output_path: Path to output patched workflow JSON
+        workflow: Workflow in UI format (with 'nodes' and 'links')
 
     Returns:
-        Dictionary with counts of patches applied
+        List of dicts with 'path' (relative to the volume root), 'node',
+        'type' and 'order'
     """
-    with open(input_path) as f:
-        workflow = json.load(f)
+    nodes = {node['id']: node for node in workflow['nodes']}
+    consumers = {}
+    for link in workflow.get('links', []):
+        _, src_node, _, dst_node, _, _ = link
+        if dst_node in nodes:
+            consumers.setdefault(src_node, []).append(nodes[dst_node].get('order', 0))
+
+    references = {}
+    for node in nodes.values():
+        widgets = MODEL_LOADERS.get(node['type'])
+        if not widgets or node.get('mode') in (MODE_MUTED, MODE_BYPASSED):
+            continue
+        values = node.get('widgets_values') or []
+        order = min(consumers.get(node['id'], []), default=node.get('order', 0))
+        for index, folder in widgets.items():
+            if index >= len(values) or not isinstance(values[index], str) or values[index] == 'None':
+                continue
+            path = f"{folder}/{Path(values[index]).name}"
+            if path not in references or order < references[path]['order']:
+                references[path] = {'path': path, 'node': node['id'], 'type': node['type'], 'order': order}
+
+    return sorted(references.values(), key=lambda ref: ref['order'])
+
+
+# Widget names per node type, in widgets_values order. None marks values the
+# frontend stores but does not send (control_after_generate, upload buttons,
+# display state). Used when no /object_info from a running ComfyUI is given.
+NODE_WIDGETS = {
+    # ComfyUI core
+    'BasicGuider': [],
+    'BasicScheduler': ['scheduler', 'steps', 'denoise'],
+    'CheckpointLoaderSimple': ['ckpt_name'],
+    'CLIPSetLastLayer': ['stop_at_clip_layer'],
+    'CLIPTextEncode': ['text', None],
+    'CLIPVisionLoader': ['clip_name'],
+    'ControlNetApply': ['strength'],
+    'ControlNetLoader': ['control_net_name'],
+    'DiffControlNetLoader': ['control_net_name'],
+    'EmptyImage': ['width', 'height', 'batch_size', 'color'],
+    'EmptyLatentImage': ['width', 'height', 'batch_size'],
+    'FluxGuidance': ['guidance'],
+    'GrowMask': ['expand', 'tapered_corners'],
+    'ImageBatch': [],
+    'ImageCompositeMasked': ['x', 'y', 'resize_source'],
+    'InpaintModelConditioning': ['noise_mask'],
+    'KSampler': ['seed', None, 'steps', 'cfg', 'sampler_name', 'scheduler', 'denoise'],
+    'KSamplerSelect': ['sampler_name'],
+    'LoadImage': ['image', None],
+    'MaskToImage': [],
+    'ModelSamplingFlux': ['max_shift', 'base_shift', 'width', 'height'],
+    'PreviewImage': [],
+    'RandomNoise': ['noise_seed', None],
+    'SamplerCustomAdvanced': [],
+    'UNETLoader': ['unet_name', 'weight_dtype'],
+    'UpscaleModelLoader': ['model_name'],
+    'VAEDecode': [],
+    'VAEEncode': [],
+    'VAELoader': ['vae_name'],
+    # ComfyUI-GGUF
+    'DualCLIPLoaderGGUF': ['clip_name1', 'clip_name2', 'type'],
+    'UnetLoaderGGUF': ['unet_name'],
+    # ComfyUI_IPAdapter_plus
+    'IPAdapterAdvanced': ['weight', 'weight_type', 'combine_embeds', 'start_at', 'end_at', 'embeds_scaling'],
+    'IPAdapterModelLoader': ['ipadapter_file'],
+    'PrepImageForClipVision': ['interpolation', 'crop_position', 'sharpening'],
+    # comfyui_controlnet_aux
+    'AV_ControlNetPreprocessor': ['preprocessor', 'sd_version', 'resolution', 'preprocessor_override'],
+    'CannyEdgePreprocessor': ['low_threshold', 'high_threshold', 'resolution'],
+    'DepthAnythingPreprocessor': ['ckpt_name', 'resolution'],
+    'DepthAnythingV2Preprocessor': ['ckpt_name', 'resolution'],
+    'HEDPreprocessor': ['safe', 'resolution'],
+    'OpenposePreprocessor': ['detect_hand', 'detect_body', 'detect_face', 'resolution', 'scale_stick_for_xinsr_cn'],
+    'Zoe-DepthMapPreprocessor': ['resolution'],
+    # ComfyUI-Florence2
+    'DownloadAndLoadFlorence2Model': ['model', 'precision', 'attention', 'convert_to_safetensors'],
+    'Florence2Run': [
+        'text_input', 'task', 'fill_mask', 'keep_model_loaded', 'max_new_tokens',
+        'num_beams', 'do_sample', 'output_mask_select', 'seed', None, None,
+    ],
+    # ComfyUI-segment-anything-2
+    'DownloadAndLoadSAM2Model': ['model', 'segmentor', 'device', 'precision'],
+    'Florence2toCoordinates': ['index', 'batch'],
+    'Sam2AutoSegmentation': [
+        'points_per_side', 'points_per_batch', 'pred_iou_thresh', 'stability_score_thresh',
+        'stability_score_offset', 'mask_threshold', 'crop_n_layers', 'box_nms_thresh',
+        'crop_nms_thresh', 'crop_overlap_ratio', 'crop_n_points_downscale_factor',
+        'min_mask_region_area', 'use_m2m', 'keep_model_loaded',
+    ],
+    'Sam2Segmentation': ['keep_model_loaded', 'individual_objects'],
+    # ComfyUI-KJNodes
+    'ColorMatch': ['method', 'strength'],
+    'ImageAndMaskPreview': ['mask_opacity', 'mask_color', 'pass_through'],
+    'ImageResizeKJv2': [
+        'width', 'height', 'upscale_method', 'keep_proportion', 'pad_color',
+        'crop_position', 'divisible_by', 'device',
+    ],
+    'INTConstant': ['value'],
+    # ComfyUI_essentials
+    'ImageResize+': ['width', 'height', 'interpolation', 'method', 'condition', 'multiple_of'],
+    'MaskBlur+': ['amount', 'device'],
+    'MaskFromRGBCMYBW+': ['threshold_r', 'threshold_g', 'threshold_b'],
+    # masquerade-nodes-comfyui
+    'Change Channel Count': ['kind'],
+    'Combine Masks': ['op', 'clamp_result', 'round_result'],
+    'Cut By Mask': ['force_resize_width', 'force_resize_height'],
+    'Image To Mask': ['method'],
+    'Mask To Region': [
+        'padding', 'constraints', 'constraint_x', 'constraint_y',
+        'min_width', 'min_height', 'batch_behavior',
+    ],
+    'Paste By Mask': ['resize_behavior'],
+    'Separate Mask Components': [],
+    # was-node-suite-comfyui
+    'Image Edge Detection Filter': ['mode'],
+    'Image Overlay': [
+        'overlay_resize', 'resize_method', 'rescale_factor', 'width', 'height',
+        'x_offset', 'y_offset', 'rotation', 'opacity',
+    ],
+    'Image Save': [
+        'output_path', 'filename_prefix', 'filename_delimiter', 'filename_number_padding',
+        'filename_number_start', 'extension', 'dpi', 'quality', 'optimize_image',
+        'lossless_webp', 'overwrite_mode', 'show_history', 'show_history_by_prefix',
+        'embed_workflow', 'show_previews',
+    ],
+    'Images to RGB': [],
+    'Text Concatenate': ['delimiter', 'clean_whitespace'],
+    'Text Multiline': ['text', None],
+    'Text to String': [],
+    # ComfyUI_Comfyroll_CustomNodes
+    'CR Conditioning Input Switch': ['Input'],
+    'CR Image Input Switch': ['Input'],
+    'CR Latent Input Switch': ['Input'],
+    'CR Model Input Switch': ['Input'],
+    'CR String To Combo': [],
+    'CR Text Concatenate': ['separator'],
+    # rgthree-comfy
+    'Image Comparer (rgthree)': [None],
+    'KSampler Config (rgthree)': ['steps_total', 'refiner_step', 'cfg', 'sampler_name', 'scheduler'],
+    'Lora Loader Stack (rgthree)': [
+        'lora_01', 'strength_01', 'lora_02', 'strength_02',
+        'lora_03', 'strength_03', 'lora_04', 'strength_04',
+    ],
+    'Power Prompt (rgthree)': ['prompt', 'insert_lora', 'insert_embedding'],
+    'Seed (rgthree)': ['seed', None, None, None],
+    # ComfyUI-Custom-Scripts
+    'MathExpression|pysssss': ['expression', None],
+    'ShowText|pysssss': [None],
+    # ComfyUI-Easy-Use
+    'easy float': ['value'],
+    'easy imageCropFromMask': ['image_crop_multi', 'mask_crop_multi', 'bbox_smooth_alpha'],
+    'easy imageDetailTransfer': ['mode', 'blur', 'blend_factor', 'image_output', 'save_prefix'],
+    'easy imageRemBg': [
+        'rem_mode', 'image_output', 'save_prefix', 'torchscript_jit',
+        'add_background', 'refine_foreground',
+    ],
+    'easy int': ['value'],
+    # ComfyUI-Logic
+    'Compare-🔬': ['comparison'],
+    'Float-🔬': ['value'],
+    'If ANY return A else B-🔬': [],
+    'Int-🔬': ['value'],
+    # efficiency-nodes-comfyui
+    'Apply ControlNet Stack': [],
+    'Control Net Stacker': ['strength', 'start_percent', 'end_percent'],
+    # Others
+    'ColorCorrect': ['temperature', 'hue', 'brightness', 'contrast', 'saturation', 'gamma'],
+    'Get Image Size': [],
+    'Image Aspect Ratio': [],
+    'Image Filter': [
+        'timeout', 'ontimeout', 'tip', 'extra1', 'extra2', 'extra3',
+        'pick_list_start', 'pick_list', 'video_frames', 'uid',
+    ],
+    'JWStringConcat': ['a', 'b'],
+    'SDXLAspectRatioSelector': ['aspect_ratio'],
+    'UltimateSDUpscale': [
+        'upscale_by', 'seed', None, 'steps', 'cfg', 'sampler_name', 'scheduler',
+        'denoise', 'mode_type', 'tile_width', 'tile_height', 'mask_blur', 'tile_padding',
+        'seam_fix_mode', 'seam_fix_denoise', 'seam_fix_width', 'seam_fix_mask_blur',
+        'seam_fix_padding', 'force_uniform_tiles', 'tiled_decode',
+    ],
+}
+
+# Nodes that exist only in the browser: never sent to the server
+VIRTUAL_NODES = {
+    'Reroute', 'PrimitiveNode', 'Note', 'MarkdownNote',
+    'Label (rgthree)', 'Fast Groups Bypasser (rgthree)', 'Fast Groups Muter (rgthree)',
+}
+
+# Widget types in /object_info; anything else is a connection type
+WIDGET_TYPES = {'INT', 'FLOAT', 'STRING', 'BOOLEAN', 'COMBO'}
+
+# INT widgets the frontend follows with a control_after_generate value
+SEED_WIDGETS = {'seed', 'noise_seed'}
+
+Link = namedtuple('Link', 'id src src_slot dst dst_slot type')
+
+
+class WorkflowError(ValueError):
+    """A UI-format workflow that cannot be compiled."""
+
+
+def widgets_from_object_info(object_info: dict) -> dict:
+    """
+    Widget names per node type from a running ComfyUI's /object_info.
+
+    Widgets are the inputs whose type is a primitive or a list of choices,
+    in declaration order (required, then optional); seed widgets get the
+    frontend's control_after_generate slot after them.
+    """
+    widgets = {}
+    for node_type, info in object_info.items():
+        names = []
+        order = info.get('input_order')
+        for section in ('required', 'optional'):
+            inputs = info.get('input', {}).get(section, {})
+            for name in (order or {}).get(section, inputs):
+                spec = inputs.get(name)
+                if not spec:
+                    continue
+                kind = spec[0]
+                options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+                if isinstance(kind, list) or kind in WIDGET_TYPES:
+                    names.append(name)
+                    if kind == 'INT' and (name in SEED_WIDGETS or options.get('control_after_generate')):
+                        names.append(None)
+        widgets[node_type] = names
+    return widgets
+
+
+class WorkflowGraph:
+    """
+    Indexed view of a UI-format workflow.
+
+    Holds the node id map, the link table and group membership, and
+    resolves inputs through Reroute nodes and bypassed nodes to the node
+    that actually produces the value.
+    """
+
+    def __init__(self, workflow: dict):
+        if 'nodes' not in workflow or 'links' not in workflow:
+            raise WorkflowError('not a UI-format workflow (no nodes/links)')
+        self.workflow = workflow
+        self.nodes = {node['id']: node for node in workflow['nodes']}
+        self.links = {link[0]: Link(*link[:6]) for link in workflow['links'] if link}
+        self.groups = workflow.get('groups', [])
+
+    def group_titles(self, node_id: int) -> list:
+        """Titles of the groups whose bounding box contains the node's position."""
+        pos = self.nodes[node_id]['pos']
+        # Older frontends saved positions as {"0": x, "1": y}
+        x, y = (pos['0'], pos['1']) if isinstance(pos, dict) else pos[:2]
+        titles = []
+        for group in self.groups:
+            gx, gy, width, height = group['bounding']
+            if gx <= x < gx + width and gy <= y < gy + height:
+                titles.append(group['title'])
+        return titles
+
+    def input_link(self, node_id: int, slot: int):
+        """The link feeding a node's input slot, or None."""
+        inputs = self.nodes[node_id].get('inputs') or []
+        if slot >= len(inputs) or inputs[slot].get('link') is None:
+            return None
+        return self.links.get(inputs[slot]['link'])
+
+    def resolve(self, link: Link):
+        """
+        Follow a link back to the node that produces its value.
+
+        Reroutes pass their single input through. A bypassed node passes
+        through the first connected input of the same type as the output,
+        trying the input at the output's index first, like the frontend.
+
+        Returns:
+            (node_id, output_slot), or None if the value comes from nowhere
+            (an unconnected reroute or bypassed node, or a muted node)
+        """
+        seen = set()
+        while link is not None:
+            if link.id in seen:
+                raise WorkflowError(f'link cycle through node {link.src}')
+            seen.add(link.id)
+            source = self.nodes.get(link.src)
+            if source is None:
+                return None
+            if source['type'] == 'Reroute':
+                link = self.input_link(source['id'], 0)
+            elif source.get('mode') == MODE_BYPASSED:
+                link = self._passthrough(source, link.src_slot)
+            elif source.get('mode') == MODE_MUTED:
+                return None
+            else:
+                return source['id'], link.src_slot
+        return None
+
+    def _passthrough(self, node: dict, output_slot: int):
+        outputs = node.get('outputs') or []
+        output_type = outputs[output_slot]['type'] if output_slot < len(outputs) else None
+        inputs = node.get('inputs') or []
+        for slot in [output_slot] + list(range(len(inputs))):
+            if slot < len(inputs) and inputs[slot].get('type') in (output_type, '*'):
+                link = self.input_link(node['id'], slot)
+                if link is not None:
+                    return link
+        return None
+
+    def executable_nodes(self) -> list:
+        """Nodes the server runs: not virtual, not muted, not bypassed."""
+        return [
+            node for node in self.nodes.values()
+            if node['type'] not in VIRTUAL_NODES and node.get('mode', 0) not in (MODE_MUTED, MODE_BYPASSED)
+        ]
+
+
+def compile_workflow(workflow: dict, object_info: dict = None) -> dict:
+    """
+    Compile a UI-format workflow to the API format for /prompt.
+
+    Every executable node becomes {'class_type', 'inputs', '_meta'}; widget
+    values are named per node type, widgets converted to inputs take their
+    linked value, and links are resolved through reroutes, bypassed nodes
+    and PrimitiveNode values.
+
+    Args:
+        workflow: Workflow in UI format
+        object_info: Optional /object_info from the target ComfyUI; widget
+            names then come from the server instead of NODE_WIDGETS
+
+    Returns:
+        API-format workflow: {node_id: {'class_type', 'inputs', '_meta'}}
+
+    Raises:
+        WorkflowError: If a node type has widgets but no known widget names
+    """
+    graph = WorkflowGraph(workflow)
+    widget_names = dict(NODE_WIDGETS)
+    if object_info:
+        widget_names.update(widgets_from_object_info(object_info))
+
+    nodes = graph.executable_nodes()
+    unknown = sorted({
+        node['type'] for node in nodes
+        if node['type'] not in widget_names and isinstance(node.get('widgets_values'), list) and node['widgets_values']
+    })
+    if unknown:
+        raise WorkflowError(f"no widget names for node types: {', '.join(unknown)}")
+
+    prompt = {}
+    for node in sorted(nodes, key=lambda node: node.get('order', 0)):
+        inputs = {}
+        values = node.get('widgets_values')
+        if isinstance(values, dict):
+            # Some custom nodes save their widgets by name
+            inputs.update(values)
+        elif values:
+            for name, value in zip(widget_names.get(node['type'], []), values):
+                if name is not None:
+                    inputs[name] = value
+
+        for slot, node_input in enumerate(node.get('inputs') or []):
+            name = node_input['name']
+            link = graph.input_link(node['id'], slot)
+            source = graph.resolve(link) if link else None
+            if source is None:
+                if link is not None:
+                    inputs.pop(name, None)
+                continue
+            source_node = graph.nodes[source[0]]
+            if source_node['type'] == 'PrimitiveNode':
+                inputs[name] = (source_node.get('widgets_values') or [None])[0]
+            else:
+                inputs[name] = [str(source[0]), source[1]]
+
+        prompt[str(node['id'])] = {
+            'class_type': node['type'],
+            'inputs': inputs,
+            '_meta': {'title': node.get('title') or node['type']},
+        }
+
+    # Drop connections to nodes that were not emitted (e.g. virtual nodes
+    # with outputs); the server would reject them
+    for entry in prompt.values():
+        for name, value in list(entry['inputs'].items()):
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and value[0] not in prompt:
+                del entry['inputs'][name]
+
+    return prompt
+
+
+# Node types whose results production runs keep
+OUTPUT_NODES = {'Image Save'}
+
+
+def links_of(entry: dict) -> list:
+    """Ids of the nodes an API-format node takes inputs from."""
+    return [
+        value[0] for value in entry['inputs'].values()
+        if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+    ]
+
+
+def loader_models(entry: dict) -> list:
+    """Model files an API-format loader node names."""
+    widgets = NODE_WIDGETS.get(entry['class_type'], [])
+    models = []
+    for index in MODEL_LOADERS.get(entry['class_type'], {}):
+        value = entry['inputs'].get(widgets[index]) if index < len(widgets) else None
+        if isinstance(value, str) and value != 'None':
+            models.append(value)
+    return models
+
+
+def eliminate_dead_nodes(prompt: dict, output_types: set = OUTPUT_NODES) -> dict:
+    """
+    Keep only the nodes on some path to an output node.
+
+    Args:
+        prompt: API-format workflow
+        output_types: Node types whose results are wanted
+
+    Returns:
+        The pruned API-format workflow
+
+    Raises:
+        WorkflowError: If there is no output node left
+    """
+    pending = [node_id for node_id, entry in prompt.items() if entry['class_type'] in output_types]
+    if not pending:
+        raise WorkflowError(f"no enabled output node ({', '.join(sorted(output_types))})")
+    live = set()
+    while pending:
+        node_id = pending.pop()
+        if node_id in live or node_id not in prompt:
+            continue
+        live.add(node_id)
+        pending.extend(links_of(prompt[node_id]))
+    return {node_id: entry for node_id, entry in prompt.items() if node_id in live}
+
+
+def execution_order(prompt: dict, workflow: dict = None) -> list:
+    """
+    Node ids of an API workflow in the order the server executes them.
+
+    Like ComfyUI, execution starts from the sink nodes (outputs nothing
+    else consumes), taken in UI execution order ('order' in the UI
+    workflow, when given), and runs each node's inputs depth-first just
+    before it, so a loader runs right before its first consumer. Nodes
+    that feed no sink never run and are not listed.
+
+    Raises:
+        WorkflowError: If the workflow has a cycle
+    """
+    ui_order = {str(node['id']): node.get('order', 0) for node in (workflow or {}).get('nodes', [])}
+    consumed = {source for entry in prompt.values() for source in links_of(entry)}
+    sinks = sorted((node_id for node_id in prompt if node_id not in consumed),
+                   key=lambda node_id: (ui_order.get(node_id, 0), int(node_id)))
+    order = []
+    done = set()
+    visiting = set()
+
+    def visit(node_id):
+        if node_id in done:
+            return
+        if node_id in visiting:
+            raise WorkflowError(f'workflow has a cycle through node {node_id}')
+        visiting.add(node_id)
+        for source in links_of(prompt[node_id]):
+            if source in prompt:
+                visit(source)
+        visiting.discard(node_id)
+        done.add(node_id)
+        order.append(node_id)
+
+    for node_id in sinks:
+        visit(node_id)
+    return order
+
+
+# Constant nodes: output 0 is their 'value' input
+CONSTANT_NODES = {
+    'INTConstant': int,
+    'Int-🔬': int,
+    'easy int': int,
+    'Float-🔬': float,
+    'easy float': float,
+}
+
+# Input switches: output 0 is the input named by 'Input' (1 or 2)
+SWITCH_NODES = {
+    'CR Image Input Switch': ('image1', 'image2'),
+    'CR Model Input Switch': ('model1', 'model2'),
+    'CR Conditioning Input Switch': ('conditioning1', 'conditioning2'),
+    'CR Latent Input Switch': ('latent1', 'latent2'),
+}
+
+# SDXLAspectRatioSelector: aspect_ratio -> (width, height)
+SDXL_ASPECT_RATIOS = {
+    '1:1': (1024, 1024),
+    '2:3': (832, 1216),
+    '3:4': (896, 1152),
+    '5:8': (768, 1216),
+    '9:16': (768, 1344),
+    '9:19': (704, 1472),
+    '9:21': (640, 1536),
+    '3:2': (1216, 832),
+    '4:3': (1152, 896),
+    '8:5': (1216, 768),
+    '16:9': (1344, 768),
+    '19:9': (1472, 704),
+    '21:9': (1536, 640),
+}
+
+COMPARISONS = {
+    'a == b': operator.eq,
+    'a != b': operator.ne,
+    'a < b': operator.lt,
+    'a > b': operator.gt,
+    'a <= b': operator.le,
+    'a >= b': operator.ge,
+}
 
-    patches = {
-        'mps_to_cuda': 0,
-        'fp32_to_fp16': 0,
-        'eager_to_sdpa': 0,
+MATH_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+MATH_FUNCTIONS = {
+    'round': round,
+    'ceil': math.ceil,
+    'floor': math.floor,
+    'min': min,
+    'max': max,
+    'abs': abs,
+}
+
+
+def is_link(value) -> bool:
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+
+
+def evaluate_expression(expression: str, variables: dict):
+    """
+    Evaluate a MathExpression|pysssss expression over numeric variables.
+
+    Only arithmetic, the variables and round/ceil/floor/min/max/abs are
+    understood. Returns None for anything else (e.g. a.width on an image),
+    so the node is left for the server.
+    """
+    def evaluate(node):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node.value
+        if isinstance(node, ast.Name) and isinstance(variables.get(node.id), (int, float)):
+            return variables[node.id]
+        if isinstance(node, ast.BinOp) and type(node.op) in MATH_OPERATORS:
+            return MATH_OPERATORS[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in MATH_OPERATORS:
+            return MATH_OPERATORS[type(node.op)](evaluate(node.operand))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in MATH_FUNCTIONS \
+                and not node.keywords:
+            return MATH_FUNCTIONS[node.func.id](*[evaluate(arg) for arg in node.args])
+        raise ValueError(ast.dump(node))
+
+    try:
+        return evaluate(ast.parse(expression.strip(), mode='eval'))
+    except (SyntaxError, ValueError, TypeError, ZeroDivisionError, OverflowError):
+        return None
+
+
+def fold_node(entry: dict) -> dict:
+    """
+    Outputs of a node that can be computed without running it.
+
+    Returns:
+        {output_slot: value} where value is a literal or a link; empty if
+        the node's inputs are not static
+    """
+    node_type = entry['class_type']
+    inputs = entry['inputs']
+
+    if node_type in CONSTANT_NODES:
+        value = inputs.get('value')
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return {0: CONSTANT_NODES[node_type](value)}
+
+    elif node_type in SWITCH_NODES:
+        choice = inputs.get('Input')
+        if choice in (1, 2) and SWITCH_NODES[node_type][choice - 1] in inputs:
+            return {0: inputs[SWITCH_NODES[node_type][choice - 1]]}
+
+    elif node_type == 'MathExpression|pysssss':
+        variables = {name: inputs[name] for name in ('a', 'b', 'c') if name in inputs}
+        if not any(is_link(value) for value in variables.values()):
+            result = evaluate_expression(inputs.get('expression', ''), variables)
+            if isinstance(result, (int, float)):
+                return {0: int(result), 1: float(result)}
+
+    elif node_type == 'SDXLAspectRatioSelector':
+        ratio = inputs.get('aspect_ratio')
+        size = SDXL_ASPECT_RATIOS.get(ratio) if isinstance(ratio, str) else None
+        if size:
+            return {0: inputs['aspect_ratio'], 1: size[0], 2: size[1]}
+
+    elif node_type == 'Compare-🔬':
+        compare = COMPARISONS.get(inputs.get('comparison')) if isinstance(inputs.get('comparison'), str) else None
+        if compare and 'a' in inputs and 'b' in inputs and not is_link(inputs['a']) and not is_link(inputs['b']):
+            return {0: compare(inputs['a'], inputs['b'])}
+
+    elif node_type == 'If ANY return A else B-🔬':
+        condition = inputs.get('ANY')
+        branch = 'IF_TRUE' if condition else 'IF_FALSE'
+        if 'ANY' in inputs and not is_link(condition) and branch in inputs:
+            return {0: inputs[branch]}
+
+    return {}
+
+
+def fold_constants(prompt: dict) -> tuple:
+    """
+    Evaluate switches, constants and arithmetic whose inputs are static.
+
+    Consumers of a folded output get the literal value, or for a switch
+    the link it selects, so the node and the branches it did not select
+    stop being referenced; eliminate_dead_nodes then removes them. Runs
+    until nothing more folds, since folding one node can make the next
+    one static (INTConstant -> switch Input, easy float -> MathExpression).
+
+    Returns:
+        (prompt, folded): a folded copy of the API workflow and the ids of
+        the nodes that were folded
+    """
+    prompt = copy.deepcopy(prompt)
+    folded = {}
+    while True:
+        outputs = {}
+        for node_id, entry in prompt.items():
+            if node_id not in folded:
+                for slot, value in fold_node(entry).items():
+                    outputs[(node_id, slot)] = value
+        if not outputs:
+            return prompt, sorted(folded, key=int)
+
+        for node_id, _ in outputs:
+            folded[node_id] = prompt[node_id]['class_type']
+        for entry in prompt.values():
+            for name, value in entry['inputs'].items():
+                # Switch chains resolve in one pass: follow until a non-folded source
+                while is_link(value) and (value[0], value[1]) in outputs:
+                    value = copy.deepcopy(outputs[(value[0], value[1])])
+                entry['inputs'][name] = value
+
+
+def optimize_workflow(workflow: dict, object_info: dict = None, output_types: set = OUTPUT_NODES) -> tuple:
+    """
+    Compile a UI-format workflow to the smallest API workflow that
+    produces its enabled outputs.
+
+    Display-only nodes (previews, comparers, labels, notes), bypassed and
+    muted nodes and everything not feeding an output node are removed;
+    bypassed nodes are rewired to their passthrough input. Static switches,
+    constants and arithmetic are folded first, so unselected branches (and
+    the models they load) are removed too.
+
+    Returns:
+        (prompt, report): report counts the nodes removed per reason and
+        lists the model loaders that no longer run
+    """
+    graph = WorkflowGraph(workflow)
+    compiled = compile_workflow(workflow, object_info)
+    folded_prompt, folded = fold_constants(compiled)
+    prompt = eliminate_dead_nodes(folded_prompt, output_types)
+
+    def count(nodes):
+        counts = {}
+        for node_type in nodes:
+            counts[node_type] = counts.get(node_type, 0) + 1
+        return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+    virtual = [node for node in graph.nodes.values() if node['type'] in VIRTUAL_NODES]
+    disabled = [
+        node for node in graph.nodes.values()
+        if node['type'] not in VIRTUAL_NODES and node.get('mode', 0) in (MODE_MUTED, MODE_BYPASSED)
+    ]
+    unreachable = {
+        node_id: entry for node_id, entry in compiled.items()
+        if node_id not in prompt and node_id not in folded
+    }
+    loaders = [
+        {'node': int(node_id), 'type': entry['class_type'], 'models': loader_models(entry)}
+        for node_id, entry in unreachable.items() if entry['class_type'] in MODEL_LOADERS
+    ]
+    loaders += [
+        {'node': node['id'], 'type': node['type'],
+         'models': [value for index, value in enumerate(node.get('widgets_values') or [])
+                    if index in MODEL_LOADERS[node['type']] and isinstance(value, str) and value != 'None']}
+        for node in disabled if node['type'] in MODEL_LOADERS
+    ]
+
+    report = {
+        'nodes': len(graph.nodes),
+        'kept': len(prompt),
+        'removed': len(graph.nodes) - len(prompt),
+        'virtual': count(node['type'] for node in virtual),
+        'bypassed': sum(1 for node in disabled if node.get('mode') == MODE_BYPASSED),
+        'muted': sum(1 for node in disabled if node.get('mode') == MODE_MUTED),
+        'folded': count(compiled[node_id]['class_type'] for node_id in folded if node_id not in prompt),
+        'unreachable': count(entry['class_type'] for entry in unreachable.values()),
+        'loaders_removed': sorted(loaders, key=lambda loader: loader['node']),
     }
+    return prompt, report
+
+
+def print_report(report: dict):
+    """Print an optimize_workflow report."""
+    print(f"  - Nodes: {report['nodes']} -> {report['kept']} ({report['removed']} removed)")
+    print(f"  - Display-only/virtual: {sum(report['virtual'].values())}")
+    print(f"  - Bypassed: {report['bypassed']}, muted: {report['muted']}")
+    folded = [f"{count} {node_type}" for node_type, count in report['folded'].items()]
+    print(f"  - Folded to literals/links: {sum(report['folded'].values())}")
+    if folded:
+        print(f"      {', '.join(folded)}")
+    unreachable = [f"{count} {node_type}" for node_type, count in report['unreachable'].items()]
+    print(f"  - Not feeding an output: {sum(report['unreachable'].values())}")
+    if unreachable:
+        print(f"      {', '.join(unreachable)}")
+    for loader in report['loaders_removed']:
+        print(f"  - Loader not run: #{loader['node']} {loader['type']} {', '.join(loader['models'])}")
+
+
+# A patch: set a node type's widget to value. when limits the rule to
+# workflows where the widget currently holds one of those values; unlink
+# also applies it where the widget was converted to an input and linked
+# (the link is removed), instead of leaving it to the linked value.
+PatchRule = namedtuple('PatchRule', 'node_type widget value when unlink', defaults=(None, False))
+
+# Converting a macOS (MPS) workflow for CUDA; patch_workflow's default
+CUDA_RULES = [
+    PatchRule('DownloadAndLoadSAM2Model', 'device', 'cuda', when={'mps', 'cpu'}),
+    PatchRule('DownloadAndLoadSAM2Model', 'precision', 'fp16', when={'fp32'}),
+    PatchRule('DownloadAndLoadFlorence2Model', 'precision', 'fp16', when={'fp32'}),
+    PatchRule('DownloadAndLoadFlorence2Model', 'attention', 'sdpa', when={'eager'}),
+]
+
+# Resize on the GPU where the method allows it (lanczos still goes through
+# PIL on the CPU whatever the device)
+GPU_RESIZE_RULES = [
+    PatchRule('ImageResizeKJv2', 'device', 'gpu'),
+]
+
+# Quality trade-off, opt-in (--fast-resize): bicubic instead of lanczos so
+# the 1920px resizes of every input run on the GPU, at slightly softer edges
+FAST_RESIZE_RULES = [
+    PatchRule('ImageResizeKJv2', 'upscale_method', 'bicubic', when={'lanczos'}),
+]
+
+
+def upscale_tile_rules(size: int, padding: int, tiled_decode: bool = False) -> list:
+    """Fixed UltimateSDUpscale tiles (the workflow derives them from the image size)."""
+    return [
+        PatchRule('UltimateSDUpscale', 'tile_width', size, unlink=True),
+        PatchRule('UltimateSDUpscale', 'tile_height', size, unlink=True),
+        PatchRule('UltimateSDUpscale', 'tile_padding', padding),
+        PatchRule('UltimateSDUpscale', 'tiled_decode', tiled_decode),
+    ]
+
+
+# Free SAM2 after segmenting, where SDXL + Flux do not fit cached
+# (see plan_memory.py)
+RELEASE_SAM2_RULES = [
+    PatchRule('Sam2Segmentation', 'keep_model_loaded', False),
+    PatchRule('Sam2AutoSegmentation', 'keep_model_loaded', False),
+]
+
+# Keep Florence-2 loaded between its three runs, where memory allows
+KEEP_FLORENCE_RULES = [
+    PatchRule('Florence2Run', 'keep_model_loaded', True),
+]
+
+# Named hardware profiles for the pods we rent
+PATCH_PROFILES = {
+    'cuda': CUDA_RULES,
+    'rtx4090': CUDA_RULES + GPU_RESIZE_RULES + upscale_tile_rules(1024, 32) + RELEASE_SAM2_RULES,
+    'l40': CUDA_RULES + GPU_RESIZE_RULES + upscale_tile_rules(1536, 48) + KEEP_FLORENCE_RULES,
+    'a100-80g': CUDA_RULES + GPU_RESIZE_RULES + upscale_tile_rules(2048, 64) + KEEP_FLORENCE_RULES,
+    'apple-m-64g': [
+        PatchRule('DownloadAndLoadSAM2Model', 'device', 'mps', when={'cuda', 'cpu'}),
+        # bf16 needs recent macOS on MPS
+        PatchRule('DownloadAndLoadSAM2Model', 'precision', 'fp16', when={'bf16', 'fp32'}),
+        PatchRule('DownloadAndLoadFlorence2Model', 'precision', 'fp16', when={'fp32'}),
+        PatchRule('DownloadAndLoadFlorence2Model', 'attention', 'sdpa', when={'eager'}),
+        PatchRule('ImageResizeKJv2', 'device', 'gpu'),
+    ] + upscale_tile_rules(1024, 32, tiled_decode=True) + RELEASE_SAM2_RULES,
+}
+
+
+def _detach_link(workflow: dict, link_id: int):
+    """Remove a link from a UI-format workflow's link table and its source output."""
+    workflow['links'] = [link for link in workflow['links'] if not link or link[0] != link_id]
+    for node in workflow['nodes']:
+        for output in node.get('outputs') or []:
+            if link_id in (output.get('links') or []):
+                output['links'].remove(link_id)
+
+
+def apply_rules(workflow: dict, rules: list) -> list:
+    """
+    Apply patch rules to a UI- or API-format workflow, in place.
+
+    Rules address widgets by name (NODE_WIDGETS gives their position in
+    a UI node's widgets_values), so only the intended node types change,
+    whatever other widgets hold the same value.
 
-    # Handle both API format (flat dict) and UI format (nested with 'nodes')
-    nodes = workflow.get('nodes', workflow) if isinstance(workflow, dict) else workflow
+    Returns:
+        One change per node and widget: {'node', 'type', 'title',
+        'widget', 'old', 'new'}, plus 'linked' (source node id) when the
+        widget is linked and the rule was not applied, or 'unlinked' when
+        the link was removed
 
-    # If it's the UI format, nodes is a list
-    if isinstance(nodes, list):
+    Raises:
+        WorkflowError: If a rule names a widget unknown for its node type
+    """
+    changes = []
+    ui = 'nodes' in workflow
+    sources = {link[0]: link[1] for link in workflow['links'] if link} if ui else {}
+    nodes = workflow['nodes'] if ui else [
+        {'id': node_id, 'type': entry['class_type'], 'entry': entry} for node_id, entry in workflow.items()
+    ]
+    for rule in rules:
+        widgets = NODE_WIDGETS.get(rule.node_type, [])
+        if rule.widget not in widgets:
+            raise WorkflowError(f'{rule.node_type} has no widget {rule.widget!r}')
         for node in nodes:
-            if isinstance(node, dict) and 'widgets_values' in node:
-                values = node['widgets_values']
-                for i, val in enumerate(values):
-                    if val == 'mps':
-                        values[i] = 'cuda'
-                        patches['mps_to_cuda'] += 1
-                    elif val == 'fp32':
-                        values[i] = 'fp16'
-                        patches['fp32_to_fp16'] += 1
-                    elif val == 'eager':
-                        values[i] = 'sdpa'
-                        patches['eager_to_sdpa'] += 1
-    else:
-        # API format: iterate over node dict
-        for node_id, node in nodes.items():
-            if isinstance(node, dict) and 'inputs' in node:
-                inputs = node['inputs']
-                # MPS -> CUDA device
-                if inputs.get('device') == 'mps':
-                    inputs['device'] = 'cuda'
-                    patches['mps_to_cuda'] += 1
-                # fp32 -> fp16 for VRAM efficiency
-                if inputs.get('precision') == 'fp32':
-                    inputs['precision'] = 'fp16'
-                    patches['fp32_to_fp16'] += 1
-                # eager -> sdpa attention for CUDA
-                if inputs.get('attention') == 'eager':
-                    inputs['attention'] = 'sdpa'
-                    patches['eager_to_sdpa'] += 1
+            if node['type'] != rule.node_type or (ui and node.get('mode', 0) in (MODE_MUTED, MODE_BYPASSED)):
+                continue
+            change = {
+                'node': int(node['id']),
+                'type': rule.node_type,
+                'title': node.get('title') if ui else node['entry'].get('_meta', {}).get('title'),
+                'widget': rule.widget,
+            }
+            if ui:
+                values = node.get('widgets_values') or []
+                index = widgets.index(rule.widget)
+                if index >= len(values):
+                    continue
+                old = values[index]
+                slot = next((slot for slot in node.get('inputs') or []
+                             if (slot.get('widget') or {}).get('name') == rule.widget and slot.get('link') is not None), None)
+            else:
+                if rule.widget not in node['entry']['inputs']:
+                    continue
+                old = node['entry']['inputs'][rule.widget]
+                slot = old if is_link(old) else None
+
+            if slot is not None and not rule.unlink:
+                source = sources.get(slot['link']) if ui else int(slot[0])
+                if old != rule.value:
+                    changes.append({**change, 'old': old, 'new': rule.value, 'linked': source})
+                continue
+            if slot is None and (old == rule.value or (rule.when is not None and old not in rule.when)):
+                continue
+
+            if ui:
+                values[index] = rule.value
+                if slot is not None:
+                    change['unlinked'] = sources.get(slot['link'])
+                    _detach_link(workflow, slot['link'])
+                    slot['link'] = None
+            else:
+                node['entry']['inputs'][rule.widget] = rule.value
+                if slot is not None:
+                    change['unlinked'] = int(slot[0])
+            changes.append({**change, 'old': None if slot is not None else old, 'new': rule.value})
+    return changes
+
+
+def print_changes(changes: list):
+    """Print an apply_rules report."""
+    for change in changes:
+        name = f"#{change['node']} {change['type']}" + (f" ({change['title']})" if change['title'] not in (None, change['type']) else '')
+        if 'linked' in change:
+            print(f"  - {name}: {change['widget']} is linked from #{change['linked']}; left as is")
+        elif 'unlinked' in change:
+            print(f"  - {name}: {change['widget']} = {change['new']!r} (was linked from #{change['unlinked']})")
+        else:
+            print(f"  - {name}: {change['widget']} {change['old']!r} -> {change['new']!r}")
+
+
+def patch_workflow(input_path: str, output_path: str, profile: str = 'cuda', fast_resize: bool = False) -> list:
+    """
+    Patch workflow JSON for a hardware profile.
+
+    Args:
+        input_path: Path to input workflow JSON
+        output_path: Path to output patched workflow JSON
+        profile: Name in PATCH_PROFILES (default: MPS -> CUDA only)
+        fast_resize: Also apply FAST_RESIZE_RULES (bicubic instead of lanczos)
+
+    Returns:
+        The changes applied (see apply_rules)
+    """
+    with open(input_path) as f:
+        workflow = json.load(f)
+
+    changes = apply_rules(workflow, PATCH_PROFILES[profile] + (FAST_RESIZE_RULES if fast_resize else []))
 
     with open(output_path, 'w') as f:
         json.dump(workflow, f, indent=2)
 
-    return patches
+    return changes
 
 
-def main():
-    if len(sys.argv) < 3:
-        print("Usage: patch_workflow.py <input.json> <output.json>")
-        print("       Patches MPS->CUDA, fp32->fp16, eager->sdpa")
-        sys.exit(1)
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Patch widgets per hardware profile (default: cuda, i.e. MPS->CUDA, fp32->fp16, eager->sdpa)')
+    parser.add_argument('input', type=Path, help='UI-format workflow JSON')
+    parser.add_argument('output', type=Path, help='Where to write the result')
+    parser.add_argument('--profile', choices=sorted(PATCH_PROFILES),
+                        help='Hardware profile (default: cuda; with --api/--prune, none unless given)')
+    parser.add_argument('--fast-resize', action='store_true',
+                        help='Quality trade-off: resize with bicubic instead of lanczos, so '
+                             'ImageResizeKJv2 runs on the GPU')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--api', action='store_true',
+                      help='Compile the (UI-format) input to API format for /prompt')
+    mode.add_argument('--prune', action='store_true',
+                      help='Compile, fold static switches/constants/math and keep only '
+                           'nodes that feed enabled Image Save outputs')
+    args = parser.parse_args(argv)
 
-    input_path = sys.argv[1]
-    output_path = sys.argv[2]
+    input_path = args.input
+    output_path = args.output
 
-    if not Path(input_path).exists():
+    if not input_path.exists():
         print(f"Error: Input file not found: {input_path}")
-        sys.exit(1)
+        return 1
+
+    if args.api or args.prune:
+        with open(input_path) as f:
+            workflow = json.load(f)
+        try:
+            rules = (PATCH_PROFILES[args.profile] if args.profile else []) + (FAST_RESIZE_RULES if args.fast_resize else [])
+            changes = apply_rules(workflow, rules)
+            if args.prune:
+                prompt, report = optimize_workflow(workflow)
+            else:
+                prompt, report = compile_workflow(workflow), None
+        except WorkflowError as e:
+            print(f"Error: {e}")
+            return 1
+        with open(output_path, 'w') as f:
+            json.dump(prompt, f, indent=2)
+        print(f"API workflow saved to: {output_path} ({len(prompt)} nodes)")
+        print_changes(changes)
+        if report:
+            print_report(report)
+        return 0
 
-    patches = patch_workflow(input_path, output_path)
+    profile = args.profile or 'cuda'
+    try:
+        changes = patch_workflow(input_path, output_path, profile, args.fast_resize)
+    except WorkflowError as e:
+        print(f"Error: {e}")
+        return 1
 
-    print(f"Patched workflow saved to: {output_path}")
-    print(f"  - MPS -> CUDA: {patches['mps_to_cuda']}")
-    print(f"  - fp32 -> fp16: {patches['fp32_to_fp16']}")
-    print(f"  - eager -> sdpa: {patches['eager_to_sdpa']}")
+    print(f"Patched workflow saved to: {output_path} (profile: {profile})")
+    print_changes(changes)
 
-    if sum(patches.values()) == 0:
-        print("  (No changes needed - workflow already CUDA-compatible)")
+    if not any('linked' not in change for change in changes):
+        print("  (No changes needed - workflow already matches the profile)")
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Predict which models a workflow keeps resident, and where memory peaks.
+
+Walks the compiled (and, by default, pruned and folded) workflow in
+execution order, maps every loader to its file size from setup.py's
+MODEL_MANIFEST and tracks each model from its loader to the last node that
+uses it. Reports the live models per workflow group (SDXL, Flux,
+segmentation, upscale...) and a verdict per memory tier:
+
+  - fits cached:      every model stays loaded (ComfyUI's default)
+  - fits offloading:  only if models are freed after their last use
+  - does not fit:     even the peak of live models exceeds the budget
+
+Model memory is approximated by file size (weights are loaded at their
+stored precision); activations and the CUDA context are a fixed reserve.
+
+Usage:
+    python3 plan_memory.py
+    python3 plan_memory.py archviz_v037_cuda.json --no-prune
+    python3 plan_memory.py --json memory_plan.json
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from patch_workflow import (
+    MODEL_LOADERS,
+    WorkflowError,
+    WorkflowGraph,
+    compile_workflow,
+    execution_order,
+    is_link,
+    loader_models,
+    optimize_workflow,
+)
+from setup import GB, MODEL_MANIFEST, model_variants
+
+WORKFLOW_FILE = Path(__file__).resolve().parent.parent / "workflows" / "archviz_v037_cuda.json"
+
+# Link types that carry a loaded model: a model stays live while any node
+# downstream along these types has yet to run
+MODEL_TYPES = {
+    "MODEL", "CLIP", "VAE", "CONTROL_NET", "CLIP_VISION", "IPADAPTER",
+    "UPSCALE_MODEL", "SAM2MODEL", "FL2MODEL", "CONTROL_NET_STACK",
+}
+
+# Memory tiers: (patch_workflow profile, name, memory in GB, reserve for
+# activations/context/OS in GB)
+MEMORY_TIERS = [
+    ("rtx4090", "24 GB (RTX 4090)", 24, 4),
+    ("l40", "48 GB (L40/A6000)", 48, 4),
+    ("a100-80g", "80 GB (A100/H100)", 80, 4),
+    # Unified memory is shared with the OS and applications
+    ("apple-m-64g", "64 GB unified (Apple M-series)", 64, 14),
+]
+
+def manifest_sizes() -> dict:
+    """Map model file name (or repo id for repository downloads) -> size in bytes, for every variant."""
+    sizes = {}
+    for tier_data in MODEL_MANIFEST.values():
+        for model in (variant for entry in tier_data["models"] for variant in model_variants(entry)):
+            if model.get("file") is None:
+                sizes[model["repo"]] = model["size"]
+            else:
+                sizes[model.get("rename_to") or Path(model["file"]).name] = model["size"]
+    return sizes
+
+def output_type(graph: WorkflowGraph, node_id: str, slot: int) -> str:
+    outputs = graph.nodes[int(node_id)].get("outputs") or []
+    return outputs[slot]["type"] if slot < len(outputs) else None
+
+def plan_memory(workflow: dict, prune: bool = True) -> dict:
+    """
+    Compute model residency along the execution order.
+
+    Returns:
+        Plan with 'models' (per loader: size, first/last step), 'stages'
+        (per group: live models and resident bytes), 'peak' and 'tiers'
+    """
+    graph = WorkflowGraph(workflow)
+    prompt = optimize_workflow(workflow)[0] if prune else compile_workflow(workflow)
+    order = execution_order(prompt, workflow)
+    prompt = {node_id: prompt[node_id] for node_id in order}
+    step = {node_id: index for index, node_id in enumerate(order)}
+    sizes = manifest_sizes()
+
+    # Consumers along model-carrying links
+    consumers = {node_id: [] for node_id in prompt}
+    for node_id, entry in prompt.items():
+        for value in entry["inputs"].values():
+            if is_link(value) and value[0] in prompt and output_type(graph, value[0], value[1]) in MODEL_TYPES:
+                consumers[value[0]].append(node_id)
+
+    def last_use(node_id: str) -> int:
+        last, pending, seen = step[node_id], [node_id], set()
+        while pending:
+            current = pending.pop()
+            for consumer in consumers[current]:
+                if consumer not in seen:
+                    seen.add(consumer)
+                    last = max(last, step[consumer])
+                    pending.append(consumer)
+        return last
+
+    models = []
+    for node_id in order:
+        entry = prompt[node_id]
+        if entry["class_type"] not in MODEL_LOADERS:
+            continue
+        for name in loader_models(entry):
+            size = sizes.get(name, sizes.get(Path(name).name))
+            models.append({
+                "node": int(node_id),
+                "type": entry["class_type"],
+                "model": name,
+                "bytes": size or 0,
+                "known": size is not None,
+                "first": step[node_id],
+                "last": last_use(node_id),
+            })
+
+    def stage_of(node_id: str) -> str:
+        titles = graph.group_titles(int(node_id))
+        return titles[0] if titles else "(ungrouped)"
+
+    resident = [
+        sum(model["bytes"] for model in models if model["first"] <= index <= model["last"])
+        for index in range(len(order))
+    ]
+    # Groups interleave in execution order; report each once, in order of
+    # first appearance, with its peak
+    stages = {}
+    for index, node_id in enumerate(order):
+        current = stages.setdefault(stage_of(node_id), {"name": stage_of(node_id), "first": index, "bytes": 0, "models": []})
+        current["bytes"] = max(current["bytes"], resident[index])
+        for model in models:
+            if model["first"] <= index <= model["last"] and model["model"] not in current["models"]:
+                current["models"].append(model["model"])
+
+    peak_step = max(range(len(order)), key=resident.__getitem__) if order else 0
+    peak = resident[peak_step] if order else 0
+    cached = sum(model["bytes"] for model in models)
+
+    tiers = []
+    for profile, name, memory, reserve in MEMORY_TIERS:
+        budget = (memory - reserve) * GB
+        if cached <= budget:
+            verdict = "fits cached"
+        elif peak <= budget:
+            verdict = "fits offloading"
+        else:
+            verdict = "does not fit"
+        tiers.append({"profile": profile, "name": name, "budget_bytes": budget, "verdict": verdict})
+
+    return {
+        "nodes": len(order),
+        "models": models,
+        "stages": list(stages.values()),
+        "peak": {
+            "bytes": peak,
+            "step": peak_step,
+            "node": int(order[peak_step]) if order else None,
+            "stage": stage_of(order[peak_step]) if order else None,
+        },
+        "cached_bytes": cached,
+        "tiers": tiers,
+    }
+
+def print_plan(plan: dict):
+    print(f"Models loaded by {plan['nodes']} executed nodes:")
+    for model in plan["models"]:
+        note = "" if model["known"] else "  (not in MODEL_MANIFEST: size unknown)"
+        print(f"  {model['bytes'] / GB:>6.1f} GB  steps {model['first']:>3}-{model['last']:<3} "
+              f"{model['model']}{note}")
+
+    print("\nResident models per stage (execution order):")
+    for stage in plan["stages"]:
+        if stage["models"]:
+            print(f"  {stage['bytes'] / GB:>6.1f} GB  {stage['name']}: {', '.join(stage['models'])}")
+
+    peak = plan["peak"]
+    print(f"\nPeak resident models: {peak['bytes'] / GB:.1f} GB at step {peak['step']} "
+          f"(node {peak['node']}, {peak['stage']})")
+    print(f"All models cached:    {plan['cached_bytes'] / GB:.1f} GB")
+
+    print("\nMemory tiers (model budget after reserve):")
+    for tier in plan["tiers"]:
+        print(f"  {tier['name']:<32} {tier['budget_bytes'] / GB:>5.0f} GB  {tier['verdict']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Predict a workflow's model residency and peak memory")
+    parser.add_argument("workflow", nargs="?", type=Path, default=WORKFLOW_FILE,
+                        help="UI-format workflow JSON (default: the archviz workflow)")
+    parser.add_argument("--no-prune", action="store_true",
+                        help="Plan every enabled node, not only those feeding Image Save outputs")
+    parser.add_argument("--json", type=Path, metavar="FILE",
+                        help="Also write the plan as JSON")
+    args = parser.parse_args(argv)
+
+    if not args.workflow.exists():
+        print(f"Error: Workflow not found: {args.workflow}")
+        return 1
+    try:
+        plan = plan_memory(json.loads(args.workflow.read_text()), prune=not args.no_prune)
+    except WorkflowError as e:
+        print(f"Error: {e}")
+        return 1
+
+    print_plan(plan)
+    if args.json:
+        args.json.write_text(json.dumps(plan, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
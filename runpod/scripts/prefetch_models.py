@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Prefetch the models a workflow loads into the page cache.
+
+ComfyUI reads models lazily, so the first queue after a pod boot waits on
+the network volume for every checkpoint. This reads the files the workflow
+actually loads, in the order it needs them, so they come from memory when
+ComfyUI asks for them. Run it in the background while ComfyUI starts:
+
+Usage:
+    python3 /workspace/prefetch_models.py &
+    python3 /workspace/prefetch_models.py --budget 40 --jobs 4
+    python3 /workspace/prefetch_models.py --dry-run
+
+Files are taken in execution order until the memory budget (default: 80%
+of available memory) is used up; larger files that do not fit are skipped
+in favour of later ones that do.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from patch_workflow import model_references
+
+VOLUME_PATH = Path("/workspace")
+WORKFLOW_FILE = VOLUME_PATH / "archviz_v037_cuda.json"
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+# Large sequential reads: network volumes are latency-bound on small ones
+READ_SIZE = 16 * MB
+
+DEFAULT_JOBS = 4
+DEFAULT_BUDGET_FRACTION = 0.8
+
+def available_memory() -> int:
+    """MemAvailable from /proc/meminfo in bytes (0 if unknown)."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def model_files(path: Path) -> list:
+    """The files behind a model reference (a directory for repo downloads)."""
+    if path.is_dir():
+        return sorted(p for p in path.rglob("*") if p.is_file() and ".cache" not in p.parts)
+    if path.is_file():
+        return [path]
+    return []
+
+def plan_prefetch(workflow: dict, root: Path, budget: int) -> tuple:
+    """
+    Choose the files to prefetch.
+
+    Returns:
+        (selected, skipped, missing): selected and skipped are lists of
+        (reference, files, size); missing lists references not on disk
+    """
+    selected, skipped, missing = [], [], []
+    remaining = budget
+    for reference in model_references(workflow):
+        files = model_files(root / reference["path"])
+        if not files:
+            missing.append(reference)
+            continue
+        size = sum(f.stat().st_size for f in files)
+        if size <= remaining:
+            selected.append((reference, files, size))
+            remaining -= size
+        else:
+            skipped.append((reference, files, size))
+    return selected, skipped, missing
+
+def prefetch_file(path: Path) -> int:
+    """
+    Pull one file into the page cache.
+
+    posix_fadvise(WILLNEED) starts kernel readahead for the whole file;
+    the sequential read that follows makes sure every page is resident,
+    since network filesystems often ignore the hint.
+
+    Returns:
+        Bytes read
+    """
+    total = 0
+    buffer = bytearray(READ_SIZE)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        while True:
+            count = os.readv(fd, [buffer])
+            if not count:
+                break
+            total += count
+    finally:
+        os.close(fd)
+    return total
+
+def prefetch(selected: list, jobs: int) -> int:
+    """
+    Prefetch files in parallel, earliest-needed first.
+
+    Returns:
+        Number of files that failed
+    """
+    failures = 0
+    started = time.monotonic()
+    total = 0
+    order = [(reference, path) for reference, files, _ in selected for path in files]
+
+    def job(path: Path) -> tuple:
+        start = time.monotonic()
+        return prefetch_file(path), time.monotonic() - start
+
+    # The pool starts jobs in submission order, so the first models the
+    # workflow needs are read first
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(job, path): (reference, path) for reference, path in order}
+        for future in as_completed(futures):
+            reference, path = futures[future]
+            try:
+                size, seconds = future.result()
+            except OSError as e:
+                print(f"  FAILED {path}: {e}")
+                failures += 1
+                continue
+            total += size
+            print(f"  {size / MB:>9,.0f} MB {seconds:>6.1f}s "
+                  f"{size / MB / max(seconds, 1e-6):>7,.0f} MB/s  {path.name}")
+
+    elapsed = time.monotonic() - started
+    print(f"Prefetched {total / GB:.2f} GB in {elapsed:.1f}s "
+          f"({total / MB / max(elapsed, 1e-6):,.0f} MB/s)")
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prefetch a workflow's models into the page cache")
+    parser.add_argument("workflow", nargs="?", type=Path, default=WORKFLOW_FILE,
+                        help=f"UI-format workflow JSON (default: {WORKFLOW_FILE})")
+    parser.add_argument("--root", type=Path, default=VOLUME_PATH,
+                        help=f"Volume root holding models/ and LLM/ (default: {VOLUME_PATH})")
+    parser.add_argument("--budget", type=float, metavar="GB",
+                        help="Memory to fill (default: 80%% of available memory)")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        help=f"Files read in parallel (default: {DEFAULT_JOBS})")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only print what would be prefetched")
+    args = parser.parse_args(argv)
+
+    if not args.workflow.exists():
+        print(f"Error: Workflow not found: {args.workflow}")
+        return 1
+    workflow = json.loads(args.workflow.read_text())
+
+    budget = int(args.budget * GB) if args.budget else int(available_memory() * DEFAULT_BUDGET_FRACTION)
+    selected, skipped, missing = plan_prefetch(workflow, args.root, budget)
+
+    print(f"Memory budget: {budget / GB:.1f} GB")
+    for reference, _, size in selected:
+        print(f"  [{reference['order']:>4}] {size / GB:>6.2f} GB  {reference['path']}")
+    for reference, _, size in skipped:
+        print(f"  skip   {size / GB:>6.2f} GB  {reference['path']} (over budget)")
+    for reference in missing:
+        print(f"  missing          {reference['path']}")
+
+    if args.dry_run or not selected:
+        return 0
+    return 1 if prefetch(selected, max(1, args.jobs)) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Choose the least quantized model variants that fit a GPU tier.
+
+MODEL_MANIFEST lists alternative quantizations for the large models
+(Flux1-dev, T5-XXL). For a tier (the patch_workflow profiles: rtx4090,
+l40, a100-80g, apple-m-64g) this plans every combination with
+plan_memory.py and picks, in order of preference:
+
+  1. the best verdict: every model cached, then offloading after last use
+  2. the largest (least quantized) variant of each model, in manifest
+     order (Flux first)
+
+Only variants with a pinned SHA256 are considered: setup.py never
+downloads an unpinned one.
+
+It writes the choice to /workspace/model_variants.json, so the next
+setup.py run downloads those variants, and a copy of the workflow whose
+loaders name them (switching UnetLoaderGGUF <-> UNETLoader for unquantized
+weights) and whose UltimateSDUpscale tiles fit the memory left over.
+
+Usage:
+    python3 select_variants.py rtx4090
+    python3 select_variants.py a100-80g archviz_v037_cuda.json --output archviz_a100.json
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import sys
+from pathlib import Path
+
+from patch_workflow import (
+    MODEL_LOADERS,
+    WorkflowError,
+    apply_rules,
+    print_changes,
+    upscale_tile_rules,
+)
+from plan_memory import MEMORY_TIERS, plan_memory
+from setup import GB, MODEL_MANIFEST, VARIANTS_FILE, model_variants
+
+WORKFLOW_FILE = Path(__file__).resolve().parent.parent / "workflows" / "archviz_v037_cuda.json"
+
+VERDICT_RANK = {"fits cached": 2, "fits offloading": 1, "does not fit": 0}
+
+# Memory left after the models -> (tile size, tile padding) for UltimateSDUpscale
+TILE_SIZES = [
+    (16 * GB, 2048, 64),
+    (8 * GB, 1536, 48),
+    (0, 1024, 32),
+]
+
+# Widget values when a loader node switches type (from the first widget)
+LOADER_WIDGETS = {
+    "UnetLoaderGGUF": lambda name: [name],
+    "UNETLoader": lambda name: [name, "default"],
+}
+
+def file_name(model: dict) -> str:
+    return model.get("rename_to") or Path(model["file"]).name
+
+def variant_groups() -> list:
+    """Every manifest entry with alternatives, as its list of variants with a pinned hash."""
+    return [
+        [variant for variant in model_variants(model) if variant.get("hash")]
+        for tier_data in MODEL_MANIFEST.values() for model in tier_data["models"]
+        if model.get("variants")
+    ]
+
+def unpinned_variants() -> list:
+    """Names of the variants select_variants cannot choose for lack of a pinned hash."""
+    return [
+        variant["name"]
+        for tier_data in MODEL_MANIFEST.values() for model in tier_data["models"]
+        for variant in model_variants(model) if not variant.get("hash")
+    ]
+
+def use_variants(workflow: dict, choice: list) -> list:
+    """
+    Point the workflow's loaders at the chosen variants, in place.
+
+    choice holds one variant per variant_groups() entry, in that order.
+
+    A widget naming any variant of a model is set to the chosen one; a
+    loader that cannot load it (UnetLoaderGGUF for safetensors) switches
+    to the variant's loader node type.
+
+    Returns:
+        Changes in the apply_rules report format
+    """
+    names = {file_name(variant): chosen for group, chosen in zip(variant_groups(), choice) for variant in group}
+    changes = []
+    for node in workflow["nodes"]:
+        values = node.get("widgets_values") or []
+        for index in MODEL_LOADERS.get(node["type"], {}):
+            if index >= len(values) or values[index] not in names:
+                continue
+            chosen = names[values[index]]
+            change = {"node": node["id"], "type": node["type"], "title": node.get("title")}
+            loader = chosen.get("loader")
+            if loader and loader != node["type"] and loader in LOADER_WIDGETS and node["type"] in LOADER_WIDGETS:
+                changes.append({**change, "widget": "type", "old": node["type"], "new": loader})
+                node["type"] = loader
+                node["widgets_values"] = values = LOADER_WIDGETS[loader](values[index])
+                index = 0
+            if values[index] != file_name(chosen):
+                changes.append({**change, "widget": "model", "old": values[index], "new": file_name(chosen)})
+                values[index] = file_name(chosen)
+    return changes
+
+def select_variants(workflow: dict, profile: str) -> dict:
+    """
+    Plan every variant combination for a tier and pick the best.
+
+    Returns:
+        {'choice': [variant entries], 'plan': plan_memory plan, 'verdict',
+        'budget_bytes', 'headroom_bytes'}
+    """
+    best = None
+    for choice in itertools.product(*variant_groups()):
+        candidate = copy.deepcopy(workflow)
+        use_variants(candidate, list(choice))
+        plan = plan_memory(candidate)
+        tier = next(tier for tier in plan["tiers"] if tier["profile"] == profile)
+        key = (
+            VERDICT_RANK[tier["verdict"]],
+            tuple(variant["size"] for variant in choice),
+        )
+        if best is None or key > best[0]:
+            resident = plan["cached_bytes"] if tier["verdict"] == "fits cached" else plan["peak"]["bytes"]
+            best = (key, {
+                "choice": list(choice),
+                "plan": plan,
+                "verdict": tier["verdict"],
+                "budget_bytes": tier["budget_bytes"],
+                "headroom_bytes": tier["budget_bytes"] - resident,
+            })
+    return best[1]
+
+def main(argv=None):
+    profiles = [tier[0] for tier in MEMORY_TIERS]
+    parser = argparse.ArgumentParser(description="Choose model variants and upscale tiles for a GPU tier")
+    parser.add_argument("profile", choices=profiles, help="GPU tier")
+    parser.add_argument("workflow", nargs="?", type=Path, default=WORKFLOW_FILE,
+                        help="UI-format workflow JSON (default: the archviz workflow)")
+    parser.add_argument("--output", type=Path,
+                        help="Rewritten workflow (default: <workflow>_<profile>.json in the current directory)")
+    parser.add_argument("--variants-file", type=Path, default=VARIANTS_FILE,
+                        help=f"Where setup.py reads the choice from (default: {VARIANTS_FILE})")
+    args = parser.parse_args(argv)
+
+    if not args.workflow.exists():
+        print(f"Error: Workflow not found: {args.workflow}")
+        return 1
+    workflow = json.loads(args.workflow.read_text())
+
+    try:
+        selection = select_variants(workflow, args.profile)
+        changes = use_variants(workflow, selection["choice"])
+        size, padding = next(((size, padding) for minimum, size, padding in TILE_SIZES
+                              if selection["headroom_bytes"] >= minimum), TILE_SIZES[-1][1:])
+        changes += apply_rules(workflow, upscale_tile_rules(size, padding))
+    except WorkflowError as e:
+        print(f"Error: {e}")
+        return 1
+
+    print(f"{args.profile}: {selection['verdict']} "
+          f"({selection['budget_bytes'] / GB:.0f} GB budget, {selection['headroom_bytes'] / GB:.1f} GB left)")
+    for variant in selection["choice"]:
+        print(f"  {variant['size'] / GB:>5.1f} GB  {variant['name']}")
+    if unpinned_variants():
+        print(f"  Skipped (no pinned SHA256): {', '.join(unpinned_variants())}")
+    if selection["verdict"] == "does not fit":
+        print("  Warning: even the smallest pinned variants do not fit; expect out-of-memory errors")
+    print(f"  Upscale tiles: {size}x{size}, padding {padding}")
+    print_changes(changes)
+
+    output = args.output or Path(f"{args.workflow.stem}_{args.profile}.json")
+    output.write_text(json.dumps(workflow, indent=2))
+    print(f"Workflow saved to: {output}")
+
+    if not args.variants_file.parent.exists():
+        print(f"Warning: {args.variants_file.parent} not found; not writing {args.variants_file.name}")
+        return 0
+    choice = {group[0]["name"]: variant["variant"] for group, variant in zip(variant_groups(), selection["choice"])}
+    args.variants_file.write_text(json.dumps({"profile": args.profile, "variants": choice}, indent=2))
+    print(f"Wrote {args.variants_file} (run setup.py to download the variants)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+"""
+Serverless worker: one warm ComfyUI serving render jobs from a job queue.
+
+The worker boots ComfyUI once and keeps it running between jobs, so models
+stay loaded after the first job (with --profile, ComfyUI also gets
+--highvram when plan_memory.py says every model fits, so they stay in
+VRAM). It exits after --idle-seconds without jobs, letting the platform
+scale to zero.
+
+Each round it takes every queued job (up to --max-jobs) from the job API,
+coalesces identical jobs that give no seed into one latent batch (as
+sweep_workflow.py does: each job gets its own sample of a seed drawn at
+random per run, reported as batch_seed/batch_index), renders identical jobs with the
+same seed once, queues the rest side by side and posts each job's images
+back. A malformed job, or a round that fails unexpectedly, gets an error
+posted instead of being left in progress.
+
+Job input:
+
+    {
+      "images": {"1DEPTH": "<base64 or data URL>"},  // per workflow input role
+      "workflow": "archviz_v037_cuda",               // optional, default the first
+      "set": {"152.denoise": 0.3},                   // literal inputs by node id or title
+      "seed": 42                                     // optional, honored exactly; random if omitted
+    }
+
+The worker measures itself: ComfyUI boot time, the first (cold) job, warm
+jobs, and per-job overhead (job time outside ComfyUI's queue and
+execution). Every job output carries its timings; the summary is printed
+on exit and written to --metrics.
+
+The job API is RunPod's (RUNPOD_WEBHOOK_GET_JOB / RUNPOD_WEBHOOK_POST_OUTPUT)
+or, with --job-api, job_api_stub.py or anything serving its endpoints.
+
+Usage:
+    python3 serverless_handler.py
+    python3 serverless_handler.py --job-api http://127.0.0.1:8000 --profile rtx4090
+    python3 serverless_handler.py --job-api http://127.0.0.1:8000 \\
+        --comfyui-command "python3 comfyui_stub.py --port 8188 --load-seconds 20"
+"""
+
+import argparse
+import base64
+import copy
+import hashlib
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from batch_render import (
+    COMFYUI_URL,
+    ComfyClient,
+    ComfyUIError,
+    input_roles,
+    load_prompt,
+    run_batch,
+)
+from patch_workflow import OUTPUT_NODES, PATCH_PROFILES, WorkflowError, is_link
+from plan_memory import MEMORY_TIERS, plan_memory
+from sweep_workflow import DEFAULT_MAX_BATCH, batch_latents, find_nodes, seed_targets
+
+WORKFLOW_FILE = Path(__file__).resolve().parent.parent / "workflows" / "archviz_v037_cuda.json"
+
+# ComfyUI in the serverless image (runpod/worker-comfyui), else on the pod volume
+COMFYUI_PATH = Path(os.environ.get("COMFYUI_PATH", "/comfyui"))
+if not COMFYUI_PATH.exists():
+    COMFYUI_PATH = Path("/workspace/runpod-slim/ComfyUI")
+
+DEFAULT_IDLE_SECONDS = 300
+DEFAULT_MAX_JOBS = 8
+BOOT_TIMEOUT = 600
+
+# Pause between job API polls while the queue is empty
+TAKE_INTERVAL = 1.0
+
+# Image magic -> file extension for uploads
+IMAGE_TYPES = [(b"\x89PNG", ".png"), (b"\xff\xd8", ".jpg"), (b"RIFF", ".webp")]
+
+# Largest seed every seed input accepts (rgthree's Seed node; samplers take up to 2**64 - 1)
+MAX_SEED = 1125899906842624
+
+class JobAPI:
+    """
+    Take and complete jobs.
+
+    With a base URL: GET <url>/job-take/<worker>, POST
+    <url>/job-done/<worker>?id=<id>. Without one, the RunPod worker
+    environment: RUNPOD_WEBHOOK_GET_JOB and RUNPOD_WEBHOOK_POST_OUTPUT
+    ($ID placeholders), authorized with RUNPOD_AI_API_KEY.
+    """
+
+    def __init__(self, url: str = None):
+        worker = os.environ.get("RUNPOD_POD_ID", "local")
+        if url:
+            self.take_url = f"{url.rstrip('/')}/job-take/{worker}"
+            self.done_url = f"{url.rstrip('/')}/job-done/{worker}?id=$ID"
+        else:
+            self.take_url = os.environ.get("RUNPOD_WEBHOOK_GET_JOB", "").replace("$ID", worker)
+            self.done_url = os.environ.get("RUNPOD_WEBHOOK_POST_OUTPUT", "").replace("$RUNPOD_POD_ID", worker)
+        if not self.take_url or not self.done_url:
+            raise ValueError("no job API: pass --job-api or set RUNPOD_WEBHOOK_GET_JOB/RUNPOD_WEBHOOK_POST_OUTPUT")
+        self.headers = {"Content-Type": "application/json"}
+        if os.environ.get("RUNPOD_AI_API_KEY"):
+            self.headers["Authorization"] = os.environ["RUNPOD_AI_API_KEY"]
+
+    def take(self):
+        """The next queued job ({'id', 'input'}), or None when the queue is empty."""
+        request = urllib.request.Request(self.take_url, headers=self.headers)
+        with urllib.request.urlopen(request, timeout=30) as response:
+            body = response.read()
+        if response.status == 204 or not body:
+            return None
+        job = json.loads(body)
+        return job if job.get("id") else None
+
+    def done(self, job_id: str, result: dict):
+        """Post {'output': ...} or {'error': ...} for a job."""
+        request = urllib.request.Request(
+            self.done_url.replace("$ID", job_id), data=json.dumps(result).encode(), headers=self.headers,
+        )
+        with urllib.request.urlopen(request, timeout=60) as response:
+            response.read()
+
+def boot_comfyui(command: list, cwd: Path, client: ComfyClient, timeout: float = BOOT_TIMEOUT):
+    """
+    Start ComfyUI and wait until its API answers.
+
+    Returns:
+        (process, seconds to ready)
+    """
+    started = time.monotonic()
+    process = subprocess.Popen(command, cwd=cwd)
+    while time.monotonic() - started < timeout:
+        if process.poll() is not None:
+            raise ComfyUIError(f"ComfyUI exited with code {process.returncode} during boot", retryable=False)
+        try:
+            client.get_json("/system_stats")
+            return process, time.monotonic() - started
+        except ComfyUIError:
+            time.sleep(0.5)
+    process.terminate()
+    raise ComfyUIError(f"ComfyUI not ready after {timeout:.0f}s", retryable=False)
+
+def decode_image(value: str) -> bytes:
+    """Image bytes from base64 or a data URL."""
+    if value.startswith("data:"):
+        value = value.split(",", 1)[1]
+    return base64.b64decode(value)
+
+def apply_settings(prompt: dict, settings: dict):
+    """Set literal inputs, keyed '<node id or title>.<input>' like sweep specs, in place."""
+    for key, value in settings.items():
+        reference, _, name = key.rpartition(".")
+        for node_id in find_nodes(prompt, reference):
+            if name not in prompt[node_id]["inputs"] or is_link(prompt[node_id]["inputs"][name]):
+                raise WorkflowError(f"node {node_id} ({reference}) has no literal input {name!r}")
+            prompt[node_id]["inputs"][name] = value
+
+def prepare_job(workflows: dict, job_input: dict) -> dict:
+    """
+    Validate a job's input and build its prompt.
+
+    Returns:
+        {'prompt' (without the seed applied), 'images': {role: bytes},
+        'seed', 'key'}: jobs with equal keys render the same images
+
+    Raises:
+        WorkflowError: If the input is malformed or does not fit the workflow
+    """
+    if not isinstance(job_input, dict):
+        raise WorkflowError("job input must be an object")
+    name = job_input.get("workflow") or next(iter(workflows))
+    if not isinstance(name, str) or name not in workflows:
+        raise WorkflowError(f"unknown workflow {name!r} (loaded: {', '.join(workflows)})")
+    settings = job_input.get("set", {})
+    if not isinstance(settings, dict) or not all(isinstance(value, (str, int, float)) for value in settings.values()):
+        # A list would turn the input into a link
+        raise WorkflowError("'set' must map '<node id or title>.<input>' to strings or numbers")
+    given = job_input.get("images", {})
+    if not isinstance(given, dict) or not all(isinstance(value, str) for value in given.values()):
+        raise WorkflowError("'images' must map input roles to base64 strings")
+    seed = job_input.get("seed")
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int) or not 0 <= seed <= MAX_SEED):
+        raise WorkflowError(f"'seed' must be an integer from 0 to {MAX_SEED}, got {seed!r}")
+
+    prompt = copy.deepcopy(workflows[name])
+    apply_settings(prompt, settings)
+
+    roles = input_roles(prompt)
+    missing = sorted(set(roles) - set(given))
+    if missing:
+        raise WorkflowError(f"missing images for {', '.join(missing)}")
+    try:
+        images = {role: decode_image(given[role]) for role in roles}
+    except (ValueError, TypeError, AttributeError) as e:
+        raise WorkflowError(f"invalid image data: {e}") from e
+
+    digest = hashlib.sha256(json.dumps([prompt, seed], sort_keys=True).encode())
+    for role in sorted(images):
+        digest.update(role.encode() + hashlib.sha256(images[role]).digest())
+    return {"prompt": prompt, "images": images, "seed": seed, "key": digest.hexdigest()}
+
+def coalesce(jobs: list, max_batch: int = DEFAULT_MAX_BATCH) -> list:
+    """
+    Group prepared jobs into the fewest ComfyUI runs.
+
+    Jobs without a seed get a random one per run, as the workflow's
+    "randomize" seed widgets would in the UI. Jobs with the same key and no
+    seed share one run when the workflow's seeds feed only samplers on
+    empty latents (sweep_workflow.batch_latents): the latent batch grows by
+    one per job and each job gets its own sample of the run's seed. Jobs
+    with the same key and seed would render the same images, so they share
+    one unbatched run. Others run one job each. Seeds go to
+    sweep_workflow.seed_targets, so samplers with their own literal seed
+    keep it.
+
+    Returns:
+        List of {'prompt', 'images', 'jobs': [(job id, batch index)],
+        'batch', 'seed'}: batch is the latent batch multiplier
+    """
+    groups = {}
+    for job_id, job in jobs:
+        groups.setdefault(job["key"], []).append((job_id, job))
+
+    runs = []
+    for members in groups.values():
+        prompt = members[0][1]["prompt"]
+        seed = members[0][1]["seed"]
+        targets = seed_targets(prompt)
+        if seed is not None:
+            run = copy.deepcopy(prompt)
+            for node_id, name in targets:
+                run[node_id]["inputs"][name] = seed
+            runs.append({"prompt": run, "images": members[0][1]["images"],
+                         "jobs": [(job_id, 0) for job_id, _ in members], "batch": 1, "seed": seed})
+            continue
+
+        latents = batch_latents(prompt, sorted({node_id for node_id, _ in targets}, key=int)) if targets else []
+        size = 1
+        if latents and len(members) > 1:
+            size = max(1, max_batch // max(prompt[node_id]["inputs"]["batch_size"] for node_id in latents))
+        for start in range(0, len(members), size):
+            chunk = members[start:start + size]
+            run = copy.deepcopy(prompt)
+            seed = random.randrange(MAX_SEED + 1) if targets else None
+            for node_id, name in targets:
+                run[node_id]["inputs"][name] = seed
+            if len(chunk) > 1:
+                for node_id in latents:
+                    run[node_id]["inputs"]["batch_size"] *= len(chunk)
+            runs.append({"prompt": run, "images": chunk[0][1]["images"],
+                         "jobs": [(job_id, index) for index, (job_id, _) in enumerate(chunk)],
+                         "batch": len(chunk), "seed": seed})
+    return runs
+
+def image_suffix(data: bytes) -> str:
+    return next((suffix for magic, suffix in IMAGE_TYPES if data.startswith(magic)), ".png")
+
+class Worker:
+    """A warm ComfyUI and the jobs it has served."""
+
+    def __init__(self, client: ComfyClient, workflows: dict, max_batch: int, in_flight: int):
+        self.client = client
+        self.workflows = workflows
+        self.max_batch = max_batch
+        self.in_flight = in_flight
+        self.workdir = Path(tempfile.mkdtemp(prefix="serverless_"))
+        self.boot_seconds = None
+        self.runs = 0
+        self.jobs = []  # per-job timings
+
+    def serve(self, taken: list) -> dict:
+        """
+        Render a round of taken jobs.
+
+        Returns:
+            Map job id -> {'output': ...} or {'error': ...}
+        """
+        results, prepared = {}, []
+        for job, received in taken:
+            try:
+                prepared.append((job["id"], prepare_job(self.workflows, job.get("input", {}))))
+            except WorkflowError as e:
+                results[job["id"]] = {"error": str(e)}
+        received_at = {job["id"]: received for job, received in taken}
+
+        runs = coalesce(prepared, self.max_batch)
+        batch_jobs = []
+        for number, run in enumerate(runs):
+            name = f"run{self.runs + number:05d}"
+            inputs = {}
+            for role, data in run["images"].items():
+                path = self.workdir / f"{name}_{role}{image_suffix(data)}"
+                path.write_bytes(data)
+                for target in input_roles(run["prompt"])[role]:
+                    inputs[target] = path
+            prompt = run["prompt"]
+            for entry in prompt.values():
+                if entry["class_type"] in OUTPUT_NODES and isinstance(entry["inputs"].get("filename_prefix"), str):
+                    entry["inputs"]["filename_prefix"] += f"_{name}"
+                    if "show_previews" in entry["inputs"]:
+                        entry["inputs"]["show_previews"] = "true"
+            batch_jobs.append({"name": name, "prompt": prompt, "inputs": inputs, "attempts": 0})
+        cold = self.runs == 0
+        self.runs += len(runs)
+        report = run_batch(self.client, batch_jobs, self.workdir, self.in_flight) if batch_jobs else {"results": []}
+
+        by_name = {result["name"]: result for result in report["results"]}
+        for number, (run, batch_job) in enumerate(zip(runs, batch_jobs)):
+            result = by_name[batch_job["name"]]
+            for job_id, index in run["jobs"]:
+                if result["status"] != "ok":
+                    results[job_id] = {"error": result["error"]}
+                    continue
+                images = []
+                for paths in result["outputs"].values():
+                    # The batch grew job by job: each job owns a consecutive
+                    # slice; an output not fed by the batch is every job's
+                    share = len(paths) // run["batch"]
+                    for path in paths[index * share:(index + 1) * share] if share else paths:
+                        images.append({"filename": Path(path).name,
+                                       "data": base64.b64encode(Path(path).read_bytes()).decode()})
+                total = time.monotonic() - received_at[job_id]
+                execution, queued = result["execution_seconds"], result["queue_seconds"]
+                timings = {
+                    "total_seconds": round(total, 2),
+                    "queue_seconds": queued,
+                    "execution_seconds": execution,
+                    # Decoding, uploads, downloads and encoding: what the
+                    # worker adds to ComfyUI's own time
+                    "overhead_seconds": round(total - execution - queued, 2) if execution is not None else None,
+                    "cold": cold and number == 0,
+                    "batch": run["batch"],
+                }
+                self.jobs.append(timings)
+                results[job_id] = {"output": {
+                    "images": images,
+                    "batch_seed": run["seed"],
+                    "batch_index": index,
+                    "timings": timings,
+                }}
+            for path in (path for paths in result["outputs"].values() for path in paths):
+                Path(path).unlink(missing_ok=True)
+        return results
+
+    def metrics(self) -> dict:
+        """Cold start, warm latency and overhead over the jobs served."""
+        cold = [job["total_seconds"] for job in self.jobs if job["cold"]]
+        warm = sorted(job["total_seconds"] for job in self.jobs if not job["cold"])
+        overhead = [job["overhead_seconds"] for job in self.jobs if job["overhead_seconds"] is not None]
+
+        def mean(values):
+            return round(sum(values) / len(values), 2) if values else None
+
+        return {
+            "boot_seconds": round(self.boot_seconds, 2) if self.boot_seconds is not None else None,
+            "cold_job_seconds": cold[0] if cold else None,
+            "cold_start_seconds": round(self.boot_seconds + cold[0], 2) if cold and self.boot_seconds else None,
+            "warm_jobs": len(warm),
+            "warm_mean_seconds": mean(warm),
+            "warm_p50_seconds": warm[len(warm) // 2] if warm else None,
+            "overhead_mean_seconds": mean(overhead),
+            "jobs": len(self.jobs),
+            "runs": self.runs,
+        }
+
+def comfyui_arguments(prompts: dict, profile: str) -> list:
+    """Extra ComfyUI flags: --highvram when every model of every workflow fits the tier cached."""
+    if not profile or profile not in {tier[0] for tier in MEMORY_TIERS}:
+        return []
+    for path in prompts:
+        tier = next(tier for tier in plan_memory(json.loads(path.read_text()))["tiers"] if tier["profile"] == profile)
+        if tier["verdict"] != "fits cached":
+            return []
+    return ["--highvram"]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve render jobs from a warm ComfyUI")
+    parser.add_argument("workflows", nargs="*", type=Path, default=[WORKFLOW_FILE],
+                        help="UI workflows or API prompts jobs can name (default: the archviz workflow)")
+    parser.add_argument("--job-api", help="Job API base URL (default: the RunPod worker environment)")
+    parser.add_argument("--server", default=COMFYUI_URL, help=f"ComfyUI URL (default: {COMFYUI_URL})")
+    parser.add_argument("--comfyui-command",
+                        help="Command starting ComfyUI (default: python main.py in COMFYUI_PATH); "
+                             "not started if --server already answers")
+    parser.add_argument("--profile", choices=sorted(PATCH_PROFILES), help="Patch workflows for a hardware profile")
+    parser.add_argument("--idle-seconds", type=float, default=DEFAULT_IDLE_SECONDS,
+                        help=f"Exit after this long without jobs; 0 = never (default: {DEFAULT_IDLE_SECONDS})")
+    parser.add_argument("--max-jobs", type=int, default=DEFAULT_MAX_JOBS,
+                        help=f"Jobs taken per round (default: {DEFAULT_MAX_JOBS})")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH,
+                        help=f"Largest latent batch when coalescing (default: {DEFAULT_MAX_BATCH})")
+    parser.add_argument("--in-flight", type=int, default=2, help="Prompts queued in ComfyUI at once (default: 2)")
+    parser.add_argument("--metrics", type=Path, help="Write the latency summary to this JSON file on exit")
+    args = parser.parse_args(argv)
+
+    started = time.monotonic()
+    try:
+        api = JobAPI(args.job_api)
+        workflows = {path.stem: load_prompt(path, args.profile) for path in args.workflows}
+    except (ValueError, OSError, WorkflowError) as e:
+        print(f"Error: {e}")
+        return 1
+
+    client = ComfyClient(args.server)
+    worker = Worker(client, workflows, max(1, args.max_batch), max(1, args.in_flight))
+    process = None
+    try:
+        client.get_json("/system_stats")
+        print(f"Using running ComfyUI at {args.server}")
+    except ComfyUIError:
+        if args.comfyui_command:
+            command = shlex.split(args.comfyui_command)
+        else:
+            port = args.server.rsplit(":", 1)[-1].rstrip("/")
+            command = [sys.executable, "main.py", "--listen", "127.0.0.1", "--port", port, "--disable-auto-launch"]
+            command += comfyui_arguments([path for path in args.workflows if "nodes" in json.loads(path.read_text())],
+                                         args.profile)
+        try:
+            process, _ = boot_comfyui(command, COMFYUI_PATH if not args.comfyui_command else Path.cwd(), client)
+        except ComfyUIError as e:
+            print(f"Error: {e}")
+            return 1
+        # Cold start counts from the worker's own start
+        worker.boot_seconds = time.monotonic() - started
+        print(f"ComfyUI ready in {worker.boot_seconds:.1f}s")
+
+    idle_since = time.monotonic()
+    try:
+        while True:
+            taken = []
+            while len(taken) < args.max_jobs:
+                try:
+                    job = api.take()
+                except (urllib.error.URLError, OSError, ValueError) as e:
+                    print(f"Warning: job API: {e}")
+                    job = None
+                if job is None:
+                    break
+                taken.append((job, time.monotonic()))
+            if not taken:
+                if args.idle_seconds and time.monotonic() - idle_since > args.idle_seconds:
+                    print(f"Idle for {args.idle_seconds:.0f}s, exiting")
+                    break
+                time.sleep(TAKE_INTERVAL)
+                continue
+
+            print(f"Serving {len(taken)} jobs")
+            try:
+                results = worker.serve(taken)
+            except Exception as e:
+                # Never leave taken jobs in progress: fail the whole round
+                print(f"Error: round failed: {e!r}")
+                results = {job["id"]: {"error": f"worker error: {e}"} for job, _ in taken}
+            for job_id, result in results.items():
+                if "error" in result:
+                    print(f"  [failed] {job_id}: {result['error']}")
+                else:
+                    timings = result["output"]["timings"]
+                    print(f"  [ok] {job_id} in {timings['total_seconds']:.1f}s"
+                          f"{' (cold)' if timings['cold'] else ''}, batch of {timings['batch']}")
+                try:
+                    api.done(job_id, result)
+                except (urllib.error.URLError, OSError) as e:
+                    print(f"Warning: could not post result of {job_id}: {e}")
+            idle_since = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    metrics = worker.metrics()
+    print("Worker metrics:")
+    for key, value in metrics.items():
+        print(f"  {key}: {value}")
+    if args.metrics:
+        args.metrics.write_text(json.dumps(metrics, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
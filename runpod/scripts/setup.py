@@ -4,14 +4,21 @@ RunPod Setup Script for PH's Archviz ComfyUI Workflow
 Uses huggingface_hub API directly (no CLI dependency)
 
 This script handles the complete setup:
-1. Downloads all 16 models (~49 GB) with SHA256 verification
+1. Downloads all 16 models (~49 GB) concurrently with SHA256 verification
 2. Creates extra_model_paths.yaml for ComfyUI
 3. Creates symlinks for custom nodes with hardcoded paths
 4. Downloads the workflow JSON
+5. Checks every node type and model the workflow uses is installed
 
 Usage:
     wget -O /workspace/setup.py https://raw.githubusercontent.com/wiremarrow/luma/main/runpod/scripts/setup.py
     python3 /workspace/setup.py
+    python3 /workspace/setup.py --jobs 6     # more concurrent model downloads
+    python3 /workspace/setup.py --verify     # re-hash all models in parallel
+    python3 /workspace/setup.py --verify quick   # header + sampled-chunk check
+    python3 /workspace/setup.py --plan       # dry run: what would setup do?
+    python3 /workspace/setup.py --update-nodes   # move custom nodes to latest commits
+    python3 /workspace/setup.py --preflight  # check the workflow's nodes and models only
 
 Prerequisites:
     - HuggingFace login for gated models (Flux VAE):
@@ -19,11 +26,26 @@ Prerequisites:
     - Accept license at: https://huggingface.co/black-forest-labs/FLUX.1-schnell
 """
 
+import argparse
+import ast
+import asyncio
+import errno
+import fcntl
 import hashlib
+import json
+import mmap
 import os
 import shutil
+import struct
 import subprocess
 import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 
@@ -43,10 +65,6 @@ def ensure_huggingface_hub():
         ])
         return True
 
-ensure_huggingface_hub()
-
-from huggingface_hub import hf_hub_download, snapshot_download
-
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
@@ -54,7 +72,38 @@ from huggingface_hub import hf_hub_download, snapshot_download
 VOLUME_PATH = Path("/workspace")
 MODELS_PATH = VOLUME_PATH / "models"
 LOG_FILE = VOLUME_PATH / "download_log.txt"
-MARKER_FILE = VOLUME_PATH / ".models_downloaded"
+REPORT_FILE = VOLUME_PATH / "setup_report.json"           # Timing report of the last run
+REPORT_HISTORY_FILE = VOLUME_PATH / "setup_reports.jsonl"  # One line per run
+PLAN_FILE = VOLUME_PATH / "setup_plan.json"                # Written by --plan
+VARIANTS_FILE = VOLUME_PATH / "model_variants.json"        # Written by select_variants.py
+# Custom node commits: every node in CUSTOM_NODES is checked out at exactly
+# the commit recorded here (generated on first run, refreshed by --update-nodes)
+NODE_LOCK_FILE = VOLUME_PATH / "custom_nodes.lock.json"
+NODE_SYNC_WORKERS = 8
+
+# Per-model record of verified files: path, stat signature and SHA256.
+# A file whose size/mtime/inode still match its entry is trusted without
+# re-hashing; anything else is re-verified or downloaded again.
+LEDGER_FILE = VOLUME_PATH / ".model_ledger.json"
+
+# Content-addressed model store: every verified model is kept once under
+# blobs/sha256/<hash> and each layout path is a hardlink/reflink/symlink to it
+BLOB_STORE = VOLUME_PATH / "blobs" / "sha256"
+
+# Concurrent model downloads (override with --jobs)
+DEFAULT_DOWNLOAD_WORKERS = 4
+
+# Size units for the manifest
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# Segmented HTTP downloads: each file is fetched as SEGMENT_SIZE byte ranges
+# over DOWNLOAD_CONNECTIONS connections into "<file>.part", with progress
+# journaled to "<file>.part.json" so an interrupted download resumes
+DOWNLOAD_CONNECTIONS = 4
+SEGMENT_SIZE = 32 * MB
+DOWNLOAD_RETRIES = 3
+HTTP_TIMEOUT = 60
 
 # Terminal colors
 RED = "\033[0;31m"
@@ -66,6 +115,14 @@ NC = "\033[0m"  # No Color
 # =============================================================================
 # MODEL MANIFEST
 # All 16 models with their source repos, files, destinations, and SHA256 hashes
+# "size" is the approximate download size, used for scheduling and planning
+#
+# Entries with "variants" have alternative quantizations: each variant
+# overrides fields of the entry ("loader" is the node type that loads it if
+# the workflow's does not). VARIANTS_FILE, written by select_variants.py for
+# a GPU tier, picks the variant to download. A variant is only used once its
+# SHA256 is pinned (the LFS hash on its Hugging Face file page); until then
+# (hash None) it is skipped and the default is downloaded instead.
 # =============================================================================
 
 MODEL_MANIFEST = {
@@ -81,6 +138,7 @@ MODEL_MANIFEST = {
                 "file": "ae.safetensors",
                 "dest": "vae",
                 "hash": "afc8e28272cd15db3919bacdb6918ce9c1ed22e96cb12c4d5ed0fba823529e38",
+                "size": 320 * MB,
             },
             {
                 "name": "CLIP-L",
@@ -88,6 +146,7 @@ MODEL_MANIFEST = {
                 "file": "clip_l.safetensors",
                 "dest": "clip",
                 "hash": "660c6f5b1abae9dc498ac2d21e1347d2abdb0cf6c0c0c8576cd796491d9a6cdd",
+                "size": 235 * MB,
             },
             {
                 "name": "Florence-2-large",
@@ -96,6 +155,7 @@ MODEL_MANIFEST = {
                 "dest": "LLM/Florence-2-large",
                 "dest_is_absolute": True,  # Relative to VOLUME_PATH, not MODELS_PATH
                 "hash": "4f38ce741c6b71188fe2b3419a55e11917a8a7b321ae2e63c61da0191b0ebad7",
+                "size": int(1.5 * GB),
                 "hash_file": "model.safetensors",  # File to verify within repo
             },
         ],
@@ -112,6 +172,7 @@ MODEL_MANIFEST = {
                 "file": "diffusers_xl_canny_full.safetensors",
                 "dest": "controlnet",
                 "hash": "80664d80e3f233371cb6921110d0a6b7a40c01571905463f9dde5637e7894ed3",
+                "size": int(2.3 * GB),
             },
             {
                 "name": "ControlNet Depth",
@@ -119,6 +180,7 @@ MODEL_MANIFEST = {
                 "file": "diffusers_xl_depth_full.safetensors",
                 "dest": "controlnet",
                 "hash": "8ba4dfaa1958f1f68e5dc7f9839f9ef4e153aef0d330291e5cf966c925f97477",
+                "size": int(2.3 * GB),
             },
             {
                 "name": "ControlNet OpenPose",
@@ -126,6 +188,7 @@ MODEL_MANIFEST = {
                 "file": "thibaud_xl_openpose.safetensors",
                 "dest": "controlnet",
                 "hash": "9e070426568a3c60c128ffb98c66cdc7a0ea21d0d8abb86f73564aaf2e0c6f42",
+                "size": int(2.3 * GB),
             },
             {
                 "name": "Depth Anything V2",
@@ -133,6 +196,7 @@ MODEL_MANIFEST = {
                 "file": "depth_anything_v2_vitl.pth",
                 "dest": "depth",
                 "hash": "a7ea19fa0ed99244e67b624c72b8580b7e9553043245905be58796a608eb9345",
+                "size": int(1.2 * GB),
                 "format_warning": ".pth format",
             },
             {
@@ -142,6 +206,7 @@ MODEL_MANIFEST = {
                 "file": "depth_anything_vitl14.pth",
                 "dest": "depth",
                 "hash": "6c6a383e33e51c5fdfbf31e7ebcda943973a9e6a1cbef1564afe58d7f2e8fe63",
+                "size": int(1.2 * GB),
                 "format_warning": ".pth format",
             },
         ],
@@ -158,7 +223,44 @@ MODEL_MANIFEST = {
                 "file": "flux1-dev-Q8_0.gguf",
                 "dest": "unet",
                 "hash": "129032f32224bf7138f16e18673d8008ba5f84c1ec74063bf4511a8bb4cf553d",
+                "size": 12 * GB,
                 "format_warning": ".gguf format (city96)",
+                "variant": "Q8_0",
+                "loader": "UnetLoaderGGUF",
+                "variants": [
+                    {
+                        "variant": "Q4_K_S",
+                        "name": "Flux1-dev Q4_K_S",
+                        "file": "flux1-dev-Q4_K_S.gguf",
+                        "hash": None,
+                        "size": int(6.8 * GB),
+                    },
+                    {
+                        "variant": "Q5_K_S",
+                        "name": "Flux1-dev Q5_K_S",
+                        "file": "flux1-dev-Q5_K_S.gguf",
+                        "hash": None,
+                        "size": int(8.3 * GB),
+                    },
+                    {
+                        "variant": "Q6_K",
+                        "name": "Flux1-dev Q6_K",
+                        "file": "flux1-dev-Q6_K.gguf",
+                        "hash": None,
+                        "size": int(9.9 * GB),
+                    },
+                    {
+                        # Gated: accept the license on the repo page first
+                        "variant": "bf16",
+                        "name": "Flux1-dev bf16",
+                        "repo": "black-forest-labs/FLUX.1-dev",
+                        "file": "flux1-dev.safetensors",
+                        "hash": None,
+                        "size": int(23.8 * GB),
+                        "loader": "UNETLoader",
+                        "format_warning": None,
+                    },
+                ],
             },
             {
                 "name": "T5-XXL Q8_0",
@@ -166,7 +268,35 @@ MODEL_MANIFEST = {
                 "file": "t5-v1_1-xxl-encoder-Q8_0.gguf",
                 "dest": "clip",
                 "hash": "9ec60f6028534b7fe5af439fcb535d75a68592a9ca3fcdeb175ef89e3ee99825",
+                "size": int(4.7 * GB),
                 "format_warning": ".gguf format (city96)",
+                "variant": "Q8_0",
+                "variants": [
+                    {
+                        "variant": "Q4_K_M",
+                        "name": "T5-XXL Q4_K_M",
+                        "file": "t5-v1_1-xxl-encoder-Q4_K_M.gguf",
+                        "hash": None,
+                        "size": int(2.9 * GB),
+                    },
+                    {
+                        "variant": "Q6_K",
+                        "name": "T5-XXL Q6_K",
+                        "file": "t5-v1_1-xxl-encoder-Q6_K.gguf",
+                        "hash": None,
+                        "size": int(3.9 * GB),
+                    },
+                    {
+                        # DualCLIPLoaderGGUF loads safetensors too
+                        "variant": "fp16",
+                        "name": "T5-XXL fp16",
+                        "repo": "comfyanonymous/flux_text_encoders",
+                        "file": "t5xxl_fp16.safetensors",
+                        "hash": None,
+                        "size": int(9.8 * GB),
+                        "format_warning": None,
+                    },
+                ],
             },
             {
                 "name": "IP-Adapter Plus",
@@ -174,7 +304,7 @@ MODEL_MANIFEST = {
                 "file": "sdxl_models/ip-adapter-plus_sdxl_vit-h.safetensors",
                 "dest": "ipadapter",
                 "hash": "3f5062b8400c94b7159665b21ba5c62acdcd7682262743d7f2aefedef00e6581",
-                "flatten_from": "sdxl_models",  # Move from nested dir
+                "size": 808 * MB,
             },
             {
                 "name": "CLIP Vision",
@@ -182,7 +312,7 @@ MODEL_MANIFEST = {
                 "file": "clip_vision/CLIP-ViT-H-14-laion2B-s32B-b79K.safetensors",
                 "dest": "clip_vision",
                 "hash": "6ca9667da1ca9e0b0f75e46bb030f7e011f44f86cbfb8d5a36590fcd7507b030",
-                "flatten_from": "clip_vision",  # Move from nested dir
+                "size": int(2.4 * GB),
             },
             {
                 "name": "RealVisXL V4.0",
@@ -190,6 +320,7 @@ MODEL_MANIFEST = {
                 "file": "RealVisXL_V4.0.safetensors",
                 "dest": "checkpoints",
                 "hash": "912c9dc74f5855175c31a7993f863a043ac8dcc31732b324cd05d75cd7e16844",
+                "size": int(6.5 * GB),
             },
             {
                 "name": "RealVisXL V5.0 Lightning",
@@ -197,6 +328,7 @@ MODEL_MANIFEST = {
                 "file": "RealVisXL_V5.0_Lightning_fp16.safetensors",
                 "dest": "checkpoints",
                 "hash": "fabcadd9330dcc4f9702063428d40b9d4d07168d8acefc819b8d1d9db466b3ec",
+                "size": int(6.5 * GB),
                 "rename_to": "realvisxlV50_v50LightningBakedvae.safetensors",
             },
             {
@@ -205,7 +337,7 @@ MODEL_MANIFEST = {
                 "file": "ESRGAN/4x-UltraSharp.pth",
                 "dest": "upscale_models",
                 "hash": "a5812231fc936b42af08a5edba784195495d303d5b3248c24489ef0c4021fe01",
-                "flatten_from": "ESRGAN",
+                "size": 64 * MB,
                 "format_warning": ".pth format",
             },
             {
@@ -214,6 +346,7 @@ MODEL_MANIFEST = {
                 "file": "sam2.1_hiera_base_plus.safetensors",
                 "dest": "sam2",
                 "hash": "eb4b5f725c8b68205aa05bbe6b27efc628b18b4b9c7b9bb8218991b86b9a4932",
+                "size": 308 * MB,
             },
         ],
     },
@@ -223,44 +356,219 @@ MODEL_MANIFEST = {
 # LOGGING
 # =============================================================================
 
+# Download workers log from several threads. Each worker buffers its lines
+# and flushes them as one block, so per-model output is never interleaved.
+_log_lock = threading.RLock()
+_log_local = threading.local()
+
 def log_to_file(message: str):
-    """Append message to log file."""
-    with open(LOG_FILE, "a") as f:
+    """Append message to log file (skipped while the volume is not mounted, e.g. for --plan)."""
+    if not LOG_FILE.parent.exists():
+        return
+    with _log_lock, open(LOG_FILE, "a") as f:
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         f.write(f"[{timestamp}] {message}\n")
 
+def _emit(line: str, message: str = None):
+    """Print a console line (and log message), or buffer it for the current worker."""
+    buffer = getattr(_log_local, "buffer", None)
+    if buffer is not None:
+        buffer.append((line, message))
+        return
+    with _log_lock:
+        print(line)
+        if message is not None:
+            log_to_file(message)
+
+@contextmanager
+def buffered_log():
+    """Collect log output of the current thread and emit it as one block on exit."""
+    _log_local.buffer = []
+    try:
+        yield
+    finally:
+        lines, _log_local.buffer = _log_local.buffer, None
+        with _log_lock:
+            for line, message in lines:
+                _emit(line, message)
+
 def log_info(message: str):
-    print(f"{GREEN}[INFO]{NC} {message}")
-    log_to_file(f"INFO: {message}")
+    _emit(f"{GREEN}[INFO]{NC} {message}", f"INFO: {message}")
 
 def log_warn(message: str):
-    print(f"{YELLOW}[WARN]{NC} {message}")
-    log_to_file(f"WARN: {message}")
+    _emit(f"{YELLOW}[WARN]{NC} {message}", f"WARN: {message}")
 
 def log_error(message: str):
-    print(f"{RED}[ERROR]{NC} {message}")
-    log_to_file(f"ERROR: {message}")
+    _emit(f"{RED}[ERROR]{NC} {message}", f"ERROR: {message}")
 
 def log_section(title: str):
-    print(f"\n{BLUE}{'=' * 68}{NC}")
-    print(f"{BLUE}  {title}{NC}")
-    print(f"{BLUE}{'=' * 68}{NC}\n")
+    _emit(f"\n{BLUE}{'=' * 68}{NC}")
+    _emit(f"{BLUE}  {title}{NC}")
+    _emit(f"{BLUE}{'=' * 68}{NC}\n")
+
+# =============================================================================
+# INSTRUMENTATION
+# =============================================================================
+
+# Per-phase and per-item timings of this run, written to REPORT_FILE
+REPORT = {"phases": [], "items": []}
+_report_lock = threading.Lock()
+_metrics = threading.local()
+
+def phase_failed(result) -> bool:
+    """Whether a phase body's return value means failure: False or a non-zero exit code."""
+    if isinstance(result, bool):
+        return not result
+    return isinstance(result, int) and result != 0
+
+@contextmanager
+def timed_phase(name: str):
+    """Time a setup phase. The yielded dict can be annotated (e.g. status="failed")."""
+    phase = {"name": name, "status": "ok", "started_at": datetime.now().isoformat(timespec="seconds")}
+    start = time.monotonic()
+    try:
+        yield phase
+    except BaseException:
+        phase["status"] = "error"
+        raise
+    finally:
+        phase["seconds"] = round(time.monotonic() - start, 2)
+        with _report_lock:
+            REPORT["phases"].append(phase)
+
+def record_item(phase: str, name: str, seconds: float, nbytes: int = 0, retries: int = 0, **fields):
+    """Record the timing of one unit of work (a model, a repository, a pip run)."""
+    item = {"phase": phase, "name": name, "seconds": round(seconds, 2), "bytes": nbytes, "retries": retries}
+    if nbytes and seconds > 0:
+        item["mb_per_s"] = round(nbytes / MB / seconds, 1)
+    item.update(fields)
+    with _report_lock:
+        REPORT["items"].append(item)
+
+@contextmanager
+def timed_item(phase: str, name: str):
+    """
+    Time one unit of work on the current thread.
+
+    The download engine adds transferred bytes and retries to the active
+    item; the yielded dict can carry extra fields such as "action".
+    """
+    item = {"bytes": 0, "retries": 0}
+    _metrics.item = item
+    start = time.monotonic()
+    try:
+        yield item
+    finally:
+        _metrics.item = None
+        fields = dict(item)
+        record_item(phase, name, time.monotonic() - start, nbytes=fields.pop("bytes"), **fields)
+
+def current_item():
+    """The item being timed on the current thread (None outside timed_item)."""
+    return getattr(_metrics, "item", None)
+
+def _count_transfer(item: dict, nbytes: int = 0, retries: int = 0):
+    """Attribute transferred bytes/retries to an item from any thread."""
+    if item is not None:
+        with _report_lock:
+            item["bytes"] += nbytes
+            item["retries"] += retries
+
+def _host_info() -> dict:
+    """Pod identity for comparing runs across GPU types and datacenters."""
+    import platform
+
+    info = {"hostname": platform.node(), "python": platform.python_version(), "cpus": os.cpu_count()}
+    for var in ("RUNPOD_POD_ID", "RUNPOD_DC_ID", "RUNPOD_GPU_COUNT"):
+        if os.environ.get(var):
+            info[var.lower()] = os.environ[var]
+    try:
+        result = subprocess.run(
+            ["nvidia-smi", "--query-gpu=name", "--format=csv,noheader"],
+            capture_output=True, text=True, timeout=10,
+        )
+        if result.returncode == 0:
+            info["gpus"] = result.stdout.strip().splitlines()
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    return info
+
+def write_report(started: float, command: str, exit_code) -> dict:
+    """Write the JSON timing report of this run and append it to the history."""
+    report = {
+        "command": command,
+        "finished_at": datetime.now().isoformat(timespec="seconds"),
+        "total_seconds": round(time.monotonic() - started, 2),
+        "exit_code": exit_code,
+        "host": _host_info(),
+        "io": dict(IO_COUNTERS),
+        **REPORT,
+    }
+    try:
+        REPORT_FILE.write_text(json.dumps(report, indent=2))
+        with open(REPORT_HISTORY_FILE, "a") as f:
+            f.write(json.dumps(report) + "\n")
+    except OSError as e:
+        log_warn(f"Could not write timing report: {e}")
+    return report
+
+def print_report_summary(report: dict):
+    """Print the per-phase timing table and the slowest items."""
+    log_section("Timing Summary")
+    print(f"  {'Phase':<28} {'Seconds':>9}  Status")
+    print(f"  {'-' * 28} {'-' * 9}  {'-' * 8}")
+    for phase in report["phases"]:
+        print(f"  {phase['name']:<28} {phase['seconds']:>9.1f}  {phase['status']}")
+    print(f"  {'total':<28} {report['total_seconds']:>9.1f}")
+
+    downloads = [item for item in report["items"] if item["phase"] == "models" and item["bytes"]]
+    if downloads:
+        total_bytes = sum(item["bytes"] for item in downloads)
+        print(f"\n  Downloaded {total_bytes / GB:.2f} GB in {len(downloads)} files, "
+              f"{sum(item['retries'] for item in downloads)} retries")
+
+    slowest = sorted(report["items"], key=lambda item: -item["seconds"])[:5]
+    if slowest:
+        print("\n  Slowest items:")
+        for item in slowest:
+            rate = f"{item['mb_per_s']:.1f} MB/s" if "mb_per_s" in item else ""
+            print(f"  {item['seconds']:>9.1f}s {rate:>13}  {item['phase']:<14} {item['name']}")
+    print()
+    log_info(f"Timing report: {REPORT_FILE}")
 
 # =============================================================================
 # HASH VERIFICATION
 # =============================================================================
 
+# Large reads: hashing 8 KB at a time is dominated by per-call latency on
+# network volumes
+HASH_CHUNK_SIZE = 64 * MB
+
+def sha256_file(path: Path, chunk_size: int = HASH_CHUNK_SIZE) -> str:
+    """SHA256 of a file using a memory map read in large sequential chunks."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return sha256.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mm)
+            try:
+                for offset in range(0, size, chunk_size):
+                    sha256.update(view[offset:offset + chunk_size])
+            finally:
+                view.release()
+    return sha256.hexdigest()
+
 def verify_hash(file_path: Path, expected_hash: str) -> bool:
     """Verify SHA256 hash of a file."""
     if not expected_hash:
         return True
 
-    sha256 = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            sha256.update(chunk)
-
-    actual_hash = sha256.hexdigest()
+    actual_hash = sha256_file(file_path)
+    _count_io(read=file_path.stat().st_size)
 
     if actual_hash == expected_hash:
         log_info(f"Hash verified: {file_path.name}")
@@ -271,6 +579,802 @@ def verify_hash(file_path: Path, expected_hash: str) -> bool:
         log_error(f"  Got:      {actual_hash}")
         return False
 
+# =============================================================================
+# STRUCTURAL CHECKS
+# =============================================================================
+
+# Sampled-chunk digest: fixed positions derived from the file size only
+SAMPLE_CHUNKS = 16
+SAMPLE_CHUNK_SIZE = 1 * MB
+
+# Headers larger than this are treated as corrupt rather than parsed
+MAX_HEADER_SIZE = 256 * MB
+
+# Bytes per element of safetensors dtypes
+SAFETENSORS_DTYPE_SIZES = {
+    "BOOL": 1, "U8": 1, "I8": 1, "F8_E4M3": 1, "F8_E5M2": 1,
+    "U16": 2, "I16": 2, "F16": 2, "BF16": 2,
+    "U32": 4, "I32": 4, "F32": 4,
+    "U64": 8, "I64": 8, "F64": 8,
+}
+
+# ggml tensor types: (elements per block, bytes per block)
+GGML_BLOCK_SIZES = {
+    0: (1, 4),        # F32
+    1: (1, 2),        # F16
+    2: (32, 18),      # Q4_0
+    3: (32, 20),      # Q4_1
+    6: (32, 22),      # Q5_0
+    7: (32, 24),      # Q5_1
+    8: (32, 34),      # Q8_0
+    9: (32, 36),      # Q8_1
+    10: (256, 84),    # Q2_K
+    11: (256, 110),   # Q3_K
+    12: (256, 144),   # Q4_K
+    13: (256, 176),   # Q5_K
+    14: (256, 210),   # Q6_K
+    15: (256, 292),   # Q8_K
+    16: (256, 66),    # IQ2_XXS
+    17: (256, 74),    # IQ2_XS
+    18: (256, 98),    # IQ3_XXS
+    19: (256, 50),    # IQ1_S
+    20: (32, 18),     # IQ4_NL
+    21: (256, 110),   # IQ3_S
+    22: (256, 82),    # IQ2_S
+    23: (256, 136),   # IQ4_XS
+    24: (1, 1),       # I8
+    25: (1, 2),       # I16
+    26: (1, 4),       # I32
+    27: (1, 8),       # I64
+    28: (1, 8),       # F64
+    29: (256, 56),    # IQ1_M
+    30: (1, 2),       # BF16
+}
+
+# GGUF metadata value types with a fixed size (struct format)
+GGUF_SCALAR_FORMATS = {
+    0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i",
+    6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d",
+}
+GGUF_TYPE_STRING = 8
+GGUF_TYPE_ARRAY = 9
+
+class StructureError(Exception):
+    """A model file whose header does not describe its contents."""
+
+def _read_exact(f, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise StructureError("header truncated")
+    return data
+
+def _unpack(f, fmt: str):
+    return struct.unpack(fmt, _read_exact(f, struct.calcsize(fmt)))[0]
+
+def _check_extents(extents: list, data_size: int, allow_gaps: bool):
+    """Check (name, begin, end) byte ranges lie inside the data section without overlapping."""
+    position = 0
+    for name, begin, end in sorted(extents, key=lambda extent: extent[1]):
+        if end > data_size:
+            raise StructureError(f"tensor {name} ends at {end:,}, past the data section ({data_size:,} bytes)")
+        if begin < position or (begin > position and not allow_gaps):
+            raise StructureError(f"tensor {name} at {begin:,} overlaps or leaves a hole")
+        position = end
+    if position != data_size and not allow_gaps:
+        raise StructureError(f"data section has {data_size - position:,} unindexed bytes")
+
+def check_safetensors(f, size: int) -> int:
+    """
+    Validate a safetensors header against the file size.
+
+    Layout: 8-byte little-endian header length, JSON header mapping tensor
+    names to dtype/shape/data_offsets, then the byte buffer, which the
+    format requires to be fully indexed without holes.
+
+    Returns:
+        Number of tensors
+    """
+    header_size = _unpack(f, "<Q")
+    if header_size > min(size - 8, MAX_HEADER_SIZE):
+        raise StructureError(f"header length {header_size:,} exceeds the file")
+    try:
+        header = json.loads(_read_exact(f, header_size))
+    except ValueError as e:
+        raise StructureError(f"header is not valid JSON: {e}")
+
+    extents = []
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        begin, end = info["data_offsets"]
+        if not 0 <= begin <= end:
+            raise StructureError(f"tensor {name} has invalid offsets {begin}..{end}")
+        element_size = SAFETENSORS_DTYPE_SIZES.get(info["dtype"])
+        if element_size is not None:
+            expected = element_size
+            for dim in info["shape"]:
+                expected *= dim
+            if end - begin != expected:
+                raise StructureError(f"tensor {name} spans {end - begin:,} bytes, shape needs {expected:,}")
+        extents.append((name, begin, end))
+
+    _check_extents(extents, size - 8 - header_size, allow_gaps=False)
+    return len(extents)
+
+def _skip_gguf_value(f, value_type: int):
+    """Read past one GGUF metadata value."""
+    if value_type in GGUF_SCALAR_FORMATS:
+        _read_exact(f, struct.calcsize(GGUF_SCALAR_FORMATS[value_type]))
+    elif value_type == GGUF_TYPE_STRING:
+        f.seek(_unpack(f, "<Q"), os.SEEK_CUR)
+    elif value_type == GGUF_TYPE_ARRAY:
+        item_type, count = _unpack(f, "<I"), _unpack(f, "<Q")
+        if item_type in GGUF_SCALAR_FORMATS:
+            f.seek(count * struct.calcsize(GGUF_SCALAR_FORMATS[item_type]), os.SEEK_CUR)
+        else:
+            for _ in range(count):
+                _skip_gguf_value(f, item_type)
+    else:
+        raise StructureError(f"unknown metadata value type {value_type}")
+
+def check_gguf(f, size: int) -> int:
+    """
+    Validate a GGUF file's metadata and tensor table against the file size.
+
+    Layout: magic, version, tensor and metadata counts, metadata key/values,
+    tensor infos (name, dims, ggml type, offset), padding to the alignment,
+    then the tensor data. Each tensor's extent follows from its dims and
+    type's block size and must lie inside the file.
+
+    Returns:
+        Number of tensors
+    """
+    if _read_exact(f, 4) != b"GGUF":
+        raise StructureError("missing GGUF magic")
+    version = _unpack(f, "<I")
+    if version not in (2, 3):
+        raise StructureError(f"unsupported GGUF version {version}")
+    tensor_count, kv_count = _unpack(f, "<Q"), _unpack(f, "<Q")
+
+    alignment = 32
+    for _ in range(kv_count):
+        key_length = _unpack(f, "<Q")
+        if key_length > MAX_HEADER_SIZE:
+            raise StructureError("metadata key length exceeds the file")
+        key = _read_exact(f, key_length)
+        value_type = _unpack(f, "<I")
+        if key == b"general.alignment" and value_type == 4:
+            alignment = _unpack(f, "<I")
+        else:
+            _skip_gguf_value(f, value_type)
+        if f.tell() > size:
+            raise StructureError("metadata runs past the end of the file")
+
+    tensors = []
+    for _ in range(tensor_count):
+        name_length = _unpack(f, "<Q")
+        if name_length > MAX_HEADER_SIZE:
+            raise StructureError("tensor name length exceeds the file")
+        name = _read_exact(f, name_length).decode("utf-8", "replace")
+        n_dims = _unpack(f, "<I")
+        dims = struct.unpack(f"<{n_dims}Q", _read_exact(f, 8 * n_dims))
+        tensor_type, offset = _unpack(f, "<I"), _unpack(f, "<Q")
+        tensors.append((name, dims, tensor_type, offset))
+
+    data_start = -(-f.tell() // alignment) * alignment
+    if data_start > size:
+        raise StructureError("tensor table runs past the end of the file")
+
+    extents = []
+    for name, dims, tensor_type, offset in tensors:
+        if offset % alignment:
+            raise StructureError(f"tensor {name} is not aligned to {alignment}")
+        elements = 1
+        for dim in dims:
+            elements *= dim
+        block_elements, block_bytes = GGML_BLOCK_SIZES.get(tensor_type, (1, 0))
+        if elements % block_elements:
+            raise StructureError(f"tensor {name} is not a whole number of blocks")
+        extents.append((name, offset, offset + elements // block_elements * block_bytes))
+
+    # Tensors are padded to the alignment, so gaps between them are expected
+    _check_extents(extents, size - data_start, allow_gaps=True)
+    return len(extents)
+
+STRUCTURE_CHECKS = {
+    ".safetensors": check_safetensors,
+    ".gguf": check_gguf,
+}
+
+def check_structure(path: Path) -> str:
+    """
+    Parse a model file's header and check every tensor lies inside the file.
+
+    Reads only the header (kilobytes to a few MB), so a truncated or
+    garbled download is caught without reading the data.
+
+    Returns:
+        Short description of what was checked
+
+    Raises:
+        StructureError: If the header does not match the file
+    """
+    checker = STRUCTURE_CHECKS.get(path.suffix)
+    if checker is None:
+        return "no header check for this format"
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        try:
+            tensors = checker(f, size)
+        except (KeyError, TypeError, ValueError, struct.error) as e:
+            raise StructureError(f"malformed header: {e!r}")
+    return f"{tensors} tensors"
+
+def verify_file(path: Path, expected_hash: str) -> bool:
+    """Verify a file against its pinned hash; a file without one never verifies."""
+    if not expected_hash:
+        log_error(f"No pinned SHA256 for {path.name}; pin it in MODEL_MANIFEST")
+        return False
+    return verify_hash(path, expected_hash)
+
+def sample_digest(path: Path, samples: int = SAMPLE_CHUNKS, chunk_size: int = SAMPLE_CHUNK_SIZE) -> str:
+    """
+    SHA256 over the file size and a fixed set of chunks.
+
+    Chunks are spread evenly from the first to the last byte, so the
+    positions depend only on the file size and the digest is reproducible.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        sha256.update(struct.pack("<Q", size))
+        if size <= samples * chunk_size:
+            offsets = [0]
+            chunk_size = size
+        else:
+            offsets = [i * (size - chunk_size) // (samples - 1) for i in range(samples)]
+        for offset in offsets:
+            sha256.update(os.pread(f.fileno(), chunk_size, offset))
+    return sha256.hexdigest()
+
+def quick_check(entry: dict, path: Path) -> str:
+    """
+    Fast integrity check of a file against its ledger entry.
+
+    Returns:
+        None if the file passes, otherwise the reason it does not
+    """
+    if not entry or not entry.get("sample_sha256"):
+        return "no sampled digest recorded"
+    if path.stat().st_size != entry.get("size"):
+        return "size changed"
+    try:
+        check_structure(path)
+    except StructureError as e:
+        return str(e)
+    if sample_digest(path) != entry["sample_sha256"]:
+        return "sampled chunks differ"
+    return None
+
+# =============================================================================
+# MODEL LEDGER
+# =============================================================================
+
+_ledger_lock = threading.Lock()
+
+def load_ledger() -> dict:
+    """Load the model ledger, or return an empty one."""
+    try:
+        ledger = json.loads(LEDGER_FILE.read_text())
+    except (OSError, ValueError):
+        return {"version": 1, "models": {}}
+    ledger.setdefault("models", {})
+    return ledger
+
+def save_ledger(ledger: dict):
+    """Atomically write the model ledger."""
+    tmp_path = LEDGER_FILE.with_name(LEDGER_FILE.name + ".tmp")
+    tmp_path.write_text(json.dumps(ledger, indent=2, sort_keys=True))
+    os.replace(tmp_path, LEDGER_FILE)
+
+def stat_signature(path: Path) -> dict:
+    """Cheap identity of a file's contents: size, mtime and inode."""
+    st = path.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino}
+
+def model_check_path(model: dict) -> Path:
+    """The file whose hash identifies a manifest entry."""
+    if model.get("file") is None:
+        return model_dest_dir(model) / model.get("hash_file", "model.safetensors")
+    return model_dest_dir(model) / (model.get("rename_to") or Path(model["file"]).name)
+
+def record_model(ledger: dict, model: dict, path: Path, sha256: str):
+    """Record a verified file in the ledger and persist it."""
+    with _ledger_lock:
+        ledger["models"][model["name"]] = {
+            "path": str(path),
+            "sha256": sha256,
+            "sample_sha256": sample_digest(path),
+            "verified_at": datetime.now().isoformat(timespec="seconds"),
+            **stat_signature(path),
+        }
+        save_ledger(ledger)
+
+def forget_model(ledger: dict, model: dict):
+    """Drop a manifest entry from the ledger."""
+    with _ledger_lock:
+        if ledger["models"].pop(model["name"], None) is not None:
+            save_ledger(ledger)
+
+def ledger_matches(ledger: dict, model: dict, path: Path) -> bool:
+    """True if the ledger vouches for path: same file, unchanged stat, expected hash."""
+    entry = ledger["models"].get(model["name"])
+    if not entry or entry.get("path") != str(path):
+        return False
+    if model.get("hash") and entry.get("sha256") != model["hash"]:
+        return False
+    signature = stat_signature(path)
+    return all(entry.get(key) == value for key, value in signature.items())
+
+def check_model(model: dict, ledger: dict, rehash: bool = False) -> bool:
+    """
+    Check whether a manifest entry is already present and valid.
+
+    Files known to the ledger get the fast tier: their header is parsed
+    and a sampled digest compared, which accepts them in well under a
+    second even if the stat signature changed (e.g. after a volume copy).
+    Others, and any that fail the fast tier, are fully hashed and recorded;
+    invalid files are removed so they get downloaded again. With rehash,
+    every file is fully hashed.
+
+    Returns:
+        True if the model is present and verified, False if it must be downloaded
+    """
+    path = model_check_path(model)
+    if not path.exists():
+        forget_model(ledger, model)
+        return False
+
+    entry = ledger["models"].get(model["name"])
+    if not rehash and entry and entry.get("path") == str(path) and entry.get("sha256") == model.get("hash"):
+        if not entry.get("sample_sha256") and ledger_matches(ledger, model, path):
+            # Entry written before sampled digests: the stat signature vouches once
+            record_model(ledger, model, path, entry["sha256"])
+            entry = ledger["models"][model["name"]]
+        problem = quick_check(entry, path)
+        if problem is None:
+            if not ledger_matches(ledger, model, path):
+                record_model(ledger, model, path, entry["sha256"])
+            log_info(f"Verified (structure + sample): {path.name}")
+            return True
+        log_warn(f"Fast check failed for {path.name}: {problem}")
+
+    log_info(f"Re-verifying: {path.name}")
+    if verify_file(path, model.get("hash")):
+        record_model(ledger, model, path, model.get("hash"))
+        return True
+
+    log_warn(f"Removing invalid file: {path}")
+    blob = blob_path(model["hash"]) if model.get("hash") else None
+    if blob and blob.exists() and os.path.samefile(blob, path):
+        blob.unlink()
+    path.unlink()
+    forget_model(ledger, model)
+    return False
+
+# =============================================================================
+# BLOB STORE
+# =============================================================================
+
+# ioctl request number for FICLONE (copy-on-write clone on btrfs/XFS)
+FICLONE = 0x40049409
+
+def blob_path(sha256: str) -> Path:
+    """Location of a blob in the content-addressed store."""
+    return BLOB_STORE / sha256[:2] / sha256
+
+def _reflink(source: Path, target: Path):
+    """Create target as a copy-on-write clone of source (raises OSError if unsupported)."""
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            target.unlink(missing_ok=True)
+            raise
+
+def materialize(blob: Path, target: Path) -> str:
+    """
+    Make target refer to blob without copying data.
+
+    Tries a hardlink, then a reflink, then a symlink. The link is built
+    under a temporary name and renamed over target, so target is never
+    missing or half-written.
+
+    Returns:
+        "existing", "hardlink", "reflink" or "symlink"
+    """
+    if target.exists() and os.path.samefile(blob, target):
+        return "existing"
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = target.with_name(f".{target.name}.link")
+    tmp_path.unlink(missing_ok=True)
+
+    for kind in ("hardlink", "reflink", "symlink"):
+        try:
+            if kind == "hardlink":
+                os.link(blob, tmp_path)
+            elif kind == "reflink":
+                _reflink(blob, tmp_path)
+            else:
+                tmp_path.symlink_to(blob)
+            break
+        except OSError:
+            if kind == "symlink":
+                raise
+    os.replace(tmp_path, target)
+    return kind
+
+def ingest_blob(path: Path, sha256: str) -> str:
+    """
+    Move a verified file into the blob store and leave a link in its place.
+
+    If the store already holds the blob, the duplicate is replaced by a link.
+
+    Returns:
+        How path now refers to the blob (see materialize)
+    """
+    blob = blob_path(sha256)
+    if blob.exists():
+        return materialize(blob, path)
+
+    blob.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        # Same volume: the store simply gains a second name for the inode
+        os.link(path, blob)
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    shutil.move(str(path), str(blob))
+    return materialize(blob, path)
+
+def materialize_layout(root: Path) -> int:
+    """
+    Materialize the /workspace model layout under another root from the store.
+
+    Each verified model appears at the same path relative to root as it has
+    relative to VOLUME_PATH (e.g. root/models/unet/flux1-dev-Q8_0.gguf).
+    Full-repository entries (Florence-2) are linked as a directory, and
+    variants without a pinned hash as a file symlink.
+
+    Returns:
+        Number of models that could not be materialized
+    """
+    log_section(f"Materializing Model Layout: {root}")
+    missing = 0
+
+    for model in iter_manifest():
+        if model.get("file") is None or not model.get("hash"):
+            # Repositories, and variants whose hash is not pinned (not in the store)
+            source = model_dest_dir(model) if model.get("file") is None else model_check_path(model)
+            target = root / source.relative_to(VOLUME_PATH)
+            if not source.exists():
+                log_error(f"Not downloaded: {model['name']}")
+                missing += 1
+                continue
+            if not target.is_symlink():
+                target.parent.mkdir(parents=True, exist_ok=True)
+                target.symlink_to(source, target_is_directory=model.get("file") is None)
+            log_info(f"symlink   {target}")
+            continue
+
+        blob = blob_path(model["hash"])
+        if not blob.exists():
+            log_error(f"Not in blob store: {model['name']}")
+            missing += 1
+            continue
+        target = root / model_check_path(model).relative_to(VOLUME_PATH)
+        kind = materialize(blob, target)
+        log_info(f"{kind:<9} {target}")
+
+    return missing
+
+# =============================================================================
+# DOWNLOAD ENGINE
+# =============================================================================
+
+class _CrossHostRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follow redirects, dropping the HF token when the host changes (Hub -> CDN), as huggingface_hub does."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        redirected = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if redirected is not None and \
+                urllib.parse.urlsplit(newurl).hostname != urllib.parse.urlsplit(req.full_url).hostname:
+            redirected.remove_header("Authorization")
+        return redirected
+
+_HTTP_OPENER = urllib.request.build_opener(_CrossHostRedirectHandler())
+
+def _http_open(url: str, headers: dict = None, start: int = None, end: int = None):
+    """Open a GET request, optionally for the byte range start-end (inclusive)."""
+    request = urllib.request.Request(url, headers=dict(headers or {}))
+    request.add_header("User-Agent", "luma-setup/1.0")
+    if start is not None:
+        request.add_header("Range", f"bytes={start}-{'' if end is None else end}")
+    return _HTTP_OPENER.open(request, timeout=HTTP_TIMEOUT)
+
+def probe_url(url: str, headers: dict = None) -> dict:
+    """
+    Resolve redirects and find out whether a URL supports range requests.
+
+    Returns:
+        Dictionary with the final "url", total "size" (None if unknown),
+        "ranges" (True if byte ranges are honoured) and "etag"
+    """
+    with _http_open(url, headers, start=0, end=0) as response:
+        content_range = response.headers.get("Content-Range", "")
+        info = {
+            "url": response.geturl(),
+            "etag": response.headers.get("ETag"),
+            "size": None,
+            "ranges": False,
+        }
+        if response.status == 206 and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1]
+            if total.isdigit():
+                info["size"] = int(total)
+                info["ranges"] = True
+        elif response.headers.get("Content-Length"):
+            info["size"] = int(response.headers["Content-Length"])
+    return info
+
+def _read_journal(journal_path: Path, identity: dict) -> set:
+    """Return completed segment indices, or an empty set if the journal is stale."""
+    try:
+        journal = json.loads(journal_path.read_text())
+    except (OSError, ValueError):
+        return set()
+    if any(journal.get(key) != value for key, value in identity.items()):
+        return set()
+    return set(journal.get("done", []))
+
+def _write_journal(journal_path: Path, identity: dict, done: set):
+    """Atomically persist the set of completed segments."""
+    tmp_path = journal_path.with_name(journal_path.name + ".tmp")
+    tmp_path.write_text(json.dumps({**identity, "done": sorted(done)}))
+    os.replace(tmp_path, journal_path)
+
+class HashMismatchError(IOError):
+    """Downloaded bytes do not match the expected SHA256."""
+
+# Bytes fetched from the network and written to the volume vs. bytes read back
+# from the volume for hashing (only resumed segments need reading back)
+IO_COUNTERS = {"bytes_written": 0, "bytes_read": 0}
+_io_lock = threading.Lock()
+
+def _count_io(written: int = 0, read: int = 0):
+    with _io_lock:
+        IO_COUNTERS["bytes_written"] += written
+        IO_COUNTERS["bytes_read"] += read
+
+class StreamHasher:
+    """
+    SHA256 over a file whose segments arrive out of order.
+
+    Segment data is hashed straight from memory in file order; a segment
+    that finishes early is held until every segment before it is hashed.
+    Segments completed by an earlier (interrupted) run are read back from
+    the .part file once. Fetchers call wait_turn() before starting a
+    segment so at most `window` segments are ever buffered.
+    """
+
+    def __init__(self, part_path: Path, segments: list, on_disk: set, window: int):
+        self.part_path = part_path
+        self.segments = segments
+        self.on_disk = on_disk
+        self.window = window
+        self.sha256 = hashlib.sha256()
+        self.next_index = 0
+        self.pending = {}
+        self.bytes_read = 0
+        self.failed = False
+        self.cond = threading.Condition()
+        with self.cond:
+            self._advance()
+
+    def _advance(self):
+        while self.next_index < len(self.segments):
+            if self.next_index in self.pending:
+                self.sha256.update(self.pending.pop(self.next_index))
+            elif self.next_index in self.on_disk:
+                start, end = self.segments[self.next_index]
+                with open(self.part_path, "rb") as f:
+                    f.seek(start)
+                    data = f.read(end - start + 1)
+                self.sha256.update(data)
+                self.bytes_read += len(data)
+            else:
+                break
+            self.next_index += 1
+        self.cond.notify_all()
+
+    def wait_turn(self, index: int):
+        """Block until segment `index` is within the buffering window."""
+        with self.cond:
+            while index >= self.next_index + self.window and not self.failed:
+                self.cond.wait()
+            if self.failed:
+                raise IOError("Download aborted")
+
+    def add(self, index: int, data: bytes):
+        with self.cond:
+            self.pending[index] = data
+            self._advance()
+
+    def abort(self):
+        with self.cond:
+            self.failed = True
+            self.cond.notify_all()
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+def _fetch_segment(url: str, headers: dict, part_path: Path, start: int, end: int) -> bytes:
+    """Fetch bytes start-end (inclusive) into the same offsets of part_path and return them."""
+    expected = end - start + 1
+    data = bytearray()
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        with _http_open(url, headers, start=start, end=end) as response:
+            if response.status != 206:
+                raise IOError(f"Server ignored range request (HTTP {response.status})")
+            while len(data) < expected:
+                chunk = response.read(min(1 * MB, expected - len(data)))
+                if not chunk:
+                    break
+                os.pwrite(fd, chunk, start + len(data))
+                data += chunk
+    finally:
+        os.close(fd)
+    if len(data) != expected:
+        raise IOError(f"Short read: got {len(data)} of {expected} bytes at offset {start}")
+    return bytes(data)
+
+def _fetch_stream(url: str, headers: dict, part_path: Path, sha256) -> int:
+    """Fetch a whole URL in one stream (no range support). Returns bytes written."""
+    written = 0
+    with _http_open(url, headers) as response, open(part_path, "wb") as f:
+        for chunk in iter(lambda: response.read(1 * MB), b""):
+            f.write(chunk)
+            sha256.update(chunk)
+            written += len(chunk)
+        expected = response.headers.get("Content-Length")
+    if expected is not None and written != int(expected):
+        raise IOError(f"Short read: got {written} of {expected} bytes")
+    return written
+
+def _finalize(part_path: Path, journal_path: Path, dest_path: Path, actual_hash: str, expected_hash: str):
+    """Rename a completed .part into place, or discard it if the hash is wrong."""
+    if expected_hash and actual_hash != expected_hash:
+        part_path.unlink(missing_ok=True)
+        journal_path.unlink(missing_ok=True)
+        raise HashMismatchError(f"Hash mismatch for {dest_path.name}: expected {expected_hash}, got {actual_hash}")
+    os.replace(part_path, dest_path)
+    journal_path.unlink(missing_ok=True)
+
+def fetch_url(
+    url: str,
+    dest_path: Path,
+    headers: dict = None,
+    expected_hash: str = None,
+    connections: int = DOWNLOAD_CONNECTIONS,
+    segment_size: int = SEGMENT_SIZE,
+) -> dict:
+    """
+    Download a URL to dest_path using parallel, resumable range requests.
+
+    Data is written to "<dest>.part"; completed segments are recorded in
+    "<dest>.part.json" so a later call resumes where an interrupted one
+    stopped. The SHA256 is computed from the bytes as they arrive and
+    checked before dest_path appears (via atomic rename), so the file is
+    never read back just to verify it. Servers without range support
+    fall back to one stream.
+
+    Args:
+        url: Source URL (redirects are followed)
+        dest_path: Final file path
+        headers: Extra request headers (e.g. Authorization)
+        expected_hash: Optional SHA256; on mismatch the data is discarded
+        connections: Concurrent range requests for this file
+        segment_size: Bytes per range request
+
+    Returns:
+        Dictionary with "sha256", "bytes_written" (fetched by this call) and
+        "bytes_read" (read back from disk for hashing, non-zero on resume)
+
+    Raises:
+        HashMismatchError if the data does not match expected_hash
+        IOError / urllib.error.URLError if the download cannot be completed
+    """
+    part_path = dest_path.with_name(dest_path.name + ".part")
+    journal_path = dest_path.with_name(dest_path.name + ".part.json")
+    item = current_item()  # segments run on other threads
+    info = probe_url(url, headers)
+
+    # Only send credentials to the host they were meant for
+    if urllib.parse.urlsplit(info["url"]).netloc != urllib.parse.urlsplit(url).netloc:
+        segment_headers = {}
+    else:
+        segment_headers = headers
+
+    if not info["ranges"]:
+        journal_path.unlink(missing_ok=True)
+        sha256 = hashlib.sha256()
+        written = _fetch_stream(info["url"], segment_headers, part_path, sha256)
+        _count_io(written=written)
+        _count_transfer(item, nbytes=written)
+        _finalize(part_path, journal_path, dest_path, sha256.hexdigest(), expected_hash)
+        return {"sha256": sha256.hexdigest(), "bytes_written": written, "bytes_read": 0}
+
+    size = info["size"]
+    identity = {"url": url, "size": size, "etag": info["etag"], "segment_size": segment_size}
+    segments = [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+
+    done = _read_journal(journal_path, identity) if part_path.exists() else set()
+    if not done:
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+    else:
+        resumed = sum(segments[i][1] - segments[i][0] + 1 for i in done)
+        log_info(f"Resuming {dest_path.name}: {resumed // MB}/{size // MB} MB already downloaded")
+    _write_journal(journal_path, identity, done)
+
+    connections = max(1, connections)
+    hasher = StreamHasher(part_path, segments, set(done), window=connections + 2)
+    journal_lock = threading.Lock()
+    pending = [i for i in range(len(segments)) if i not in done]
+
+    def fetch(index: int) -> int:
+        start, end = segments[index]
+        hasher.wait_turn(index)
+        for attempt in range(1, DOWNLOAD_RETRIES + 1):
+            try:
+                data = _fetch_segment(info["url"], segment_headers, part_path, start, end)
+                break
+            except (OSError, urllib.error.URLError) as e:
+                if attempt == DOWNLOAD_RETRIES:
+                    hasher.abort()
+                    raise
+                log_warn(f"{dest_path.name}: segment {index} failed ({e}), retry {attempt}/{DOWNLOAD_RETRIES - 1}")
+                _count_transfer(item, retries=1)
+                time.sleep(2 ** attempt)
+        _count_io(written=len(data))
+        _count_transfer(item, nbytes=len(data))
+        with journal_lock:
+            done.add(index)
+            _write_journal(journal_path, identity, done)
+        hasher.add(index, data)
+        return len(data)
+
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        written = sum(pool.map(fetch, pending))
+
+    _count_io(read=hasher.bytes_read)
+    if part_path.stat().st_size != size:
+        raise IOError(f"{part_path} has size {part_path.stat().st_size}, expected {size}")
+    _finalize(part_path, journal_path, dest_path, hasher.hexdigest(), expected_hash)
+    return {"sha256": hasher.hexdigest(), "bytes_written": written, "bytes_read": hasher.bytes_read}
+
+def _log_stream_result(name: str, stats: dict, expected_hash: str):
+    """Log the in-stream verification result and the I/O it cost."""
+    io_note = f"wrote {stats['bytes_written'] / MB:.1f} MB, read back {stats['bytes_read'] / MB:.1f} MB"
+    if expected_hash:
+        log_info(f"Hash verified in-stream: {name} ({io_note})")
+    else:
+        log_info(f"Downloaded: {name} ({io_note})")
+
 # =============================================================================
 # DOWNLOAD FUNCTIONS
 # =============================================================================
@@ -280,28 +1384,33 @@ def download_file(
     filename: str,
     dest_dir: Path,
     expected_hash: str = None,
-    flatten_from: str = None,
     rename_to: str = None,
 ) -> bool:
     """
     Download a single file from HuggingFace.
 
+    The file is fetched from the Hub's resolve URL with the segmented engine
+    (hashing in-stream) and written straight to its final flat name, so
+    nested repo paths never touch the volume.
+
     Args:
         repo_id: HuggingFace repo (e.g., "black-forest-labs/FLUX.1-schnell")
         filename: File path within repo (e.g., "ae.safetensors")
         dest_dir: Destination directory
         expected_hash: Optional SHA256 hash for verification
-        flatten_from: If file is in nested dir, move it up
         rename_to: Rename file after download
 
     Returns:
         True if successful, False otherwise
     """
+    from huggingface_hub import hf_hub_url
+    from huggingface_hub.utils import build_hf_headers
+
     # Determine final filename
     final_name = rename_to if rename_to else Path(filename).name
     final_path = dest_dir / final_name
 
-    # Skip if already exists
+    # Skip if already exists (partial data lives in <file>.part)
     if final_path.exists():
         log_info(f"Exists: {final_name}")
         return True
@@ -309,49 +1418,34 @@ def download_file(
     log_info(f"Downloading: {filename} from {repo_id}")
 
     try:
-        # Download to dest_dir
-        downloaded_path = hf_hub_download(
-            repo_id=repo_id,
-            filename=filename,
-            local_dir=dest_dir,
-            local_dir_use_symlinks=False,
+        stats = fetch_url(
+            hf_hub_url(repo_id=repo_id, filename=filename),
+            final_path,
+            headers=build_hf_headers(),
+            expected_hash=expected_hash,
         )
-        downloaded_path = Path(downloaded_path)
-
-        # Handle nested directory flattening
-        if flatten_from:
-            nested_path = dest_dir / flatten_from / Path(filename).name
-            if nested_path.exists():
-                shutil.move(str(nested_path), str(final_path))
-                # Clean up nested directory
-                nested_dir = dest_dir / flatten_from
-                if nested_dir.exists():
-                    shutil.rmtree(nested_dir, ignore_errors=True)
-                log_info(f"Flattened {flatten_from}/ subdirectory")
-        elif rename_to and downloaded_path.name != rename_to:
-            # Rename if needed
-            shutil.move(str(downloaded_path), str(final_path))
+        if rename_to:
             log_info(f"Renamed to: {rename_to}")
-
-        # Clean up .cache if present
-        cache_dir = dest_dir / ".cache"
-        if cache_dir.exists():
-            shutil.rmtree(cache_dir, ignore_errors=True)
-
-        # Verify hash
-        if expected_hash:
-            return verify_hash(final_path, expected_hash)
-
+        _log_stream_result(final_name, stats, expected_hash)
         return True
 
-    except Exception as e:
+    except HashMismatchError as e:
+        log_error(str(e))
+        return False
+    except urllib.error.HTTPError as e:
         log_error(f"Download failed: {e}")
+        if e.code in (401, 403):
+            log_error(f"Accept the license at https://huggingface.co/{repo_id} and log in to HuggingFace")
+        return False
+    except Exception as e:
+        log_error(f"Download failed: {e} (rerun to resume)")
         return False
 
 def download_url(url: str, dest_dir: Path, filename: str, expected_hash: str = None) -> bool:
-    """Download a file directly from a URL using requests or urllib."""
+    """Download a file directly from a URL with the segmented engine (hashing in-stream)."""
     dest_path = dest_dir / filename
 
+    # Partial data lives in <file>.part, so an existing dest_path is complete
     if dest_path.exists():
         log_info(f"Exists: {filename}")
         return True
@@ -359,15 +1453,15 @@ def download_url(url: str, dest_dir: Path, filename: str, expected_hash: str = N
     log_info(f"Downloading: {filename}")
 
     try:
-        import urllib.request
-        urllib.request.urlretrieve(url, dest_path)
-
-        if expected_hash:
-            return verify_hash(dest_path, expected_hash)
+        stats = fetch_url(url, dest_path, expected_hash=expected_hash)
+        _log_stream_result(filename, stats, expected_hash)
         return True
 
+    except HashMismatchError as e:
+        log_error(str(e))
+        return False
     except Exception as e:
-        log_error(f"Download failed: {e}")
+        log_error(f"Download failed: {e} (rerun to resume)")
         return False
 
 def download_repo(repo_id: str, dest_dir: Path, hash_file: str = None, expected_hash: str = None) -> bool:
@@ -392,6 +1486,8 @@ def download_repo(repo_id: str, dest_dir: Path, hash_file: str = None, expected_
     log_info(f"Downloading: {repo_id} (full repository)")
 
     try:
+        from huggingface_hub import snapshot_download
+
         dest_dir.mkdir(parents=True, exist_ok=True)
 
         snapshot_download(
@@ -418,12 +1514,549 @@ def download_repo(repo_id: str, dest_dir: Path, hash_file: str = None, expected_
         log_error(f"Repository download failed: {e}")
         return False
 
+# =============================================================================
+# DOWNLOAD SCHEDULER
+# =============================================================================
+
+def model_variants(model: dict) -> list:
+    """Every variant of a manifest entry, the default first, as full entries."""
+    base = {key: value for key, value in model.items() if key != "variants"}
+    return [base] + [{**base, **variant} for variant in model.get("variants", [])]
+
+def load_variant_choice() -> dict:
+    """Map entry name -> chosen variant from VARIANTS_FILE ({} if none)."""
+    try:
+        return json.loads(VARIANTS_FILE.read_text()).get("variants", {})
+    except (OSError, ValueError):
+        return {}
+
+def iter_manifest(choice: dict = None):
+    """
+    Yield every MODEL_MANIFEST entry in manifest order.
+
+    Entries with variants yield the variant chosen in VARIANTS_FILE (or
+    choice), the default otherwise or when the chosen variant has no
+    pinned hash.
+    """
+    if choice is None:
+        choice = load_variant_choice()
+    for tier_data in MODEL_MANIFEST.values():
+        for model in tier_data["models"]:
+            variants = model_variants(model)
+            chosen = next((v for v in variants if v.get("variant") == choice.get(model["name"])), variants[0])
+            if not chosen.get("hash"):
+                log_warn(f"{chosen['name']} has no pinned SHA256; using {variants[0]['name']}")
+                chosen = variants[0]
+            yield chosen
+
+def model_dest_dir(model: dict) -> Path:
+    """Resolve the destination directory of a manifest entry."""
+    if model.get("dest_is_absolute"):
+        return VOLUME_PATH / model["dest"]
+    return MODELS_PATH / model["dest"]
+
+def download_model(model: dict) -> bool:
+    """Download one manifest entry using the strategy its fields describe."""
+    name = model["name"]
+
+    # Print format warning if present
+    if model.get("format_warning"):
+        log_warn(f"{name} ({model['format_warning']})...")
+    else:
+        log_info(f"{name}...")
+
+    dest_dir = model_dest_dir(model)
+
+    # Download based on type
+    if model.get("url"):
+        # Direct URL download
+        return download_url(
+            url=model["url"],
+            dest_dir=dest_dir,
+            filename=model["file"],
+            expected_hash=model.get("hash"),
+        )
+    if model.get("file") is None:
+        # Full repository download
+        return download_repo(
+            repo_id=model["repo"],
+            dest_dir=dest_dir,
+            hash_file=model.get("hash_file"),
+            expected_hash=model.get("hash"),
+        )
+    # Single file download
+    return download_file(
+        repo_id=model["repo"],
+        filename=model["file"],
+        dest_dir=dest_dir,
+        expected_hash=model.get("hash"),
+        rename_to=model.get("rename_to"),
+    )
+
+def _download_job(model: dict, ledger: dict, rehash: bool) -> bool:
+    """Worker entry point: check or download one model with its log output kept together."""
+    with buffered_log(), timed_item("models", model["name"]) as item:
+        try:
+            path = model_check_path(model)
+            sha256 = model.get("hash")
+
+            if not sha256:
+                # iter_manifest never yields these; refuse rather than record an unchecked file
+                log_error(f"{model['name']}: no pinned SHA256 in MODEL_MANIFEST, not downloading")
+                item["action"] = "failed"
+                return False
+
+            item["action"] = "verified"
+            if not check_model(model, ledger, rehash):
+                if sha256 and blob_path(sha256).exists():
+                    # Verified earlier (e.g. by another layout or checkpoint switch)
+                    kind = materialize(blob_path(sha256), path)
+                    log_info(f"Linked from blob store ({kind}): {path.name}")
+                    item["action"] = "linked"
+                elif not download_model(model):
+                    item["action"] = "failed"
+                    return False
+                else:
+                    item["action"] = "downloaded"
+
+            if sha256:
+                ingest_blob(path, sha256)
+            record_model(ledger, model, path, sha256)
+            return True
+        except Exception as e:
+            log_error(f"{model['name']}: unexpected error: {e}")
+            item["action"] = "failed"
+            return False
+
+def schedule_downloads(
+    models: list,
+    workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    ledger: dict = None,
+    rehash: bool = False,
+) -> dict:
+    """
+    Download manifest entries concurrently.
+
+    Entries are submitted largest-first so the biggest file (Flux1-dev Q8_0)
+    starts immediately instead of becoming the long tail. Entries already
+    verified in the ledger are skipped after the fast structural check.
+
+    Args:
+        models: Manifest entries to download
+        workers: Number of concurrent downloads
+        ledger: Model ledger (loaded from LEDGER_FILE if not given)
+        rehash: Ignore the ledger and re-hash every existing file
+
+    Returns:
+        Dictionary mapping model name to success (True/False)
+    """
+    if ledger is None:
+        ledger = load_ledger()
+    ordered = sorted(models, key=lambda m: m.get("size", 0), reverse=True)
+    workers = max(1, min(workers, len(ordered) or 1))
+
+    if workers > 1:
+        # Per-file progress bars from several threads garble the terminal
+        from huggingface_hub.utils import disable_progress_bars
+        disable_progress_bars()
+
+    log_info(f"Checking {len(ordered)} models with {workers} workers (largest first)")
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download") as pool:
+        futures = {pool.submit(_download_job, model, ledger, rehash): model for model in ordered}
+        for future in as_completed(futures):
+            model = futures[future]
+            results[model["name"]] = future.result()
+            done = len(results)
+            status = "OK" if results[model["name"]] else "FAILED"
+            log_info(f"[{done}/{len(ordered)}] {model['name']}: {status}")
+
+    return results
+
+# =============================================================================
+# BULK VERIFICATION
+# =============================================================================
+
+def _hash_job(path: str) -> tuple:
+    """Process pool worker: hash one file. Returns (sha256, seconds)."""
+    start = time.monotonic()
+    return sha256_file(Path(path)), time.monotonic() - start
+
+def verify_models(workers: int = None) -> int:
+    """
+    Re-hash every MODEL_MANIFEST entry in parallel and report throughput.
+
+    Files are hashed in a process pool (one file per core) with large mmap'd
+    reads. Results update the ledger; mismatching files are reported but
+    left in place for inspection.
+
+    Args:
+        workers: Processes to use (default: CPU count)
+
+    Returns:
+        0 if every model is present and matches its hash, 1 otherwise
+    """
+    log_section("Verifying Models")
+
+    ledger = load_ledger()
+    workers = workers or os.cpu_count() or 1
+    models = sorted(iter_manifest(), key=lambda m: m.get("size", 0), reverse=True)
+    failures = 0
+    total_bytes = 0
+    start = time.monotonic()
+
+    log_info(f"Hashing {len(models)} models with {workers} processes")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for model in models:
+            path = model_check_path(model)
+            if not path.exists():
+                log_error(f"MISSING   {model['name']}: {path}")
+                forget_model(ledger, model)
+                failures += 1
+                continue
+            futures[pool.submit(_hash_job, str(path))] = (model, path)
+
+        for future in as_completed(futures):
+            model, path = futures[future]
+            try:
+                actual_hash, seconds = future.result()
+            except Exception as e:
+                log_error(f"ERROR     {model['name']}: {e}")
+                failures += 1
+                continue
+
+            size = path.stat().st_size
+            total_bytes += size
+            record_item("verify", model["name"], seconds, nbytes=size)
+            rate = size / MB / max(seconds, 1e-6)
+            if not model.get("hash"):
+                forget_model(ledger, model)
+                log_error(f"UNPINNED  {model['name']}: no SHA256 in MODEL_MANIFEST")
+                failures += 1
+            elif actual_hash == model["hash"]:
+                record_model(ledger, model, path, actual_hash)
+                log_info(f"OK        {model['name']}: {size / MB:,.0f} MB in {seconds:.1f}s ({rate:,.0f} MB/s)")
+            else:
+                forget_model(ledger, model)
+                log_error(f"MISMATCH  {model['name']}: {path}")
+                log_error(f"  Expected: {model['hash']}")
+                log_error(f"  Got:      {actual_hash}")
+                failures += 1
+
+    elapsed = time.monotonic() - start
+    log_info(
+        f"Verified {total_bytes / GB:.2f} GB in {elapsed:.1f}s "
+        f"({total_bytes / MB / max(elapsed, 1e-6):,.0f} MB/s aggregate)"
+    )
+    if failures:
+        log_error(f"{failures}/{len(models)} models missing or invalid")
+        return 1
+    log_info(f"All {len(models)} models verified")
+    return 0
+
+def _quick_job(model: dict, ledger: dict) -> tuple:
+    """Thread worker: fast-check one model. Returns (path, problem, detail, seconds)."""
+    start = time.monotonic()
+    path = model_check_path(model)
+    if not path.exists():
+        return path, "missing", "", time.monotonic() - start
+    try:
+        detail = check_structure(path)
+    except StructureError as e:
+        return path, str(e), "", time.monotonic() - start
+    entry = ledger["models"].get(model["name"])
+    problem = None
+    if entry and entry.get("sample_sha256") and entry.get("sha256") == model.get("hash"):
+        problem = quick_check(entry, path)
+    else:
+        detail += ", no sampled digest to compare (run --verify)"
+    return path, problem, detail, time.monotonic() - start
+
+def quick_verify_models(workers: int = None) -> int:
+    """
+    Fast integrity audit of every MODEL_MANIFEST entry.
+
+    Parses each safetensors/GGUF header, checks tensor extents against the
+    file size and compares the sampled digest recorded in the ledger. Reads
+    a few MB per file instead of the whole 49 GB; use --verify for the full
+    hash.
+
+    Returns:
+        0 if every model passes, 1 otherwise
+    """
+    log_section("Quick Model Check")
+
+    ledger = load_ledger()
+    models = list(iter_manifest())
+    failures = 0
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers or DEFAULT_DOWNLOAD_WORKERS) as pool:
+        futures = {pool.submit(_quick_job, model, ledger): model for model in models}
+        for future in as_completed(futures):
+            model = futures[future]
+            path, problem, detail, seconds = future.result()
+            record_item("verify", model["name"], seconds, status="failed" if problem else "ok")
+            if problem:
+                log_error(f"FAILED    {model['name']}: {problem} ({path})")
+                failures += 1
+            else:
+                log_info(f"OK        {model['name']}: {detail or 'sample matches'} in {seconds * 1000:.0f} ms")
+
+    log_info(f"Checked {len(models)} models in {time.monotonic() - start:.1f}s")
+    if failures:
+        log_error(f"{failures}/{len(models)} models missing or damaged; run --verify or setup to repair")
+        return 1
+    log_info(f"All {len(models)} models passed the quick check")
+    return 0
+
+# =============================================================================
+# PHASE ORCHESTRATOR
+# =============================================================================
+
+# Setup phases that may run at the same time (override with --max-phases)
+DEFAULT_PARALLEL_PHASES = 3
+
+async def _orchestrate(phases: list, max_parallel: int) -> dict:
+    """Run phases as a dependency graph; see run_phases."""
+    semaphore = asyncio.Semaphore(max_parallel)
+    tasks = {}
+
+    async def run(phase: dict) -> str:
+        dependencies = [await tasks[name] for name in phase.get("after", [])]
+        if any(status != "ok" for status in dependencies):
+            log_warn(f"Skipping {phase['name']}: a phase it depends on did not succeed")
+            with timed_phase(phase["name"]) as record:
+                record["status"] = "skipped"
+            return "skipped"
+        async with semaphore:
+            def body():
+                with timed_phase(phase["name"]) as record:
+                    record["status"] = "failed" if phase_failed(phase["run"]()) else "ok"
+                    return record["status"]
+            return await asyncio.to_thread(body)
+
+    # Phases are listed so that dependencies come first
+    for phase in phases:
+        tasks[phase["name"]] = asyncio.ensure_future(run(phase))
+    statuses = await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    results = {}
+    for name, status in zip(tasks, statuses):
+        if isinstance(status, BaseException):
+            log_error(f"Phase {name} crashed: {status}")
+            status = "error"
+        results[name] = status
+    return results
+
+def run_phases(phases: list, max_parallel: int = DEFAULT_PARALLEL_PHASES) -> dict:
+    """
+    Run setup phases concurrently, respecting their dependencies.
+
+    Each phase is a dict with "name", "run" (a blocking callable returning
+    False or a non-zero exit code on failure) and optional "after" (names
+    of phases that must succeed first). Phases run in worker threads, at most max_parallel at
+    a time, so network-bound downloads overlap with git and pip work.
+
+    Returns:
+        Dictionary mapping phase name to "ok", "failed", "skipped" or "error"
+    """
+    return asyncio.run(_orchestrate(phases, max(1, max_parallel)))
+
+# =============================================================================
+# DRY-RUN PLANNER
+# =============================================================================
+
+# Rough costs used to turn the plan into a time estimate
+PLAN_BANDWIDTH_MBPS = 100      # Download throughput (override with --bandwidth)
+PLAN_HASH_MBPS = 300           # Re-hash throughput on the network volume
+PLAN_NODE_SYNC_SECONDS = 10    # One shallow clone/fetch
+PLAN_PIP_SECONDS = {"skip": 0, "offline": 60, "online": 600}
+
+# Exit codes of --plan
+PLAN_NOTHING_TO_DO = 0
+PLAN_WORK_PENDING = 2
+
+def read_git_head(repo_dir: Path):
+    """Commit checked out in repo_dir, read from .git without running git."""
+    git_dir = repo_dir / ".git"
+    try:
+        head = (git_dir / "HEAD").read_text().strip()
+    except OSError:
+        return None
+    if not head.startswith("ref: "):
+        return head
+    ref = head[5:]
+    try:
+        return (git_dir / ref).read_text().strip()
+    except OSError:
+        pass
+    try:
+        for line in (git_dir / "packed-refs").read_text().splitlines():
+            if line.endswith(" " + ref):
+                return line.split()[0]
+    except OSError:
+        pass
+    return None
+
+def plan_models(ledger: dict, rehash: bool = False) -> list:
+    """
+    Classify every manifest entry: ok, reverify, link, resume or download.
+
+    Reverify entries are costed as check_model would run them: the sampled
+    chunks for files the ledger knows (the fast tier), the whole file for
+    the rest, or for every existing file with rehash.
+    """
+    planned = []
+    for model in iter_manifest():
+        path = model_check_path(model)
+        entry = {"name": model["name"], "path": str(path), "bytes": 0}
+        part_path = path.with_name(path.name + ".part")
+        journal_path = path.with_name(path.name + ".part.json")
+
+        if path.exists():
+            recorded = ledger["models"].get(model["name"], {})
+            size = path.stat().st_size
+            if not rehash and ledger_matches(ledger, model, path):
+                entry["action"] = "ok"
+            elif (not rehash and recorded.get("sample_sha256") and recorded.get("path") == str(path)
+                  and recorded.get("sha256") == model.get("hash") and recorded.get("size") == size):
+                # Header parse is small next to the samples; a failed fast check adds a full hash
+                entry["action"] = "reverify"
+                entry["hash_bytes"] = min(size, SAMPLE_CHUNKS * SAMPLE_CHUNK_SIZE)
+            else:
+                entry["action"] = "reverify"
+                entry["hash_bytes"] = size
+        elif model.get("hash") and blob_path(model["hash"]).exists():
+            entry["action"] = "link"
+        elif part_path.exists() and journal_path.exists():
+            entry["action"] = "resume"
+            try:
+                journal = json.loads(journal_path.read_text())
+                done = len(journal.get("done", [])) * journal["segment_size"]
+                entry["bytes"] = max(0, journal["size"] - done)
+            except (OSError, ValueError, KeyError):
+                entry["bytes"] = model.get("size", 0)
+        else:
+            entry["action"] = "download"
+            entry["bytes"] = model.get("size", 0)
+        planned.append(entry)
+    return planned
+
+def plan_nodes(custom_nodes_dir: Path, lock: dict) -> list:
+    """Classify every custom node: ok, clone, update, or resolve (not locked yet)."""
+    planned = []
+    for repo_url, _ in CUSTOM_NODES:
+        name = node_dir_name(repo_url)
+        locked = lock["nodes"].get(name, {})
+        commit = locked.get("commit") or PINNED_NODE_VERSIONS.get(name)
+        head = read_git_head(custom_nodes_dir / name)
+
+        if head is None:
+            action = "clone"
+        elif not commit:
+            action = "resolve"
+        elif head.startswith(commit):
+            action = "ok"
+        else:
+            action = "update"
+        planned.append({"name": name, "action": action, "head": head, "locked": commit})
+    return planned
+
+def plan_dependencies(custom_nodes_dir: Path) -> str:
+    """How the dependency phase would run: skip, offline or online."""
+    if not custom_nodes_dir.exists():
+        return "online"
+    merged, options, _ = merge_requirements(collect_node_requirements(custom_nodes_dir))
+    key = environment_key(options + merged, PROJECT_CONSTRAINTS)
+    if (Path(sys.prefix) / f".luma-deps-{key}").exists():
+        return "skip"
+    if (WHEELHOUSE_PATH / key).is_dir():
+        return "offline"
+    return "online"
+
+def plan_setup(bandwidth_mbps: float = PLAN_BANDWIDTH_MBPS, rehash: bool = False) -> int:
+    """
+    Compute the work a setup run would do, from stat calls and file reads only.
+
+    No network access and no hashing: models are checked against the
+    ledger, nodes against the lockfile and .git/HEAD, dependencies against
+    the environment key. With rehash, existing models are costed as full
+    re-hashes. The plan is printed and written to PLAN_FILE.
+
+    Returns:
+        PLAN_NOTHING_TO_DO, PLAN_WORK_PENDING, or 1 if the volume lacks space
+    """
+    custom_nodes_dir = VOLUME_PATH / "runpod-slim" / "ComfyUI" / "custom_nodes"
+    models = plan_models(load_ledger(), rehash)
+    nodes = plan_nodes(custom_nodes_dir, load_node_lock())
+    dependencies = plan_dependencies(custom_nodes_dir)
+
+    download_bytes = sum(entry["bytes"] for entry in models)
+    hash_bytes = sum(entry.get("hash_bytes", 0) for entry in models)
+    node_work = [entry for entry in nodes if entry["action"] != "ok"]
+    # No volume yet (fresh CPU pod): nothing to measure or write to
+    free_bytes = shutil.disk_usage(VOLUME_PATH).free if VOLUME_PATH.exists() else None
+
+    # Phases run one after another; node syncs run NODE_SYNC_WORKERS at a time
+    estimate = {
+        "models": download_bytes / MB / bandwidth_mbps + hash_bytes / MB / PLAN_HASH_MBPS,
+        "custom_nodes": -(-len(node_work) // NODE_SYNC_WORKERS) * PLAN_NODE_SYNC_SECONDS,
+        "dependencies": PLAN_PIP_SECONDS[dependencies],
+    }
+    plan = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "bandwidth_mbps": bandwidth_mbps,
+        "download_bytes": download_bytes,
+        "rehash_bytes": hash_bytes,
+        "free_bytes": free_bytes,
+        "disk_ok": free_bytes is None or free_bytes >= download_bytes,
+        "models": models,
+        "custom_nodes": nodes,
+        "dependencies": dependencies,
+        "estimated_seconds": {phase: round(seconds) for phase, seconds in estimate.items()},
+    }
+
+    log_section("Setup Plan (dry run)")
+    for entry in models:
+        if entry["action"] != "ok":
+            size = entry["bytes"] or entry.get("hash_bytes", 0)
+            log_info(f"  {entry['action']:<9} {size / GB:7.2f} GB  {entry['name']}")
+    for entry in node_work:
+        log_info(f"  {entry['action']:<9} {'':>10}  {entry['name']}")
+    log_info(f"Models:       {sum(e['action'] == 'ok' for e in models)}/{len(models)} ready, "
+             f"{download_bytes / GB:.2f} GB to download, {hash_bytes / GB:.2f} GB to re-hash")
+    log_info(f"Custom nodes: {len(nodes) - len(node_work)}/{len(nodes)} at locked commit")
+    log_info(f"Dependencies: {dependencies}")
+    if free_bytes is None:
+        log_warn(f"Disk:         {VOLUME_PATH} not mounted; space not checked")
+    else:
+        log_info(f"Disk:         {free_bytes / GB:.1f} GB free on {VOLUME_PATH}")
+    log_info(f"Estimate:     ~{sum(estimate.values()) / 60:.0f} min at {bandwidth_mbps:g} MB/s")
+
+    if PLAN_FILE.parent.exists():
+        PLAN_FILE.write_text(json.dumps(plan, indent=2))
+        log_info(f"Plan written to {PLAN_FILE}")
+
+    if not plan["disk_ok"]:
+        log_error(f"Not enough space: need {download_bytes / GB:.1f} GB, {free_bytes / GB:.1f} GB free")
+        return 1
+    if download_bytes or hash_bytes or node_work or dependencies != "skip" or any(
+        entry["action"] != "ok" for entry in models
+    ):
+        return PLAN_WORK_PENDING
+    return PLAN_NOTHING_TO_DO
+
 # =============================================================================
 # MAIN
 # =============================================================================
 
 def create_directories():
     """Create all required model directories."""
+    log_section("Creating Directory Structure")
     dirs = [
         MODELS_PATH / "checkpoints",
         MODELS_PATH / "clip",
@@ -621,108 +2254,569 @@ CUSTOM_NODES = [
     ("https://github.com/theUpsider/ComfyUI-Logic.git", "HIGH"),
 ]
 
-def install_custom_nodes():
-    """Clone all custom nodes and install their dependencies.
+# Pinned versions for compatibility
+# Some nodes need specific versions to work with pinned dependencies
+PINNED_NODE_VERSIONS = {
+    # ComfyUI-Florence2 v1.0.7: Uses torch_dtype (not dtype) compatible with transformers 4.51.3
+    # Latest version uses dtype= which is invalid for transformers < 5.0
+    "ComfyUI-Florence2": "6c766b1",
+}
 
-    IMPORTANT: Dependencies are installed EVERY time, not just on first clone.
-    This is because Python packages live in the container (ephemeral), while
-    node files live on the network volume (persistent). Each new pod needs
-    dependencies reinstalled.
+def node_dir_name(repo_url: str) -> str:
+    """Directory name of a custom node repository."""
+    return repo_url.split("/")[-1].replace(".git", "")
+
+def run_git(*args, cwd: Path = None, timeout: int = 300) -> str:
+    """Run a git command and return stdout; raise RuntimeError with stderr on failure."""
+    command = ["git"] + (["-C", str(cwd)] if cwd else []) + list(args)
+    result = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f"git {' '.join(args)}: {result.stderr.strip()[:200]}")
+    return result.stdout.strip()
+
+def load_node_lock() -> dict:
+    """Load the custom node lockfile, or return an empty one."""
+    try:
+        lock = json.loads(NODE_LOCK_FILE.read_text())
+    except (OSError, ValueError):
+        return {"version": 1, "nodes": {}}
+    lock.setdefault("nodes", {})
+    return lock
+
+def save_node_lock(lock: dict):
+    """Atomically write the custom node lockfile."""
+    tmp_path = NODE_LOCK_FILE.with_name(NODE_LOCK_FILE.name + ".tmp")
+    tmp_path.write_text(json.dumps(lock, indent=2, sort_keys=True))
+    os.replace(tmp_path, NODE_LOCK_FILE)
+
+def lock_custom_nodes(lock: dict, update: bool = False) -> dict:
     """
-    comfyui_path = VOLUME_PATH / "runpod-slim" / "ComfyUI"
-    custom_nodes_dir = comfyui_path / "custom_nodes"
+    Fill in lockfile entries for every node in CUSTOM_NODES.
 
-    if not comfyui_path.exists():
-        log_warn(f"ComfyUI not found at {comfyui_path}")
-        log_warn("Skipping custom node installation")
-        return False
+    New (or, with update=True, all unpinned) nodes are locked to the remote
+    HEAD via concurrent `git ls-remote` calls. Pinned nodes take their
+    commit from PINNED_NODE_VERSIONS; an abbreviated pin is stored as
+    "pin" and expanded to a full SHA by the first sync.
+
+    Returns:
+        The updated lock
+    """
+    nodes = lock["nodes"]
+    to_resolve = []
+
+    for repo_url, _ in CUSTOM_NODES:
+        name = node_dir_name(repo_url)
+        entry = nodes.get(name, {})
+        pin = PINNED_NODE_VERSIONS.get(name)
+
+        if pin:
+            if entry.get("pin") != pin or not (entry.get("commit") or "").startswith(pin):
+                full = pin if len(pin) == 40 else None
+                nodes[name] = {"url": repo_url, "pin": pin, "commit": full}
+        elif update or entry.get("url") != repo_url or not entry.get("commit"):
+            to_resolve.append((name, repo_url))
+
+    def resolve(item):
+        name, repo_url = item
+        head = run_git("ls-remote", repo_url, "HEAD", timeout=60).split()
+        return name, repo_url, head[0] if head else None
+
+    with ThreadPoolExecutor(max_workers=NODE_SYNC_WORKERS) as pool:
+        for future in as_completed([pool.submit(resolve, item) for item in to_resolve]):
+            try:
+                name, repo_url, commit = future.result()
+            except Exception as e:
+                log_error(f"Cannot resolve remote HEAD: {e}")
+                continue
+            if commit:
+                nodes[name] = {"url": repo_url, "commit": commit}
 
-    log_section("Installing Custom Nodes (26 packages)")
+    return lock
 
-    cloned = 0
-    existed = 0
+def sync_node(repo_url: str, dest_dir: Path, entry: dict) -> dict:
+    """
+    Check out one node at its locked commit.
 
-    # Step 1: Clone any missing repos
-    for repo_url, risk_level in CUSTOM_NODES:
-        dir_name = repo_url.split("/")[-1].replace(".git", "")
-        dest_dir = custom_nodes_dir / dir_name
+    Only the locked commit is fetched (`fetch --depth 1 origin <sha>`), for
+    new and existing clones alike. An abbreviated pin needs history to be
+    expanded, so that one case fetches the full branch once.
 
-        if dest_dir.exists():
-            existed += 1
+    Returns:
+        Dictionary with "action" (cloned/updated/unchanged), "commit" and "seconds"
+    """
+    start = time.monotonic()
+    action = "updated"
+
+    if not (dest_dir / ".git").exists():
+        action = "cloned"
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        run_git("init", "-q", cwd=dest_dir)
+        run_git("remote", "add", "origin", repo_url, cwd=dest_dir)
+
+    try:
+        current = run_git("rev-parse", "HEAD", cwd=dest_dir)
+    except RuntimeError:
+        current = None
+
+    commit = entry.get("commit")
+    if commit and current == commit:
+        action = "unchanged"
+    elif commit:
+        run_git("fetch", "-q", "--depth", "1", "origin", commit, cwd=dest_dir)
+        run_git("checkout", "-q", "--detach", commit, cwd=dest_dir)
+    else:
+        # Abbreviated pin: fetch history once to expand it
+        shallow = (dest_dir / ".git" / "shallow").exists()
+        run_git("fetch", "-q", *(["--unshallow"] if shallow else []), "origin", cwd=dest_dir)
+        commit = run_git("rev-parse", f"{entry['pin']}^{{commit}}", cwd=dest_dir)
+        if current != commit:
+            run_git("checkout", "-q", "--detach", commit, cwd=dest_dir)
+        else:
+            action = "unchanged"
+
+    return {"action": action, "commit": commit, "seconds": time.monotonic() - start}
+
+def sync_custom_nodes(custom_nodes_dir: Path, update: bool = False) -> bool:
+    """
+    Clone/update all CUSTOM_NODES concurrently to the commits in NODE_LOCK_FILE.
+
+    The lockfile is generated on first run and extended for new nodes;
+    update=True moves every unpinned node to its current remote HEAD.
+    Wall time is bounded by the slowest single repository.
+
+    Returns:
+        True if every node is at its locked commit
+    """
+    log_section(f"Syncing Custom Nodes ({len(CUSTOM_NODES)} packages)")
+
+    lock = lock_custom_nodes(load_node_lock(), update=update)
+    save_node_lock(lock)
+    risk = dict(CUSTOM_NODES)
+    results = {}
+
+    def job(repo_url: str):
+        name = node_dir_name(repo_url)
+        with buffered_log():
+            entry = lock["nodes"].get(name)
+            if not entry:
+                log_error(f"{name}: not in lockfile (remote unreachable?)")
+                return name, None
+            if not (custom_nodes_dir / name).exists() and risk[repo_url] in ("HIGH", "MEDIUM"):
+                log_warn(f"Cloning {name} ({risk[repo_url]} RISK)...")
+            try:
+                result = sync_node(repo_url, custom_nodes_dir / name, entry)
+            except Exception as e:
+                log_error(f"Failed to sync {name}: {e}")
+                return name, None
+            if result["action"] != "unchanged":
+                log_info(f"{result['action'].capitalize()}: {name} @ {result['commit'][:7]}")
+            return name, result
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=NODE_SYNC_WORKERS) as pool:
+        for name, result in pool.map(job, [url for url, _ in CUSTOM_NODES]):
+            results[name] = result
+            if result:
+                lock["nodes"][name]["commit"] = result["commit"]
+                record_item("custom_nodes", name, result["seconds"], action=result["action"])
+            else:
+                record_item("custom_nodes", name, 0, action="failed")
+    save_node_lock(lock)
+
+    # Per-repo timing, slowest first
+    log_info(f"Node sync finished in {time.monotonic() - start:.1f}s:")
+    for name, result in sorted(results.items(), key=lambda item: -(item[1] or {}).get("seconds", 0)):
+        if result:
+            log_info(f"  {result['seconds']:6.1f}s  {result['action']:<9} {result['commit'][:7]}  {name}")
+        else:
+            log_error(f"  {'-':>6}   failed              {name}")
+
+    counts = {}
+    for result in results.values():
+        action = result["action"] if result else "failed"
+        counts[action] = counts.get(action, 0) + 1
+    log_info(", ".join(f"{count} {action}" for action, count in sorted(counts.items())))
+    return all(results.values())
+
+# Project requirements installed alongside the node requirements. They take
+# precedence: a node constraint that contradicts one is reported and dropped.
+PROJECT_REQUIREMENTS = [
+    # comfyui-various has no requirements.txt but needs soundfile
+    "soundfile",
+    # Pin transformers for Florence-2 compatibility
+    # Version 4.51.3 is confirmed to work without degenerate output
+    # See: https://huggingface.co/microsoft/Florence-2-large/discussions
+    "transformers==4.51.3",
+]
+
+# Constraints that never cause an install on their own
+PROJECT_CONSTRAINTS = [
+    # ultralytics releases that shipped malware
+    "ultralytics!=8.3.41,!=8.3.42,!=8.3.45,!=8.3.46",
+]
+
+MERGED_REQUIREMENTS_FILE = VOLUME_PATH / "requirements.merged.txt"
+PROJECT_CONSTRAINTS_FILE = VOLUME_PATH / "constraints.txt"
+
+# Wheels for the merged requirements, one directory per environment key
+# (requirements + Python + torch), so a new pod installs offline from the volume
+WHEELHOUSE_PATH = VOLUME_PATH / "wheelhouse"
+
+def _packaging():
+    """Return the packaging module's requirement helpers (pip's vendored copy as fallback)."""
+    try:
+        from packaging.requirements import InvalidRequirement, Requirement
+        from packaging.utils import canonicalize_name
+    except ImportError:
+        from pip._vendor.packaging.requirements import InvalidRequirement, Requirement
+        from pip._vendor.packaging.utils import canonicalize_name
+    return Requirement, InvalidRequirement, canonicalize_name
+
+def specifier_satisfiable(specifier) -> bool:
+    """
+    Whether any version can satisfy a (merged) specifier set.
+
+    Without an index to ask, candidates are the versions the specifiers
+    name, versions just above and below each, and the next release at
+    every level (4.9 and 5 for 4.8); a range like numpy<2,>=2 has no
+    candidate and is unsatisfiable.
+    """
+    try:
+        from packaging.version import InvalidVersion, Version
+    except ImportError:
+        from pip._vendor.packaging.version import InvalidVersion, Version
+
+    candidates = {"0", "999999"}
+    for spec in specifier:
+        text = spec.version.removesuffix(".*")
+        try:
+            release = Version(text).release
+        except InvalidVersion:
+            # Arbitrary (===) versions: compared as strings
+            candidates.add(spec.version)
             continue
+        candidates.update({text, f"{text}.post999999", f"{text}.999999"})
+        for index in range(len(release)):
+            candidates.add(".".join(map(str, (*release[:index], release[index] + 1))))
+        for index in range(len(release) - 1, -1, -1):
+            if release[index] > 0:
+                lower = (*release[:index], release[index] - 1)
+                candidates.add(".".join(map(str, lower)) + ".999999")
+                break
+    return any(specifier.contains(candidate, prereleases=True) for candidate in candidates)
+
+def read_requirements(req_file: Path, seen: set = None) -> list:
+    """
+    Read a requirements file into logical lines, following -r includes.
 
-        # Log with risk level
-        if risk_level == "HIGH":
-            log_warn(f"Cloning {dir_name} (HIGH RISK)...")
-        elif risk_level == "MEDIUM":
-            log_warn(f"Cloning {dir_name} (MEDIUM RISK)...")
+    Comments, blank lines and line continuations are resolved; option
+    lines (--extra-index-url, -e, ...) are returned as-is.
+    """
+    seen = seen if seen is not None else set()
+    if req_file in seen or not req_file.exists():
+        return []
+    seen.add(req_file)
+
+    lines = []
+    text = req_file.read_text(errors="replace").replace("\\\n", "")
+    for raw in text.splitlines():
+        line = raw.split(" #", 1)[0].strip()
+        if not line or line.startswith("#"):
+            continue
+        for flag in ("-r ", "--requirement "):
+            if line.startswith(flag):
+                lines += read_requirements(req_file.parent / line[len(flag):].strip(), seen)
+                break
         else:
-            log_info(f"Cloning {dir_name}...")
+            lines.append(line)
+    return lines
+
+def collect_node_requirements(custom_nodes_dir: Path) -> list:
+    """Return (source, line) for every requirement of every installed node plus the project."""
+    collected = []
+    for node_dir in sorted(custom_nodes_dir.iterdir()):
+        if node_dir.is_dir():
+            for line in read_requirements(node_dir / "requirements.txt"):
+                collected.append((node_dir.name, line))
+    for line in PROJECT_REQUIREMENTS:
+        collected.append(("project", line))
+    return collected
+
+def merge_requirements(collected: list) -> tuple:
+    """
+    Merge requirement lines from many sources into one conflict-checked set.
+
+    Specifiers for the same package are intersected. A pinned version (==)
+    is checked against every other source's specifier, and every other
+    constraint against the intersection so far (project first, then nodes
+    in order), so ranges like numpy<2 and numpy>=2 are caught too.
+    Contradicting constraints, and specifiers no version satisfies on their
+    own, are reported with the source that requested them and dropped (project requirements always win), so one node's
+    conflict cannot fail the whole install. Requirements whose environment
+    markers don't apply are skipped; URLs and pip options are passed
+    through.
+
+    Returns:
+        (merged requirement lines, option lines, list of conflict messages)
+    """
+    Requirement, InvalidRequirement, canonicalize_name = _packaging()
 
+    packages = {}   # canonical name -> list of (source, Requirement)
+    options = []
+    passthrough = []
+
+    for source, line in collected:
+        if line.startswith("-"):
+            if line not in options:
+                options.append(line)
+            continue
         try:
-            result = subprocess.run(
-                ["git", "clone", "--depth", "1", repo_url, str(dest_dir)],
-                capture_output=True,
-                text=True
-            )
-
-            if result.returncode != 0:
-                log_error(f"Failed to clone {dir_name}: {result.stderr}")
+            req = Requirement(line)
+        except InvalidRequirement:
+            if line not in passthrough:
+                passthrough.append(line)
+            continue
+        if req.marker and not req.marker.evaluate():
+            continue
+        if req.url:
+            if line not in passthrough:
+                passthrough.append(line)
+            continue
+        packages.setdefault(canonicalize_name(req.name), []).append((source, req))
+
+    merged = []
+    conflicts = []
+
+    for name, requests in sorted(packages.items()):
+        # Project pins are authoritative; otherwise any source may pin
+        project = [(source, req) for source, req in requests if source == "project"]
+        pins = {
+            spec.version
+            for _, req in (project or requests)
+            for spec in req.specifier
+            if spec.operator in ("==", "===") and not spec.version.endswith(".*")
+        }
+
+        kept = []
+        if len(pins) > 1:
+            conflicts.append(f"{name}: conflicting pins (" + ", ".join(
+                f"{source} wants {name}{req.specifier}" for source, req in requests if req.specifier
+            ) + "); leaving the version to pip")
+        else:
+            pinned = next(iter(pins), None)
+            for source, req in requests:
+                if pinned and not req.specifier.contains(pinned, prereleases=True):
+                    winner = "project" if project else "another node"
+                    conflicts.append(f"{name}: {source} wants {name}{req.specifier}, {winner} pins =={pinned}")
+                    continue
+                kept.append((source, req))
+
+        specifier = None
+        accepted = []  # (source, specifier) merged so far
+        ordered = sorted(kept, key=lambda item: item[0] != "project")
+        for source, req in ordered:
+            if not specifier_satisfiable(req.specifier):
+                conflicts.append(f"{name}: {source} wants {name}{req.specifier}, which no version satisfies; "
+                                 f"dropped {source}'s constraint")
+                continue
+            combined = req.specifier if specifier is None else specifier & req.specifier
+            if not specifier_satisfiable(combined):
+                conflicts.append(
+                    f"{name}: {source} wants {name}{req.specifier}, which contradicts "
+                    + ", ".join(f"{other} ({name}{spec})" for other, spec in accepted if spec)
+                    + f"; dropped {source}'s constraint"
+                )
                 continue
+            specifier = combined
+            accepted.append((source, req.specifier))
+        extras = sorted({extra for _, req in requests for extra in req.extras})
 
-            cloned += 1
+        line = name + (f"[{','.join(extras)}]" if extras else "") + (str(specifier) if specifier else "")
+        sources = sorted({source for source, _ in requests})
+        merged.append(f"{line}  # {', '.join(sources)}")
 
-        except Exception as e:
-            log_error(f"Failed to clone {dir_name}: {e}")
+    return merged + passthrough, options, conflicts
 
-    log_info(f"Cloned {cloned} new nodes, {existed} already existed")
+def environment_key(requirement_lines: list, constraint_lines: list) -> str:
+    """
+    Hash everything that determines the installed dependency set.
 
-    # Step 2: Install dependencies for ALL nodes (always, every time)
-    # This is critical because pip packages don't persist on the network volume
-    log_section("Installing Node Dependencies")
+    Covers the merged requirements (provenance comments stripped), project
+    constraints, Python version/platform and the installed torch version.
+    """
+    import platform
+    from importlib import metadata
+
+    try:
+        torch_version = metadata.version("torch")
+    except metadata.PackageNotFoundError:
+        torch_version = "none"
 
-    deps_installed = 0
-    deps_failed = []
+    sha256 = hashlib.sha256()
+    for line in sorted(line.split("  #", 1)[0] for line in requirement_lines):
+        sha256.update(f"req:{line}\n".encode())
+    for line in constraint_lines:
+        sha256.update(f"constraint:{line}\n".encode())
+    sha256.update(f"python:{platform.python_implementation()}-{sys.version_info[0]}.{sys.version_info[1]}\n".encode())
+    sha256.update(f"platform:{sys.platform}-{platform.machine()}\n".encode())
+    sha256.update(f"torch:{torch_version}\n".encode())
+    return sha256.hexdigest()[:16]
+
+def _pip(*args) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, "-m", "pip", *args], capture_output=True, text=True)
+
+def _log_pip_failure(title: str, result: subprocess.CompletedProcess):
+    log_error(title)
+    for line in result.stderr.strip().splitlines()[-10:]:
+        log_error(f"  {line}")
+
+def build_wheelhouse(report_path: Path, wheel_dir: Path) -> bool:
+    """
+    Save wheels for everything a pip install just installed.
 
-    for node_dir in custom_nodes_dir.iterdir():
-        if not node_dir.is_dir():
+    Reads the `pip install --report` output and runs `pip wheel --no-deps`
+    for exactly those distributions (served from pip's cache, so nothing is
+    downloaded twice). VCS requirements are pinned to the resolved commit.
+    The directory only becomes visible once complete.
+    """
+    report = json.loads(report_path.read_text())
+    specs = []
+    for item in report.get("install", []):
+        name = item["metadata"]["name"]
+        download = item.get("download_info", {})
+        if "vcs_info" in download:
+            vcs = download["vcs_info"]
+            specs.append(f"{name} @ {vcs['vcs']}+{download['url']}@{vcs['commit_id']}")
+        elif "dir_info" in download:
             continue
+        else:
+            specs.append(f"{name}=={item['metadata']['version']}")
+
+    tmp_dir = wheel_dir.with_name(wheel_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    if specs:
+        result = _pip("wheel", "--no-deps", "-w", str(tmp_dir), *specs)
+        if result.returncode != 0:
+            _log_pip_failure("Building wheelhouse failed:", result)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return False
+
+    shutil.rmtree(wheel_dir, ignore_errors=True)
+    os.replace(tmp_dir, wheel_dir)
+    log_info(f"Wheelhouse: saved {len(specs)} wheels to {wheel_dir}")
+    return True
 
-        req_file = node_dir / "requirements.txt"
-        if req_file.exists():
-            log_info(f"Installing deps: {node_dir.name}")
-            result = subprocess.run(
-                [sys.executable, "-m", "pip", "install", "-r", str(req_file)],
-                capture_output=True,
-                text=True
-            )
-            if result.returncode != 0:
-                log_error(f"FAILED: {node_dir.name}")
-                log_error(f"  {result.stderr.strip()[:200]}")
-                deps_failed.append(node_dir.name)
-            else:
-                deps_installed += 1
+def install_node_requirements(custom_nodes_dir: Path) -> bool:
+    """
+    Install the requirements of all custom nodes with one pip resolver run.
 
-    # Install soundfile for comfyui-various (no requirements.txt but needs it)
-    subprocess.run(
-        [sys.executable, "-m", "pip", "install", "-q", "soundfile"],
-        capture_output=True
-    )
+    Every node's requirements.txt and PROJECT_REQUIREMENTS are merged and
+    conflict-checked up front (see merge_requirements), written to
+    MERGED_REQUIREMENTS_FILE and installed in a single `pip install`, so
+    later nodes can no longer silently upgrade what earlier ones pinned.
 
-    # Pin transformers for Florence-2 compatibility
-    # Version 4.51.3 is confirmed to work without degenerate output
-    # See: https://huggingface.co/microsoft/Florence-2-large/discussions
-    log_info("Pinning transformers==4.51.3 for Florence-2 compatibility")
-    subprocess.run(
-        [sys.executable, "-m", "pip", "install", "transformers==4.51.3"],
-        capture_output=True
+    Installs are keyed by environment_key(): if this container already
+    installed the same key, nothing runs; if the volume has a wheelhouse
+    for the key, pip installs fully offline from it; otherwise pip
+    installs online and the wheelhouse is saved for the next pod.
+
+    Returns:
+        True if the install succeeded
+    """
+    collected = collect_node_requirements(custom_nodes_dir)
+    nodes = {source for source, _ in collected if source != "project"}
+    merged, options, conflicts = merge_requirements(collected)
+
+    log_info(f"Merged {len(collected)} requirements from {len(nodes)} nodes into {len(merged)} packages")
+    for conflict in conflicts:
+        log_warn(f"Conflict: {conflict}")
+
+    MERGED_REQUIREMENTS_FILE.write_text(
+        "# Generated by setup.py from custom node requirements; do not edit\n"
+        + "".join(f"{line}\n" for line in options + merged)
     )
+    PROJECT_CONSTRAINTS_FILE.write_text("".join(f"{line}\n" for line in PROJECT_CONSTRAINTS))
+    pip_files = ["-r", str(MERGED_REQUIREMENTS_FILE), "-c", str(PROJECT_CONSTRAINTS_FILE)]
 
-    if deps_failed:
-        log_error(f"Failed to install deps for: {', '.join(deps_failed)}")
-        log_warn("Some nodes may not work. Check errors above.")
+    key = environment_key(options + merged, PROJECT_CONSTRAINTS)
+    stamp = Path(sys.prefix) / f".luma-deps-{key}"
+    wheel_dir = WHEELHOUSE_PATH / key
+
+    if stamp.exists():
+        log_info(f"Dependencies already installed in this environment (key {key})")
+        return True
 
-    log_info(f"Installed dependencies for {deps_installed} nodes ({len(deps_failed)} failed)")
+    start = time.monotonic()
+    if wheel_dir.is_dir():
+        log_info(f"Installing offline from wheelhouse {wheel_dir}...")
+        result = _pip("install", "--no-index", "--find-links", str(wheel_dir), *pip_files)
+        if result.returncode == 0:
+            stamp.touch()
+            record_item("dependencies", "pip install", time.monotonic() - start, action="offline")
+            log_info(f"Installed dependencies for {len(nodes)} nodes in {time.monotonic() - start:.0f}s (offline)")
+            return True
+        _log_pip_failure("Offline install failed, falling back to the package index:", result)
+
+    log_info("Installing merged requirements (single resolver run)...")
+    report_path = VOLUME_PATH / f".pip-report-{key}.json"
+    result = _pip("install", "--report", str(report_path), *pip_files)
+    if result.returncode != 0 and "--report" in result.stderr:
+        # pip < 22.2: install without a report (no wheelhouse this time)
+        result = _pip("install", *pip_files)
+    if result.returncode != 0:
+        record_item("dependencies", "pip install", time.monotonic() - start, action="failed")
+        _log_pip_failure("Dependency installation failed:", result)
+        log_error(f"Merged requirements: {MERGED_REQUIREMENTS_FILE}")
+        return False
+
+    stamp.touch()
+    record_item("dependencies", "pip install", time.monotonic() - start, action="online")
+    log_info(f"Installed dependencies for {len(nodes)} nodes in {time.monotonic() - start:.0f}s")
+
+    if report_path.exists():
+        start = time.monotonic()
+        build_wheelhouse(report_path, wheel_dir)
+        record_item("dependencies", "wheelhouse", time.monotonic() - start)
+        report_path.unlink()
+    return True
+
+def install_custom_nodes(update_nodes: bool = False) -> bool:
+    """Sync all custom nodes to their locked commits."""
+    comfyui_path = VOLUME_PATH / "runpod-slim" / "ComfyUI"
+    custom_nodes_dir = comfyui_path / "custom_nodes"
+
+    if not comfyui_path.exists():
+        log_warn(f"ComfyUI not found at {comfyui_path}")
+        log_warn("Skipping custom node installation")
+        return False
+
+    if not sync_custom_nodes(custom_nodes_dir, update=update_nodes):
+        log_warn("Some nodes failed to sync. Check errors above.")
+        return False
+    return True
+
+def install_node_dependencies() -> bool:
+    """Install the dependencies of all custom nodes.
+
+    IMPORTANT: Dependencies are installed EVERY time, not just on first clone.
+    This is because Python packages live in the container (ephemeral), while
+    node files live on the network volume (persistent). Each new pod needs
+    dependencies reinstalled - from the wheelhouse on the volume when one
+    exists for the current requirements, so no wheels are downloaded or built.
+    """
+    custom_nodes_dir = VOLUME_PATH / "runpod-slim" / "ComfyUI" / "custom_nodes"
+
+    if not custom_nodes_dir.exists():
+        log_warn("No custom nodes installed, skipping dependencies")
+        return False
+
+    # This is critical because pip packages don't persist on the network volume
+    log_section("Installing Node Dependencies")
+
+    ok = install_node_requirements(custom_nodes_dir)
+    if not ok:
+        log_warn("Some nodes may not work. Check errors above.")
 
     # Security check: warn about dangerous ultralytics versions
     try:
@@ -743,231 +2837,578 @@ def install_custom_nodes():
     except Exception:
         pass
 
-    return True
+    return ok
 
-# Pinned versions for compatibility
-# Some nodes need specific versions to work with pinned dependencies
-PINNED_NODE_VERSIONS = {
-    # ComfyUI-Florence2 v1.0.7: Uses torch_dtype (not dtype) compatible with transformers 4.51.3
-    # Latest version uses dtype= which is invalid for transformers < 5.0
-    "ComfyUI-Florence2": "6c766b1",
+# =============================================================================
+# PREFLIGHT VALIDATION
+# =============================================================================
+
+COMFYUI_PATH = VOLUME_PATH / "runpod-slim" / "ComfyUI"
+WORKFLOW_FILE = VOLUME_PATH / "archviz_v037_cuda.json"
+
+# Only files mentioning one of these are parsed first; modules defining the
+# classes and name helpers their registrations use are followed from there
+NODE_REGISTRATION_MARKERS = ("CLASS_MAPPINGS", "NODE_CONFIG", "node_id")
+
+# Directories inside node packages that never hold node definitions
+SKIPPED_SOURCE_DIRS = {".git", "node_modules", "web", "js", "tests", "test", "docs", "__pycache__"}
+
+# Node types the browser handles itself (as patch_workflow.VIRTUAL_NODES)
+FRONTEND_NODES = {
+    "Reroute", "PrimitiveNode", "Note", "MarkdownNote",
+    "Label (rgthree)", "Fast Groups Bypasser (rgthree)", "Fast Groups Muter (rgthree)",
+}
+
+# Loader node type -> widget index -> ComfyUI model folder names searched.
+# Folder None: the node loads from a fixed path set up by configure_comfyui,
+# so the file only has to be on the volume where MODEL_MANIFEST puts it.
+PREFLIGHT_LOADERS = {
+    "CheckpointLoaderSimple": {0: ["checkpoints"]},
+    "UnetLoaderGGUF": {0: ["diffusion_models", "unet"]},
+    "UNETLoader": {0: ["diffusion_models", "unet"]},
+    "DualCLIPLoaderGGUF": {0: ["text_encoders", "clip"], 1: ["text_encoders", "clip"]},
+    "DualCLIPLoader": {0: ["text_encoders", "clip"], 1: ["text_encoders", "clip"]},
+    "CLIPLoader": {0: ["text_encoders", "clip"]},
+    "VAELoader": {0: ["vae"]},
+    "ControlNetLoader": {0: ["controlnet"]},
+    "DiffControlNetLoader": {0: ["controlnet"]},
+    "CLIPVisionLoader": {0: ["clip_vision"]},
+    "IPAdapterModelLoader": {0: ["ipadapter"]},
+    "UpscaleModelLoader": {0: ["upscale_models"]},
+    "LoraLoader": {0: ["loras"]},
+    "DownloadAndLoadSAM2Model": {0: None},
+    "DepthAnythingPreprocessor": {0: None},
+    "DepthAnythingV2Preprocessor": {0: None},
+    "DownloadAndLoadFlorence2Model": {0: None},
 }
 
-def update_custom_nodes():
-    """Pull latest versions of custom nodes (with version pinning for compatibility).
+# UI node modes that keep a node from executing (muted, bypassed)
+INACTIVE_MODES = {2, 4}
+
+def _string_function(node) -> tuple:
+    """(parameter, f-string) for `def f(x): return f'...{x}...'`, else None."""
+    if (isinstance(node, ast.FunctionDef) and len(node.args.args) == 1 and len(node.body) == 1
+            and isinstance(node.body[0], ast.Return) and isinstance(node.body[0].value, ast.JoinedStr)):
+        return node.args.args[0].arg, node.body[0].value
+    return None
+
+def _helper_calls(trees, functions: dict) -> set:
+    """Single-argument functions called by module or class assignments that are not known helpers yet."""
+    names = set()
+    for tree in trees:
+        for node in tree.body:
+            for statement in node.body if isinstance(node, ast.ClassDef) else [node]:
+                if isinstance(statement, ast.Assign) and isinstance(statement.value, ast.Call) \
+                        and isinstance(statement.value.func, ast.Name) and len(statement.value.args) == 1 \
+                        and statement.value.func.id not in functions:
+                    names.add(statement.value.func.id)
+    return names
+
+def _static_string(node, functions: dict, constants: dict):
+    """Value of a string expression the index understands, else None."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.Name):
+        return constants.get(node.id)
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+        # SomeNode.NAME
+        return constants.get(f"{node.value.id}.{node.attr}")
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in functions
+            and len(node.args) == 1 and not node.keywords):
+        # rgthree: NAME = get_name("Seed") with get_name returning f"{name} (rgthree)"
+        argument = _static_string(node.args[0], functions, constants)
+        parameter, template = functions[node.func.id]
+        if argument is None:
+            return None
+        parts = []
+        for value in template.values:
+            if isinstance(value, ast.Constant):
+                parts.append(str(value.value))
+            elif isinstance(value, ast.FormattedValue) and isinstance(value.value, ast.Name) \
+                    and value.value.id == parameter and value.format_spec is None:
+                parts.append(argument)
+            else:
+                return None
+        return "".join(parts)
+    return None
+
+def _collect_constants(tree, functions: dict, constants: dict):
+    """Add a module's string constants and class attributes (as 'Class.NAME') to constants."""
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            value = _static_string(node.value, functions, constants)
+            if value is not None:
+                constants[node.targets[0].id] = value
+        elif isinstance(node, ast.ClassDef):
+            for statement in node.body:
+                if isinstance(statement, ast.Assign) and len(statement.targets) == 1 \
+                        and isinstance(statement.targets[0], ast.Name):
+                    value = _static_string(statement.value, functions, constants)
+                    if value is not None:
+                        constants[f"{node.name}.{statement.targets[0].id}"] = value
+
+def _index_source(tree, functions: dict, constants: dict) -> tuple:
+    """
+    Node types one module registers.
 
-    This is important because shallow clones (--depth 1) may have older code.
-    The latest versions often have critical compatibility fixes.
+    Understands dict literals assigned to *CLASS_MAPPINGS / NODE_CONFIG
+    names (or passed to their update()), item assignments on them, and
+    V3 io.Schema(node_id=...) declarations. Loops copying another module's
+    mappings (ComfyUI's `for name, node_cls in module.NODE_CLASS_MAPPINGS
+    .items(): NODE_CLASS_MAPPINGS[name] = node_cls`) and V3 registrations
+    by schema.node_id re-register types indexed where they are declared,
+    so they are skipped rather than counted as unresolved.
 
-    Some nodes are pinned to specific versions due to dependency compatibility.
+    Returns:
+        (node types, unresolved): unresolved holds the keys that could not
+        be resolved statically, as class names for `Class.NAME` keys and
+        None otherwise
     """
-    comfyui_path = VOLUME_PATH / "runpod-slim" / "ComfyUI"
-    custom_nodes_dir = comfyui_path / "custom_nodes"
+    def registry(target) -> bool:
+        return isinstance(target, ast.Name) and (target.id.endswith("CLASS_MAPPINGS") or target.id == "NODE_CONFIG")
 
-    if not custom_nodes_dir.exists():
-        return
+    types, unresolved = set(), set()
 
-    log_section("Updating Custom Nodes")
+    def add_key(key):
+        value = _static_string(key, functions, constants)
+        if value is not None:
+            types.add(value)
+        elif isinstance(key, ast.Attribute) and isinstance(key.value, ast.Name):
+            unresolved.add(key.value.id)
+        else:
+            unresolved.add(None)
 
-    updated = 0
-    pinned = 0
+    def add_keys(mapping):
+        for key in mapping.keys:
+            if key is not None:  # **other_mappings: indexed where it is defined
+                add_key(key)
 
-    for node_dir in custom_nodes_dir.iterdir():
-        if not node_dir.is_dir():
+    copies = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.For, ast.AsyncFor)):
             continue
-        git_dir = node_dir / ".git"
-        if not git_dir.exists():
+        source = node.iter
+        if isinstance(source, ast.Call) and isinstance(source.func, ast.Attribute) \
+                and source.func.attr in ("items", "keys"):
+            source = source.func.value
+        target = node.target.elts[0] if isinstance(node.target, ast.Tuple) and node.target.elts else node.target
+        if isinstance(source, ast.Attribute) and source.attr.endswith("CLASS_MAPPINGS") and isinstance(target, ast.Name):
+            copies |= {
+                statement for statement in ast.walk(node)
+                if isinstance(statement, ast.Assign) and isinstance(statement.targets[0], ast.Subscript)
+                and isinstance(statement.targets[0].slice, ast.Name) and statement.targets[0].slice.id == target.id
+            }
+
+    for node in ast.walk(tree):
+        if node in copies:
             continue
+        if isinstance(node, ast.Assign) and any(registry(target) for target in node.targets):
+            if isinstance(node.value, ast.Dict):
+                add_keys(node.value)
+            elif not isinstance(node.value, (ast.Name, ast.Attribute)):
+                unresolved.add(None)
+        elif isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Subscript) \
+                and registry(node.targets[0].value):
+            key = node.targets[0].slice
+            if not (isinstance(key, ast.Attribute) and key.attr == "node_id"):
+                add_key(key)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "update" \
+                and registry(node.func.value):
+            if node.args and isinstance(node.args[0], ast.Dict):
+                add_keys(node.args[0])
+        elif isinstance(node, ast.Call):
+            for keyword in node.keywords:
+                if keyword.arg == "node_id":
+                    add_key(keyword.value)
+    return types, unresolved
+
+def _package_sources(root: Path) -> list:
+    """(path, text) of every Python file of a package."""
+    sources = []
+    for directory, subdirs, files in os.walk(root):
+        subdirs[:] = [name for name in subdirs if name not in SKIPPED_SOURCE_DIRS]
+        for name in files:
+            if name.endswith(".py"):
+                path = Path(directory) / name
+                try:
+                    text = path.read_text(errors="replace")
+                except OSError:
+                    continue
+                sources.append((path, text))
+    return sources
+
+def index_node_classes(comfyui_path: Path = COMFYUI_PATH) -> dict:
+    """
+    Index the node types ComfyUI and its custom nodes register, without
+    importing anything.
 
-        node_name = node_dir.name
+    Each package (ComfyUI core, every directory in custom_nodes/) is parsed
+    with ast; single-argument f-string helpers are evaluated, so names built
+    like rgthree's get_name("Seed") resolve too. Only modules that mention a
+    registration are parsed, plus, until nothing new turns up, those
+    defining a class whose NAME a registration uses or a helper such a NAME
+    calls. Names built any other way (loops, dynamic imports) stay
+    unresolved and mark the package dynamic.
 
-        # Check if this node is pinned to a specific version
-        if node_name in PINNED_NODE_VERSIONS:
-            target_commit = PINNED_NODE_VERSIONS[node_name]
+    Returns:
+        Map package name -> {'types': set, 'dynamic': bool, 'errors': [files
+        that failed to parse]}
+    """
+    packages = {"ComfyUI": [comfyui_path / "nodes.py", comfyui_path / "comfy_extras"]}
+    custom_nodes = comfyui_path / "custom_nodes"
+    if custom_nodes.is_dir():
+        for entry in sorted(custom_nodes.iterdir()):
+            if entry.is_dir() and not entry.name.startswith(".") and not entry.name.endswith(".disabled"):
+                packages[entry.name] = [entry]
+
+    index = {}
+    for package, roots in packages.items():
+        sources = []
+        for root in roots:
+            if root.is_file():
+                sources.append((root, root.read_text(errors="replace")))
+            elif root.is_dir():
+                sources.extend(_package_sources(root))
+        trees, errors, parsed = [], [], set()
+
+        def parse(selected):
+            for path, text in selected:
+                parsed.add(path)
+                try:
+                    trees.append(ast.parse(text, filename=str(path)))
+                except (SyntaxError, ValueError):
+                    errors.append(str(path))
+
+        def index_trees():
+            # Helpers and node classes usually live in other modules than
+            # the mappings (rgthree: constants.py, seed.py, __init__.py)
+            functions, constants = {}, {}
+            for tree in trees:
+                for node in tree.body:
+                    helper = _string_function(node)
+                    if helper:
+                        functions[node.name] = helper
+            for tree in trees:
+                _collect_constants(tree, functions, constants)
+            types, unresolved = set(), set()
+            for tree in trees:
+                found, missed = _index_source(tree, functions, constants)
+                types |= found
+                unresolved |= missed
+            return types, unresolved, functions
+
+        parse([source for source in sources if any(marker in source[1] for marker in NODE_REGISTRATION_MARKERS)])
+        types, unresolved, functions = index_trees()
+        while True:
+            wanted = [f"class {name}" for name in unresolved if name]
+            wanted += [f"def {name}(" for name in _helper_calls(trees, functions)]
+            found = [(path, text) for path, text in sources
+                     if path not in parsed and any(w in text for w in wanted)]
+            if not found:
+                break
+            parse(found)
+            types, unresolved, functions = index_trees()
+        index[package] = {"types": types, "dynamic": bool(unresolved), "errors": errors}
+    return index
+
+def read_model_paths(yaml_path: Path) -> dict:
+    """
+    Map ComfyUI folder name -> directories from extra_model_paths.yaml.
 
-            # Fetch all history first (needed for checkout)
-            shallow_file = git_dir / "shallow"
-            if shallow_file.exists():
-                subprocess.run(
-                    ["git", "-C", str(node_dir), "fetch", "--unshallow"],
-                    capture_output=True,
-                    timeout=120
-                )
+    Understands the flat layout written by configure_comfyui and
+    stage_models.py (sections of `key: value` lines), no YAML library needed.
+    """
+    folders = {}
+    try:
+        lines = yaml_path.read_text().splitlines()
+    except OSError:
+        return folders
+    sections, current = [], None
+    for line in lines:
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        key, _, value = line.strip().partition(":")
+        if not line.startswith((" ", "\t")):
+            current = {}
+            sections.append(current)
+        elif current is not None:
+            current[key.strip()] = value.strip()
+    for section in sections:
+        base = Path(section.pop("base_path", ""))
+        section.pop("is_default", None)
+        for folder, value in section.items():
+            for directory in value.split("|"):
+                if directory.strip():
+                    folders.setdefault(folder, []).append(base / directory.strip())
+    return folders
+
+def manifest_locations() -> dict:
+    """Map model file name (or repo id) -> where MODEL_MANIFEST puts it, for every variant."""
+    locations = {}
+    for tier_data in MODEL_MANIFEST.values():
+        for entry in tier_data["models"]:
+            for model in model_variants(entry):
+                if model.get("file") is None:
+                    locations[model["repo"]] = model_dest_dir(model)
+                else:
+                    locations[model.get("rename_to") or Path(model["file"]).name] = model_check_path(model)
+    return locations
 
-            # Check current commit
-            current = subprocess.run(
-                ["git", "-C", str(node_dir), "rev-parse", "HEAD"],
-                capture_output=True,
-                text=True
-            ).stdout.strip()
-
-            if not current.startswith(target_commit):
-                # Checkout the pinned version
-                subprocess.run(
-                    ["git", "-C", str(node_dir), "checkout", target_commit],
-                    capture_output=True,
-                    timeout=60
-                )
-                log_info(f"Pinned: {node_name} -> {target_commit} (for transformers 4.51.3 compatibility)")
-                pinned += 1
-            else:
-                log_info(f"Already pinned: {node_name} @ {target_commit[:7]}")
+def preflight_check(workflow: dict, comfyui_path: Path = COMFYUI_PATH) -> dict:
+    """
+    Check a UI-format workflow against what is installed, statically.
 
+    Returns:
+        {'missing_nodes', 'inactive_missing_nodes', 'unverified_nodes',
+        'missing_models', 'packages', 'index_seconds'}: missing_* list
+        (node id, type, detail) tuples; unverified nodes are not in the
+        index, but the package the workflow names for them (properties
+        cnr_id) registers nodes dynamically, or no package is named and
+        some package does
+    """
+    started = time.monotonic()
+    index = index_node_classes(comfyui_path)
+    index_seconds = time.monotonic() - started
+    known = set().union(*(package["types"] for package in index.values()))
+    dynamic = sorted(name for name, package in index.items() if package["dynamic"])
+    # Registry ids (cnr_id) match directory names up to case and -/_
+    installed = {name.lower().replace("_", "-"): name for name in index}
+    installed["comfy-core"] = "ComfyUI"
+
+    folders = read_model_paths(comfyui_path / "extra_model_paths.yaml")
+    for folder in {name for loaders in PREFLIGHT_LOADERS.values() for names in loaders.values() for name in names or []}:
+        folders.setdefault(folder, []).append(comfyui_path / "models" / folder)
+    locations = manifest_locations()
+
+    result = {
+        "missing_nodes": [], "inactive_missing_nodes": [], "unverified_nodes": [], "missing_models": [],
+        "packages": len(index) - 1, "node_types": len(known), "index_seconds": index_seconds,
+    }
+    for node in workflow.get("nodes", []):
+        node_type = node.get("type")
+        inactive = node.get("mode", 0) in INACTIVE_MODES
+        if node_type not in known and node_type not in FRONTEND_NODES:
+            cnr_id = (node.get("properties") or {}).get("cnr_id")
+            package = installed.get(str(cnr_id).lower().replace("_", "-")) if cnr_id else None
+            if inactive:
+                result["inactive_missing_nodes"].append((node["id"], node_type, "muted/bypassed"))
+            elif cnr_id and package is None:
+                result["missing_nodes"].append((node["id"], node_type, f"from {cnr_id}, which is not installed"))
+            elif package is not None and index[package]["dynamic"]:
+                result["unverified_nodes"].append((node["id"], node_type, f"maybe registered dynamically by {package}"))
+            elif package is not None:
+                result["missing_nodes"].append((node["id"], node_type, f"{package} does not register it"))
+            elif dynamic:
+                result["unverified_nodes"].append((node["id"], node_type, f"maybe registered by {', '.join(dynamic)}"))
+            else:
+                result["missing_nodes"].append((node["id"], node_type, "no installed package registers it"))
+        if inactive:
             continue
 
-        # Regular update for non-pinned nodes
-        # Check if shallow clone
-        shallow_file = git_dir / "shallow"
-        if shallow_file.exists():
-            subprocess.run(
-                ["git", "-C", str(node_dir), "fetch", "--unshallow"],
-                capture_output=True,
-                timeout=120
-            )
-
-        # Get current commit before pull
-        before = subprocess.run(
-            ["git", "-C", str(node_dir), "rev-parse", "HEAD"],
-            capture_output=True,
-            text=True
-        ).stdout.strip()
+        values = node.get("widgets_values") or []
+        for index_, searched in PREFLIGHT_LOADERS.get(node_type, {}).items():
+            if index_ >= len(values) or not isinstance(values[index_], str) or values[index_] == "None":
+                continue
+            name = values[index_]
+            if searched is not None and any((directory / name).exists()
+                                            for folder in searched for directory in folders.get(folder, [])):
+                continue
+            location = locations.get(name) or locations.get(Path(name).name)
+            if searched is None and location is not None and location.exists():
+                continue
+            if location is None:
+                detail = "not in MODEL_MANIFEST"
+            elif not location.exists():
+                detail = f"in MODEL_MANIFEST but not downloaded ({location})"
+            else:
+                detail = f"downloaded to {location} but not in the {'/'.join(searched)} model paths"
+            result["missing_models"].append((node["id"], f"{node_type}: {name}", detail))
+    return result
+
+def run_preflight(workflow_path: Path = WORKFLOW_FILE) -> bool:
+    """Run the preflight check and log its report. False if anything would fail at queue time."""
+    log_section("Preflight Check")
+    if not COMFYUI_PATH.exists():
+        log_warn(f"ComfyUI not found at {COMFYUI_PATH}; skipping preflight")
+        return False
+    try:
+        workflow = json.loads(workflow_path.read_text())
+    except (OSError, ValueError) as e:
+        log_error(f"Cannot read workflow {workflow_path}: {e}")
+        return False
 
-        # Pull latest
-        subprocess.run(
-            ["git", "-C", str(node_dir), "pull", "--ff-only"],
-            capture_output=True,
-            timeout=120
-        )
+    result = preflight_check(workflow)
+    log_info(f"Indexed {result['node_types']} node types in ComfyUI + {result['packages']} custom node "
+             f"packages in {result['index_seconds']:.2f}s")
+    for node_id, name, detail in result["missing_nodes"]:
+        log_error(f"Missing node type #{node_id} {name}: {detail}")
+    for node_id, name, detail in result["missing_models"]:
+        log_error(f"Missing model #{node_id} {name}: {detail}")
+    for node_id, name, detail in result["unverified_nodes"]:
+        log_warn(f"Unverified node type #{node_id} {name}: {detail}")
+    for node_id, name, detail in result["inactive_missing_nodes"]:
+        log_warn(f"Missing node type #{node_id} {name} ({detail}; shown red in the UI)")
+
+    if result["missing_nodes"] or result["missing_models"]:
+        log_error(f"{workflow_path.name} would fail when queued")
+        return False
+    log_info(f"All node types and models of {workflow_path.name} resolve")
+    return True
 
-        # Get commit after pull
-        after = subprocess.run(
-            ["git", "-C", str(node_dir), "rev-parse", "HEAD"],
-            capture_output=True,
-            text=True
-        ).stdout.strip()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="RunPod setup for PH's Archviz ComfyUI workflow")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help=f"Concurrent model downloads (default: {DEFAULT_DOWNLOAD_WORKERS}), "
+             "or hashing processes with --verify (default: CPU count)",
+    )
+    parser.add_argument(
+        "--update-nodes", action="store_true",
+        help="Re-lock every unpinned custom node to its latest remote commit",
+    )
+    parser.add_argument(
+        "--layout", action="append", type=Path, default=[], metavar="DIR",
+        help="Also materialize the model layout under DIR from the blob store "
+             "(e.g. /runpod-volume); repeatable",
+    )
+    parser.add_argument(
+        "--plan", action="store_true",
+        help="Dry run: report the work setup would do from stat calls only "
+             f"(exit {PLAN_NOTHING_TO_DO}: nothing to do, {PLAN_WORK_PENDING}: work pending, 1: disk too small)",
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=PLAN_BANDWIDTH_MBPS, metavar="MBPS",
+        help=f"Download bandwidth assumed by --plan in MB/s (default: {PLAN_BANDWIDTH_MBPS})",
+    )
+    parser.add_argument(
+        "--verify", nargs="?", const="full", choices=["full", "quick"],
+        help="Only check all models and report; exit 1 on any mismatch. "
+             "full (default) re-hashes everything in parallel, quick parses headers "
+             "and compares sampled chunks",
+    )
+    parser.add_argument(
+        "--max-phases", type=int, default=DEFAULT_PARALLEL_PHASES, metavar="N",
+        help=f"Setup phases run concurrently (default: {DEFAULT_PARALLEL_PHASES}; 1 = sequential)",
+    )
+    parser.add_argument(
+        "--rehash", action="store_true",
+        help="Ignore the model ledger and re-hash every existing model file",
+    )
+    parser.add_argument(
+        "--preflight", nargs="?", const=WORKFLOW_FILE, type=Path, metavar="WORKFLOW",
+        help="Only check that every node type and model file of WORKFLOW "
+             f"(default: {WORKFLOW_FILE}) is installed; exit 1 if not",
+    )
+    return parser.parse_args(argv)
+
+def download_models(args) -> bool:
+    """Download missing or invalid models (the ledger skips verified ones)."""
+    log_section("Downloading Models")
+    results = schedule_downloads(
+        list(iter_manifest()),
+        workers=args.jobs or DEFAULT_DOWNLOAD_WORKERS,
+        rehash=args.rehash,
+    )
+    success_count = sum(results.values())
+    total_count = len(results)
 
-        if before != after:
-            log_info(f"Updated: {node_dir.name} ({before[:7]} -> {after[:7]})")
-            updated += 1
+    log_info(
+        f"Download I/O: wrote {IO_COUNTERS['bytes_written'] / GB:.2f} GB, "
+        f"read back {IO_COUNTERS['bytes_read'] / GB:.2f} GB for hashing"
+    )
 
-    log_info(f"Updated {updated} nodes, pinned {pinned} nodes")
+    failed = [name for name, ok in results.items() if not ok]
+    if failed:
+        log_error(f"Failed: {', '.join(failed)}")
 
-def main():
-    print()
-    print("=" * 72)
-    print("  RUNPOD MODEL DOWNLOAD - PH's Archviz ComfyUI Workflow")
-    print("  Using huggingface_hub Python API (no CLI dependency)")
-    print("=" * 72)
-    print()
+    # Check if all models downloaded
+    if success_count != total_count:
+        log_error(f"Downloaded {success_count}/{total_count} models")
+        log_error("Fix the failed downloads and run again (only failed models are retried)")
+        return False
 
-    # Check if models already downloaded
-    models_already_downloaded = MARKER_FILE.exists()
+    log_info(f"All {total_count} models present and verified")
+    return True
 
-    if not models_already_downloaded:
-        # Initialize log
-        log_to_file("=== Download started ===")
+def check_model_tree() -> bool:
+    """Post-download checks of the model directory tree."""
+    log_section("Post-Download Verification")
 
-        # Create directories
-        log_section("Creating Directory Structure")
-        create_directories()
+    # Clean up any remaining .cache directories
+    for cache_dir in MODELS_PATH.rglob(".cache"):
+        shutil.rmtree(cache_dir, ignore_errors=True)
 
-        # Download all models
-        success_count = 0
-        total_count = 0
+    # Verify flat structure
+    log_info("Verifying flat directory structure...")
+    errors = verify_flat_structure()
 
-        for tier_key, tier_data in MODEL_MANIFEST.items():
-            log_section(f"Downloading {tier_data['description']}")
+    if errors > 0:
+        log_error(f"{errors} directory structure errors found!")
+        return False
 
-            for model in tier_data["models"]:
-                total_count += 1
-                name = model["name"]
+    # Count files
+    count_files()
+    return True
 
-                # Print format warning if present
-                if model.get("format_warning"):
-                    log_warn(f"{name} ({model['format_warning']})...")
-                else:
-                    log_info(f"{name}...")
+def build_layout(root: Path) -> bool:
+    """Materialize one extra consumer layout from the blob store."""
+    if materialize_layout(root):
+        log_error(f"Layout {root} is incomplete")
+        return False
+    return True
 
-                # Determine destination directory
-                if model.get("dest_is_absolute"):
-                    dest_dir = VOLUME_PATH / model["dest"]
-                else:
-                    dest_dir = MODELS_PATH / model["dest"]
-
-                # Download based on type
-                if model.get("url"):
-                    # Direct URL download
-                    success = download_url(
-                        url=model["url"],
-                        dest_dir=dest_dir,
-                        filename=model["file"],
-                        expected_hash=model.get("hash"),
-                    )
-                elif model.get("file") is None:
-                    # Full repository download
-                    success = download_repo(
-                        repo_id=model["repo"],
-                        dest_dir=dest_dir,
-                        hash_file=model.get("hash_file"),
-                        expected_hash=model.get("hash"),
-                    )
-                else:
-                    # Single file download
-                    success = download_file(
-                        repo_id=model["repo"],
-                        filename=model["file"],
-                        dest_dir=dest_dir,
-                        expected_hash=model.get("hash"),
-                        flatten_from=model.get("flatten_from"),
-                        rename_to=model.get("rename_to"),
-                    )
-
-                if success:
-                    success_count += 1
-
-        # Verification
-        log_section("Post-Download Verification")
-
-        # Clean up any remaining .cache directories
-        for cache_dir in MODELS_PATH.rglob(".cache"):
-            shutil.rmtree(cache_dir, ignore_errors=True)
-
-        # Verify flat structure
-        log_info("Verifying flat directory structure...")
-        errors = verify_flat_structure()
-
-        if errors > 0:
-            log_error(f"{errors} directory structure errors found!")
-            return 1
-
-        # Count files
-        count_files()
-
-        # Mark as complete
-        MARKER_FILE.touch()
-
-        # Check if all models downloaded
-        if success_count != total_count:
-            log_error(f"Downloaded {success_count}/{total_count} models")
-            log_error("Fix the failed downloads and run again")
-            return 1
-
-        log_info(f"All {total_count} models downloaded successfully!")
-    else:
-        log_info("Models already downloaded (skipping)")
-        log_info("To re-download: rm /workspace/.models_downloaded")
+def setup_phases(args) -> list:
+    """
+    The setup dependency graph.
 
-    # Configure ComfyUI (model paths + symlinks)
-    configure_comfyui()
+    Models, custom nodes and the workflow are independent of each other:
+    node sync and the pip install run while the large models download.
+    """
+    phases = [
+        {"name": "directories", "run": create_directories},
+        {"name": "models", "run": lambda: download_models(args), "after": ["directories"], "critical": True},
+        {"name": "model checks", "run": check_model_tree, "after": ["models"], "critical": True},
+        {"name": "configure comfyui", "run": configure_comfyui, "after": ["directories"]},
+        {"name": "node sync", "run": lambda: install_custom_nodes(update_nodes=args.update_nodes)},
+        {"name": "node dependencies", "run": install_node_dependencies, "after": ["node sync"]},
+        {"name": "workflow", "run": download_workflow},
+        # Reports what would fail at queue time; failures are not fatal to setup
+        {
+            "name": "preflight",
+            "run": run_preflight,
+            "after": ["model checks", "configure comfyui", "node dependencies", "workflow"],
+        },
+    ]
+    for root in args.layout:
+        # Extra consumer layouts share the same blobs
+        phases.append({
+            "name": f"layout {root}",
+            "run": lambda root=root: build_layout(root),
+            "after": ["model checks"],
+            "critical": True,
+        })
+    return phases
+
+def run_setup(args) -> int:
+    """Run the full setup; every phase is timed into REPORT."""
+    print()
+    print("=" * 72)
+    print("  RUNPOD MODEL DOWNLOAD - PH's Archviz ComfyUI Workflow")
+    print("  Using huggingface_hub Python API (no CLI dependency)")
+    print("=" * 72)
+    print()
 
-    # Install custom nodes
-    install_custom_nodes()
+    # Initialize log
+    log_to_file("=== Download started ===")
 
-    # Update custom nodes to latest versions (critical for compatibility fixes)
-    update_custom_nodes()
+    phases = setup_phases(args)
+    statuses = run_phases(phases, max_parallel=args.max_phases)
 
-    # Download workflow
-    download_workflow()
+    failed = [phase["name"] for phase in phases if phase.get("critical") and statuses[phase["name"]] != "ok"]
+    if failed:
+        log_section("Setup Incomplete")
+        log_error(f"Failed phases: {', '.join(failed)}")
+        return 1
 
     # Completion
     log_section("Setup Complete")
@@ -990,5 +3431,31 @@ def main():
 
     return 0
 
+def main(argv=None):
+    args = parse_args(argv)
+    if args.plan:
+        return plan_setup(args.bandwidth, args.rehash)
+    if args.preflight:
+        return 0 if run_preflight(args.preflight) else 1
+
+    # Installed here rather than at import, so sibling tools can import
+    # MODEL_MANIFEST without side effects
+    ensure_huggingface_hub()
+
+    started = time.monotonic()
+    exit_code = None
+
+    try:
+        if args.verify == "quick":
+            exit_code = quick_verify_models(workers=args.jobs)
+        elif args.verify:
+            exit_code = verify_models(workers=args.jobs)
+        else:
+            exit_code = run_setup(args)
+        return exit_code
+    finally:
+        report = write_report(started, "verify" if args.verify else "setup", exit_code)
+        print_report_summary(report)
+
 if __name__ == "__main__":
     sys.exit(main())
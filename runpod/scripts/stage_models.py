@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Stage the models a workflow loads onto the pod's local disk.
+
+Models on the network volume are read at network-storage speed every time
+ComfyUI (re)loads them, e.g. when switching between the SDXL and Flux
+stages. This copies the models the workflow needs to local disk in
+parallel, checks each copy's SHA256 (computed while copying) against the
+model ledger written by setup.py, and rewrites extra_model_paths.yaml so
+ComfyUI looks in the local copy first and falls back to the volume for
+anything not staged.
+
+Local disk does not survive the pod, so run this at every pod start,
+before ComfyUI starts (or restart ComfyUI afterwards):
+
+Usage:
+    python3 /workspace/stage_models.py
+    python3 /workspace/stage_models.py --local /local-models --jobs 4
+    python3 /workspace/stage_models.py --dry-run
+    python3 /workspace/stage_models.py --restore    # volume-only paths again
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from patch_workflow import model_references
+from setup import (
+    COMFYUI_PATH,
+    EXTRA_MODEL_PATHS_YAML,
+    GB,
+    LEDGER_FILE,
+    MB,
+    MODEL_MANIFEST,
+    VOLUME_PATH,
+    WORKFLOW_FILE,
+    model_check_path,
+    model_variants,
+)
+
+LOCAL_PATH = Path("/local-models")
+
+COPY_CHUNK_SIZE = 16 * MB
+DEFAULT_JOBS = 4
+
+# Local space left free for outputs, temp files and pip caches
+DEFAULT_RESERVE = 10 * GB
+
+# ComfyUI folder name -> directory relative to the volume root, as in the
+# extra_model_paths.yaml written by setup.py
+MODEL_FOLDERS = {
+    "checkpoints": "models/checkpoints",
+    "clip": "models/clip",
+    "clip_vision": "models/clip_vision",
+    "controlnet": "models/controlnet",
+    "ipadapter": "models/ipadapter",
+    "vae": "models/vae",
+    "diffusion_models": "models/unet",
+    "upscale_models": "models/upscale_models",
+    "loras": "models/loras",
+}
+
+def load_ledger_hashes() -> dict:
+    """Map volume path -> SHA256 of every model verified by setup.py."""
+    try:
+        ledger = json.loads(LEDGER_FILE.read_text())
+    except (OSError, ValueError):
+        return {}
+    return {entry["path"]: entry["sha256"] for entry in ledger.get("models", {}).values() if entry.get("sha256")}
+
+def unpinned_paths() -> set:
+    """Volume paths of manifest variants without a pinned SHA256, which setup.py never verifies."""
+    return {
+        str(model_check_path(variant))
+        for tier_data in MODEL_MANIFEST.values() for model in tier_data["models"]
+        for variant in model_variants(model) if not variant.get("hash")
+    }
+
+def plan_staging(workflow: dict, local: Path, hashes: dict, space: int) -> tuple:
+    """
+    Choose the model files to stage, in execution order.
+
+    Only single files in folders ComfyUI resolves through
+    extra_model_paths.yaml can be staged; models that custom nodes load
+    from fixed paths (SAM2, Depth Anything, Florence-2) stay on the volume.
+
+    Returns:
+        (staged, fallback): staged is a list of (source, target, sha256, size)
+        to copy; fallback is a list of (relative path, reason)
+    """
+    folders = set(MODEL_FOLDERS.values())
+    unpinned = unpinned_paths()
+    staged, fallback = [], []
+    for reference in model_references(workflow):
+        relative = reference["path"]
+        source = VOLUME_PATH / relative
+        target = local / relative
+        if str(Path(relative).parent) not in folders:
+            fallback.append((relative, "loaded from a fixed path"))
+        elif not source.is_file():
+            fallback.append((relative, "not on the volume"))
+        elif str(source) in unpinned and str(source) not in hashes:
+            fallback.append((relative, "no pinned hash in MODEL_MANIFEST"))
+        elif str(source) not in hashes:
+            fallback.append((relative, "not in the model ledger (run setup.py)"))
+        else:
+            size = source.stat().st_size
+            if target.is_file() and target.stat().st_size == size and read_stamp(target) == hashes[str(source)]:
+                # Staged earlier in this pod's life: nothing to copy
+                staged.append((source, target, hashes[str(source)], 0))
+            elif size > space:
+                fallback.append((relative, f"{size / GB:.1f} GB does not fit in local space"))
+            else:
+                staged.append((source, target, hashes[str(source)], size))
+                space -= size
+    return staged, fallback
+
+def stamp_path(target: Path) -> Path:
+    return target.with_name(f".{target.name}.sha256")
+
+def read_stamp(target: Path) -> str:
+    """SHA256 recorded when target was staged (None if not staged)."""
+    try:
+        return stamp_path(target).read_text().strip()
+    except OSError:
+        return None
+
+def copy_verified(source: Path, target: Path, expected_hash: str) -> str:
+    """
+    Copy source to target, hashing the bytes as they are written.
+
+    The copy goes to a temporary name and is only renamed into place when
+    its hash matches, so a partial or corrupt copy is never visible.
+
+    Returns:
+        None on success, otherwise the reason the copy was rejected
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = target.with_name(target.name + ".staging")
+    sha256 = hashlib.sha256()
+    buffer = bytearray(COPY_CHUNK_SIZE)
+    view = memoryview(buffer)
+    try:
+        with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(src.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                count = src.readinto(buffer)
+                if not count:
+                    break
+                sha256.update(view[:count])
+                dst.write(view[:count])
+    except OSError as e:
+        # e.g. the local disk filled up: leave no partial copy behind
+        tmp_path.unlink(missing_ok=True)
+        return f"copy failed: {e}"
+    if sha256.hexdigest() != expected_hash:
+        tmp_path.unlink()
+        return f"hash mismatch (got {sha256.hexdigest()})"
+    os.replace(tmp_path, target)
+    stamp_path(target).write_text(expected_hash + "\n")
+    return None
+
+def stage(staged: list, jobs: int) -> list:
+    """
+    Copy models in parallel, earliest-needed first.
+
+    Returns:
+        Targets that were staged and verified
+    """
+    done = []
+    started = time.monotonic()
+    total = 0
+
+    def job(source: Path, target: Path, expected_hash: str) -> tuple:
+        start = time.monotonic()
+        return copy_verified(source, target, expected_hash), time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for source, target, expected_hash, size in staged:
+            if not size:
+                print(f"  already staged          {target.name}")
+                done.append(target)
+                continue
+            futures[pool.submit(job, source, target, expected_hash)] = (target, size)
+        for future in as_completed(futures):
+            target, size = futures[future]
+            try:
+                problem, seconds = future.result()
+            except OSError as e:
+                problem, seconds = str(e), 0
+            if problem:
+                print(f"  FAILED {target.name}: {problem} (using the volume copy)")
+                continue
+            total += size
+            done.append(target)
+            print(f"  {size / MB:>9,.0f} MB {seconds:>6.1f}s "
+                  f"{size / MB / max(seconds, 1e-6):>7,.0f} MB/s  {target.name}")
+
+    elapsed = time.monotonic() - started
+    print(f"Staged {total / GB:.2f} GB in {elapsed:.1f}s ({total / MB / max(elapsed, 1e-6):,.0f} MB/s)")
+    return done
+
+def model_paths_yaml(local: Path, staged_dirs: set) -> str:
+    """
+    extra_model_paths.yaml with the local copy searched before the volume.
+
+    ComfyUI inserts the folders of every is_default section at the front of
+    its search list, section by section, so the local section comes last
+    to take precedence; files not staged are found on the volume.
+    """
+    folders = [(name, relative) for name, relative in MODEL_FOLDERS.items() if relative in staged_dirs]
+    if not folders:
+        return EXTRA_MODEL_PATHS_YAML
+    lines = ["", "luma_local:", f"    base_path: {local}/", "    is_default: true"]
+    lines += [f"    {name}: {relative}/" for name, relative in folders]
+    return EXTRA_MODEL_PATHS_YAML + "\n".join(lines) + "\n"
+
+def write_model_paths(text: str):
+    yaml_path = COMFYUI_PATH / "extra_model_paths.yaml"
+    if not COMFYUI_PATH.exists():
+        print(f"Warning: ComfyUI not found at {COMFYUI_PATH}; not writing {yaml_path.name}")
+        return
+    tmp_path = yaml_path.with_name(yaml_path.name + ".tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, yaml_path)
+    print(f"Wrote {yaml_path}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stage a workflow's models on local disk")
+    parser.add_argument("workflow", nargs="?", type=Path, default=WORKFLOW_FILE,
+                        help=f"UI-format workflow JSON (default: {WORKFLOW_FILE})")
+    parser.add_argument("--local", type=Path, default=LOCAL_PATH,
+                        help=f"Local directory for the copies (default: {LOCAL_PATH})")
+    parser.add_argument("--reserve", type=float, default=DEFAULT_RESERVE / GB, metavar="GB",
+                        help=f"Local space to leave free (default: {DEFAULT_RESERVE // GB} GB)")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        help=f"Files copied in parallel (default: {DEFAULT_JOBS})")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only print what would be staged")
+    parser.add_argument("--restore", action="store_true",
+                        help="Point extra_model_paths.yaml back at the volume only")
+    args = parser.parse_args(argv)
+
+    if args.restore:
+        write_model_paths(EXTRA_MODEL_PATHS_YAML)
+        return 0
+
+    if not args.workflow.exists():
+        print(f"Error: Workflow not found: {args.workflow}")
+        return 1
+    workflow = json.loads(args.workflow.read_text())
+
+    args.local.mkdir(parents=True, exist_ok=True)
+    space = shutil.disk_usage(args.local).free - int(args.reserve * GB)
+    staged, fallback = plan_staging(workflow, args.local, load_ledger_hashes(), max(space, 0))
+
+    print(f"Local space available for models: {max(space, 0) / GB:.1f} GB in {args.local}")
+    for source, _, _, size in staged:
+        print(f"  stage  {size / GB:>6.2f} GB  {source.relative_to(VOLUME_PATH)}")
+    for relative, reason in fallback:
+        print(f"  volume            {relative} ({reason})")
+
+    if args.dry_run:
+        return 0
+
+    done = stage(staged, max(1, args.jobs))
+    write_model_paths(model_paths_yaml(args.local, {str(target.parent.relative_to(args.local)) for target in done}))
+    return 0 if len(done) == len(staged) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
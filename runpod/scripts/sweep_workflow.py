@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Expand a workflow and a sweep spec into the fewest API workflows.
+
+A client review round explores seeds, prompts, resolutions and sampler
+steps. Queuing one full workflow per combination repeats every model load
+and preprocessing step, so seed-only variations are folded into the batch
+size of the workflow's empty latents instead: one run samples N latents
+side by side. Every other axis needs its own workflow (cartesian product).
+
+Sweep spec (JSON, every key optional):
+
+    {
+      "seeds": [1, 2, 3, 4],              // or a count of samples: 4
+      "prompts": {"PROMPT **Positive** OBJECT": ["a timber cabin", "a concrete villa"]},
+      "resolutions": [[1024, 1024], [832, 1216]],
+      "steps": [20, 28],
+      "set": {"152.denoise": [0.2, 0.3]}  // any literal input, by node id or title
+    }
+
+Seeds go to the workflow's Seed node, whose value the samplers linked to it
+share; samplers with their own literal seed (UltimateSDUpscale's tile
+pass) keep it. Without a Seed node they go to every sampler seed. Steps go
+to every sampler/scheduler step count; resolutions to every EmptyLatentImage
+with a literal size. A seed list is honored seed by seed, one workflow
+each. A count asks for that many samples instead: they are folded into
+batches, each batch run with one seed (the workflow's, +1 per batch; a
+negative "randomize" seed like rgthree's -1 needs a seed list), and
+an image is reproduced with its batch's seed, the same batch size and its
+index in the batch.
+
+Only the empty latents feeding a sampler's latent_image directly are
+batched; preview latents (title containing "preview") and the samplers
+they feed keep their size. Every node downstream of a batched latent
+(masks, crops, composites, Florence2/SAM2 detection) is assumed to handle
+a batch image by image, as ComfyUI's core image nodes do.
+
+Usage:
+    python3 sweep_workflow.py sweep.json
+    python3 sweep_workflow.py sweep.json archviz_v037_cuda.json --out sweep/ --max-batch 8
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import sys
+from pathlib import Path
+
+from patch_workflow import (
+    OUTPUT_NODES,
+    WorkflowError,
+    compile_workflow,
+    is_link,
+    links_of,
+    optimize_workflow,
+)
+
+WORKFLOW_FILE = Path(__file__).resolve().parent.parent / "workflows" / "archviz_v037_cuda.json"
+
+# Latent batches larger than this rarely fit next to SDXL + Flux on 24 GB
+DEFAULT_MAX_BATCH = 8
+
+# Node type -> input holding the seed the sampler draws noise from
+SEED_INPUTS = {
+    "KSampler": "seed",
+    "KSamplerAdvanced": "noise_seed",
+    "SamplerCustom": "noise_seed",
+    "RandomNoise": "noise_seed",
+    "UltimateSDUpscale": "seed",
+    "Seed (rgthree)": "seed",
+}
+
+# Node types that only hold a seed for samplers to link to
+SEED_NODES = {"Seed (rgthree)"}
+
+# Node type -> input holding the sampler step count
+STEP_INPUTS = {
+    "KSampler": "steps",
+    "KSamplerAdvanced": "steps",
+    "BasicScheduler": "steps",
+    "KSampler Config (rgthree)": "steps_total",
+}
+
+# Node types that create the initial latent batch
+LATENT_NODES = {"EmptyLatentImage", "EmptySD3LatentImage"}
+
+# Sampler input taking the latent to denoise
+SAMPLER_LATENT_INPUT = "latent_image"
+
+# Inputs a prompt node keeps its text in
+PROMPT_INPUTS = ("text", "prompt")
+
+def literal_inputs(prompt: dict, table: dict) -> list:
+    """(node id, input) for every node in table whose input is a literal."""
+    return [
+        (node_id, table[entry["class_type"]]) for node_id, entry in prompt.items()
+        if entry["class_type"] in table and table[entry["class_type"]] in entry["inputs"]
+        and not is_link(entry["inputs"][table[entry["class_type"]]])
+    ]
+
+def seed_targets(prompt: dict) -> list:
+    """
+    (node id, input) of the literal seeds a seed sweep sets.
+
+    The Seed nodes when the workflow has any, so samplers keeping their
+    own literal seed are left alone; otherwise every literal sampler seed.
+    """
+    targets = literal_inputs(prompt, SEED_INPUTS)
+    return [(node_id, name) for node_id, name in targets if prompt[node_id]["class_type"] in SEED_NODES] or targets
+
+def find_nodes(prompt: dict, reference: str) -> list:
+    """Ids of the nodes a spec refers to, by id or by title."""
+    if reference in prompt:
+        return [reference]
+    nodes = [node_id for node_id, entry in prompt.items() if entry.get("_meta", {}).get("title") == reference]
+    if not nodes:
+        raise WorkflowError(f"no node with id or title {reference!r} in the workflow")
+    return nodes
+
+def sweep_axes(prompt: dict, spec: dict) -> list:
+    """
+    The non-seed axes of a sweep spec.
+
+    Returns:
+        One list per axis of (label, [(node id, input, value), ...]) options
+    """
+    axes = []
+    for reference, texts in spec.get("prompts", {}).items():
+        targets = []
+        for node_id in find_nodes(prompt, reference):
+            name = next((name for name in PROMPT_INPUTS if isinstance(prompt[node_id]["inputs"].get(name), str)), None)
+            if name is None:
+                raise WorkflowError(f"node {node_id} ({reference}) has no literal prompt text")
+            targets.append((node_id, name))
+        axes.append([
+            (f"{reference}={text[:40]}", [(node_id, name, text) for node_id, name in targets])
+            for text in texts
+        ])
+
+    if spec.get("resolutions"):
+        latents = [
+            node_id for node_id, entry in prompt.items()
+            if entry["class_type"] in LATENT_NODES
+            and not is_link(entry["inputs"].get("width")) and not is_link(entry["inputs"].get("height"))
+        ]
+        if not latents:
+            raise WorkflowError("no empty latent with a literal size to sweep resolutions on "
+                                "(sweep the input resize instead, e.g. \"set\": {\"<node>.width\": [...]})")
+        axes.append([
+            (f"{width}x{height}",
+             [(node_id, name, value) for node_id in latents for name, value in (("width", width), ("height", height))])
+            for width, height in spec["resolutions"]
+        ])
+
+    if spec.get("steps"):
+        targets = literal_inputs(prompt, STEP_INPUTS)
+        if not targets:
+            raise WorkflowError("no sampler with a literal step count")
+        axes.append([
+            (f"steps={steps}", [(node_id, name, steps) for node_id, name in targets])
+            for steps in spec["steps"]
+        ])
+
+    for key, values in spec.get("set", {}).items():
+        reference, _, name = key.rpartition(".")
+        nodes = find_nodes(prompt, reference)
+        for node_id in nodes:
+            if name not in prompt[node_id]["inputs"] or is_link(prompt[node_id]["inputs"][name]):
+                raise WorkflowError(f"node {node_id} ({reference}) has no literal input {name!r}")
+        axes.append([
+            (f"{key}={value}", [(node_id, name, value) for node_id in nodes])
+            for value in values
+        ])
+    return axes
+
+def batch_latents(prompt: dict, seed_nodes: list) -> list:
+    """
+    The empty latents whose batch size can carry extra samples.
+
+    Batching works when every node sampling with a swept seed, outside the
+    preview branch, runs on data from an empty latent with a literal batch
+    size that a sampler takes as its latent_image.
+
+    Returns:
+        Ids of the latents to scale, or [] when samples need separate runs
+    """
+    consumers = {node_id: [] for node_id in prompt}
+    for node_id, entry in prompt.items():
+        for source in links_of(entry):
+            if source in consumers:
+                consumers[source].append(node_id)
+
+    def downstream(node_id: str) -> set:
+        reached, pending = set(), [node_id]
+        while pending:
+            for consumer in consumers[pending.pop()]:
+                if consumer not in reached:
+                    reached.add(consumer)
+                    pending.append(consumer)
+        return reached
+
+    # Nodes that sample with a swept seed; nodes fed only by seed sources
+    # (Seed -> RandomNoise) pass the seed on to their consumers
+    sampling, sources, pending = set(), set(), list(seed_nodes)
+    while pending:
+        node_id = pending.pop()
+        if node_id in sources:
+            continue
+        if all(source in sources for source in links_of(prompt[node_id])):
+            sources.add(node_id)
+            pending.extend(consumers[node_id])
+        else:
+            sampling.add(node_id)
+
+    latents, previews = set(), set()
+    for node_id, entry in prompt.items():
+        if entry["class_type"] not in LATENT_NODES:
+            continue
+        if "preview" in entry.get("_meta", {}).get("title", "").lower():
+            previews.add(node_id)
+        elif isinstance(entry["inputs"].get("batch_size"), int) and any(
+            prompt[consumer]["inputs"].get(SAMPLER_LATENT_INPUT) == [node_id, 0] for consumer in consumers[node_id]
+        ):
+            latents.add(node_id)
+
+    reach = {node_id: downstream(node_id) for node_id in latents}
+    batched = set().union(*reach.values())
+    # Samplers only a preview latent feeds stay at the preview's batch size
+    preview_only = set().union(*(downstream(node_id) for node_id in previews)) - batched
+    sampling -= preview_only
+    if not sampling or not sampling <= batched:
+        return []
+    return sorted((node_id for node_id in latents if reach[node_id] & sampling), key=int)
+
+def expand_sweep(prompt: dict, spec: dict, max_batch: int = DEFAULT_MAX_BATCH) -> list:
+    """
+    Expand a sweep spec into API workflows.
+
+    Returns:
+        List of {'prompt', 'labels', 'seed', 'batch'}: seed is the seed the
+        run applies (None if not swept), batch the number of samples per
+        output image, at batch indices 0..batch-1 (1 if unbatched)
+    """
+    seeds = spec.get("seeds")
+    if seeds is not None and not (
+        isinstance(seeds, int) and not isinstance(seeds, bool) and seeds > 0
+        or isinstance(seeds, list) and all(isinstance(seed, int) and not isinstance(seed, bool) and seed >= 0
+                                           for seed in seeds)
+    ):
+        raise WorkflowError(f"'seeds' must be a positive count or a list of seeds >= 0, got {seeds!r}")
+    targets = seed_targets(prompt)
+    if seeds and not targets:
+        raise WorkflowError("no sampler with a literal seed to sweep")
+
+    # (seed, samples) per run
+    runs = [(None, 1)]
+    latents = []
+    if isinstance(seeds, int) and seeds > 0:
+        node_id, name = targets[0]
+        start = prompt[node_id]["inputs"][name]
+        if not isinstance(start, int) or start < 0:
+            raise WorkflowError(f"node {node_id} has seed {start!r} (randomize); list the seeds to render instead")
+        latents = batch_latents(prompt, sorted({node_id for node_id, _ in targets}, key=int))
+        size = 1
+        if latents:
+            largest = max(prompt[node_id]["inputs"]["batch_size"] for node_id in latents)
+            size = max(1, max_batch // largest)
+        runs = [(start + number, min(size, seeds - done)) for number, done in enumerate(range(0, seeds, size))]
+    elif seeds:
+        runs = [(seed, 1) for seed in seeds]
+
+    variants = []
+    for options in itertools.product(*sweep_axes(prompt, spec)):
+        for seed, samples in runs:
+            variant = copy.deepcopy(prompt)
+            for _, changes in options:
+                for node_id, name, value in changes:
+                    variant[node_id]["inputs"][name] = value
+            if seed is not None:
+                for node_id, name in targets:
+                    variant[node_id]["inputs"][name] = seed
+            if samples > 1:
+                for node_id in latents:
+                    variant[node_id]["inputs"]["batch_size"] *= samples
+            variants.append({
+                "prompt": variant,
+                "labels": [label for label, _ in options],
+                "seed": seed,
+                "batch": samples,
+            })
+    return variants
+
+def write_sweep(variants: list, out: Path) -> Path:
+    """
+    Write one API workflow per variant plus sweep.json listing them.
+
+    Image Save prefixes get the variant number, so outputs of different
+    variants never overwrite each other and map back to their settings.
+    """
+    out.mkdir(parents=True, exist_ok=True)
+    index = []
+    for number, variant in enumerate(variants):
+        for entry in variant["prompt"].values():
+            if entry["class_type"] in OUTPUT_NODES and isinstance(entry["inputs"].get("filename_prefix"), str):
+                entry["inputs"]["filename_prefix"] += f"_v{number:03d}"
+        path = out / f"variant_{number:03d}.json"
+        path.write_text(json.dumps(variant["prompt"], indent=2))
+        index.append({
+            "file": path.name,
+            "labels": variant["labels"],
+            "seed": variant["seed"],
+            "batch_indices": list(range(variant["batch"])),
+        })
+    manifest = out / "sweep.json"
+    manifest.write_text(json.dumps(index, indent=2))
+    return manifest
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Expand a sweep spec into batched API workflows")
+    parser.add_argument("spec", type=Path, help="Sweep spec JSON")
+    parser.add_argument("workflow", nargs="?", type=Path, default=WORKFLOW_FILE,
+                        help="UI-format workflow JSON (default: the archviz workflow)")
+    parser.add_argument("--out", type=Path, default=Path("sweep"),
+                        help="Directory for the API workflows (default: ./sweep)")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH,
+                        help=f"Largest latent batch per run (default: {DEFAULT_MAX_BATCH})")
+    parser.add_argument("--no-prune", action="store_true",
+                        help="Keep every enabled node, not only those feeding Image Save outputs")
+    args = parser.parse_args(argv)
+
+    for path in (args.spec, args.workflow):
+        if not path.exists():
+            print(f"Error: File not found: {path}")
+            return 1
+    workflow = json.loads(args.workflow.read_text())
+    spec = json.loads(args.spec.read_text())
+
+    try:
+        prompt = compile_workflow(workflow) if args.no_prune else optimize_workflow(workflow)[0]
+        variants = expand_sweep(prompt, spec, max(1, args.max_batch))
+    except WorkflowError as e:
+        print(f"Error: {e}")
+        return 1
+
+    renders = sum(variant["batch"] for variant in variants)
+    manifest = write_sweep(variants, args.out)
+    print(f"{renders} renders -> {len(variants)} workflows in {args.out}/ (index: {manifest.name})")
+    for number, variant in enumerate(variants):
+        labels = list(variant["labels"])
+        if variant["seed"] is not None:
+            labels.append(f"seed {variant['seed']} x{variant['batch']}" if variant["batch"] > 1 else f"seed {variant['seed']}")
+        print(f"  variant_{number:03d}  {', '.join(labels)}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())